@@ -4,13 +4,14 @@ import sys
 import pandas as pd
 import math
 import os
+from tracker_io import read_tracker
 
 if __name__ == "__main__":
     dataset = sys.argv[1]
     session = sys.argv[2]
 
     central_tracker = "/home/data/NDClab/datasets/" + dataset + "/data-monitoring/central-tracker_" + dataset + ".csv"
-    tracker_df = pd.read_csv(central_tracker, index_col = "id")
+    tracker_df = read_tracker(central_tracker)
     datadict_df = pd.read_csv("/home/data/NDClab/datasets/" + dataset + "/data-monitoring/data-dictionary/central-tracker_datadict.csv")
 
     # get task names
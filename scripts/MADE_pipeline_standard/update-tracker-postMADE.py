@@ -6,6 +6,7 @@ from os.path import join, isdir, isfile, splitext
 
 import pandas as pd
 import re
+from tracker_io import TrackerTransaction
 
 if __name__ == "__main__":
     dataset = sys.argv[1]
@@ -13,7 +14,8 @@ if __name__ == "__main__":
 
     tracker_path = join("/home/data/NDClab/datasets",dataset,"data-monitoring","central-tracker_"+dataset+".csv")
 
-    tracker_df = pd.read_csv(tracker_path, index_col="id")
+    tracker_tx = TrackerTransaction(tracker_path)
+    tracker_df = tracker_tx.tracker
     out_location = join("/home/data/NDClab/datasets",dataset,"derivatives","preprocessed")
 
     preprocessed_subjects = []
@@ -51,9 +53,4 @@ if __name__ == "__main__":
         for sub in eeg_tasks_incomplete_subjects[task]:
             tracker_df.loc[sub, colname] = 0 # any files preprocessed with ERROR override successful files here
 
-    tracker_df.to_csv(tracker_path)
-
-    data_tracker_filename = splitext(tracker_path)[0]
-    tracker_df_no_blank_columns = tracker_df.loc[:, tracker_df.notnull().any(axis=0)]
-    tracker_df_no_blank_columns = tracker_df_no_blank_columns.fillna("NA")
-    tracker_df_no_blank_columns.to_csv(data_tracker_filename + "_viewable.csv")
+    tracker_tx.commit(tracker_df, write_viewable=True)
@@ -1,5 +1,18 @@
+import argparse
 import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import errno
 import os
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 LAB_DIR = os.path.join("/home", "data", "NDClab")
 DATASET_DIR = os.path.join(LAB_DIR, "datasets")
@@ -8,86 +21,1138 @@ BACKUP_DIR = os.path.join(LAB_DIR, "other", "backups")
 DATE_STR = datetime.datetime.now().strftime("%m-%d-%Y")
 BACKUP_LIST = {"sourcedata", "derivatives"}
 SKIPPED_DATASETS = {"bug-testing-dataset"}
+PROGRESS_INTERVAL = 60  # seconds between progress lines
+INDEX_NAME = ".link-index.sqlite"  # in BACKUP_DIR
+INDEX_COMMIT_INTERVAL = (
+    1  # seconds a write transaction is kept open, readers wait on it
+)
+INDEX_TIMEOUT = 60  # seconds to wait for the index when another process holds it
+LINK_RE = re.compile(r"^(.*)-link-(\d{2})-(\d{2})-(\d{4})$")
+PRINT_LOCK = threading.Lock()
+
+# content-addressed mode
+STORE_NAME = ".store"  # in BACKUP_DIR
+SNAPSHOT_DATE = datetime.datetime.now().strftime("%Y-%m-%d")
+SNAPSHOT_SUFFIX = ".json.gz"
+HASH_CHUNK = 4 * 1024 * 1024  # bytes per read when hashing and copying
+
+
+def log(message: str):
+    # print from worker threads without lines running into each other
+    with PRINT_LOCK:
+        print(message)
+
+
+class Progress:
+    """Thread-safe counts of files seen and linked, printed as files/sec every PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, dry_run: bool = False, verb: str = "linked"):
+        self.dry_run = dry_run
+        self.verb = verb
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.files = 0
+        self.links = 0
+        self.errors = 0
+        self.bytes = 0
+        self.links_by_dataset = {}
+
+    def add(
+        self,
+        dataset: str,
+        files: int = 0,
+        links: int = 0,
+        errors: int = 0,
+        bytes_read: int = 0,
+    ):
+        with self.lock:
+            self.files += files
+            self.links += links
+            self.errors += errors
+            self.bytes += bytes_read
+            self.links_by_dataset[dataset] = (
+                self.links_by_dataset.get(dataset, 0) + links
+            )
+            if time.time() - self.last_report >= PROGRESS_INTERVAL:
+                self.last_report = time.time()
+                log(self.summary())
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.start
+        rate = self.files / elapsed if elapsed else 0
+        verb = f"to be {self.verb}" if self.dry_run else self.verb
+        read = ""
+        if self.bytes:
+            mb = self.bytes / (1024 * 1024)
+            read = f", {mb:.0f} MB hashed ({mb / elapsed if elapsed else 0:.1f} MB/s)"
+        return (
+            f"{self.files} files checked, {self.links} {verb}, {self.errors} errors "
+            f"in {elapsed:.0f}s ({rate:.0f} files/sec){read}"
+        )
+
+
+class LinkIndex:
+    """SQLite index of the latest link of every backed up file, keyed by its path under DATASET_DIR.
+
+    A file is only linked again when its inode, size or mtime differ from the indexed ones,
+    so the backup folders don't have to be listed. Folders are listed once, the first time
+    they are seen, to take over the links made before the index existed.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only and not os.path.exists(path):
+            path = ":memory:"
+        elif not read_only:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=INDEX_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS links (dir TEXT, name TEXT, inode INTEGER, "
+            "size INTEGER, mtime_ns INTEGER, link TEXT, PRIMARY KEY (dir, name))"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY)")
+        self.last_commit = time.time()
+
+    def lookup(self, rel_dir: str):
+        """({name: (inode, size, mtime_ns, link)}, whether the folder was indexed before)"""
+        with self.lock:
+            known = self.db.execute(
+                "SELECT 1 FROM dirs WHERE dir = ?", (rel_dir,)
+            ).fetchone()
+            rows = self.db.execute(
+                "SELECT name, inode, size, mtime_ns, link FROM links WHERE dir = ?",
+                (rel_dir,),
+            ).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}, known is not None
+
+    def update(self, rel_dir: str, rows: list, removed: list):
+        """rows: [(name, inode, size, mtime_ns, link)], removed: names no longer in the source folder"""
+        if self.read_only:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO dirs VALUES (?)", (rel_dir,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?)",
+                [(rel_dir,) + row for row in rows],
+            )
+            self.db.executemany(
+                "DELETE FROM links WHERE dir = ? AND name = ?",
+                [(rel_dir, name) for name in removed],
+            )
+            if time.time() - self.last_commit >= INDEX_COMMIT_INTERVAL:
+                self.db.commit()
+                self.last_commit = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.read_only:
+                self.db.commit()
+            self.db.close()
+
+
+class ContentStore:
+    """Backed up files stored once under objects/<hash[:2]>/<hash>, named by the blake2b hash of
+    their contents, and a manifest per night in snapshots/ of which file had which object.
+
+    A file with the same inode, size and mtime as in the latest snapshot isn't read again.
+    """
+
+    def __init__(self, root: str, dry_run: bool = False):
+        self.objects = os.path.join(root, "objects")
+        self.snapshots = os.path.join(root, "snapshots")
+        self.tmp = os.path.join(root, "tmp")
+        self.lock = threading.Lock()
+        self.files = {}
+        if not dry_run:
+            for path in (self.objects, self.snapshots, self.tmp):
+                os.makedirs(path, exist_ok=True)
+            # copies left by a run that was killed
+            for name in os.listdir(self.tmp):
+                os.remove(os.path.join(self.tmp, name))
+        dates = self.snapshot_dates()
+        self.previous = self.load_snapshot(dates[-1])["files"] if dates else {}
+
+    def snapshot_dates(self) -> list:
+        """Dates (YYYY-MM-DD) of the snapshots in the store, oldest first"""
+        try:
+            names = os.listdir(self.snapshots)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            name[: -len(SNAPSHOT_SUFFIX)]
+            for name in names
+            if name.endswith(SNAPSHOT_SUFFIX)
+        )
+
+    def load_snapshot(self, date: str) -> dict:
+        with gzip.open(os.path.join(self.snapshots, date + SNAPSHOT_SUFFIX), "rt") as f:
+            return json.load(f)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def unchanged(self, rel: str, stat: os.stat_result):
+        """The latest snapshot's [digest, size, mtime_ns, inode] of the file if it hasn't changed since"""
+        previous = self.previous.get(rel)
+        if previous is not None and previous[1:] == [
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+        ]:
+            return previous
+        return None
+
+    def store(self, path: str, stat: os.stat_result) -> tuple:
+        """(digest, bytes read, whether it was new) of a file, copied into the store while it's hashed"""
+        digest = hashlib.blake2b(digest_size=32)
+        tmp_path = os.path.join(self.tmp, f"{os.getpid()}.{threading.get_ident()}.tmp")
+        size = 0
+        try:
+            with open(path, "rb") as f, open(tmp_path, "wb") as o:
+                for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                    digest.update(chunk)
+                    o.write(chunk)
+                    size += len(chunk)
+            digest = digest.hexdigest()
+            object_path = self.object_path(digest)
+            if os.path.exists(object_path):
+                return digest, size, False  # same contents as a file stored before
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            # restores link to the object, so it keeps the mtime of the first file stored in it
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, object_path)
+            return digest, size, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def add(self, rel: str, entry: list):
+        with self.lock:
+            self.files[rel] = entry
+
+    def save(self, date: str):
+        path = os.path.join(self.snapshots, date + SNAPSHOT_SUFFIX)
+        tmp_path = os.path.join(self.tmp, date + SNAPSHOT_SUFFIX)
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump({"date": date, "files": self.files}, f)
+        os.replace(tmp_path, path)
+
+    def prune(self, keep: set, dry_run: bool = False) -> tuple:
+        """Removes the snapshots not in keep and the objects no other snapshot refers to,
+        returns (snapshots removed, objects removed, bytes freed)"""
+        dates = self.snapshot_dates()
+        removed = [date for date in dates if date not in keep]
+        if dry_run:
+            return len(removed), 0, 0
+        for date in removed:
+            os.remove(os.path.join(self.snapshots, date + SNAPSHOT_SUFFIX))
+
+        referenced = set()
+        for date in dates:
+            if date in keep:
+                referenced.update(
+                    entry[0] for entry in self.load_snapshot(date)["files"].values()
+                )
+        objects, freed = 0, 0
+        with os.scandir(self.objects) as prefixes:
+            for prefix in prefixes:
+                with os.scandir(prefix.path) as entries:
+                    for entry in entries:
+                        if entry.name not in referenced:
+                            freed += entry.stat().st_size
+                            os.remove(entry.path)
+                            objects += 1
+        return len(removed), objects, freed
+
+
+def retained_snapshots(
+    dates: list, keep_daily: int, keep_weekly: int, keep_monthly: int
+) -> set:
+    """The newest keep_daily dates, and the newest date of each of the last keep_weekly weeks
+    and keep_monthly months; the newest snapshot is always kept"""
+    keep = set(dates[-keep_daily:]) if keep_daily > 0 else set()
+    keep.update(dates[-1:])
+    periods = [
+        (keep_weekly, lambda day: day.isocalendar()[:2]),
+        (keep_monthly, lambda day: (day.year, day.month)),
+    ]
+    for count, period in periods:
+        newest = {}
+        for date in dates:  # oldest first, so the newest of each period is kept
+            newest[period(datetime.date.fromisoformat(date))] = date
+        if count > 0:
+            keep.update(sorted(newest.values())[-count:])
+    return keep
+
+
+def existing_links(backup_subdir_path: str) -> dict:
+    """{source file name: (link name, inode)} of the latest dated link of each file in a backup folder"""
+    try:
+        items = os.listdir(backup_subdir_path)
+    except FileNotFoundError:
+        return {}
+    latest = {}
+    for item in items:
+        match = LINK_RE.match(item)
+        if not match:
+            continue
+        # everything before "-link-MM-DD-YYYY" is the original file's name
+        name, month, day, year = match.groups()
+        date = (year, month, day)
+        if name not in latest or date > latest[name][0]:
+            latest[name] = (date, item)
+    links = {}
+    for name, (_, item) in latest.items():
+        try:
+            inode = os.stat(os.path.join(backup_subdir_path, item)).st_ino
+        except OSError:
+            continue
+        links[name] = (item, inode)
+    return links
+
+
+def make_link(src_file: str, backup_file_path: str, inode: int):
+    """Hard link src_file as backup_file_path, replacing a link of that name to a different file"""
+    try:
+        os.link(src_file, backup_file_path)
+    except FileExistsError:
+        if os.stat(backup_file_path).st_ino == inode:
+            return  # linked by an earlier run that didn't get to update the index
+        # the file was replaced since it was linked today, link the new one in its place
+        tmp_path = f"{backup_file_path}.{os.getpid()}.tmp"
+        os.link(src_file, tmp_path)
+        os.replace(tmp_path, backup_file_path)
 
 
 def main():
-    print("Beginning backup...")
+    # verify and restore take these after the command as well, without defaults of
+    # their own so they don't reset what was given before the command
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument(
+        "--workers",
+        type=int,
+        default=argparse.SUPPRESS,
+        help="directories scanned and files linked or hashed at the same time (default: 1)",
+    )
+    shared.add_argument(
+        "--content-addressed",
+        action="store_true",
+        default=argparse.SUPPRESS,
+        help=f"use the content-addressed store in BACKUP_DIR/{STORE_NAME} instead of the links",
+    )
+    parser = argparse.ArgumentParser(
+        description="Hard-link backup of all datasets",
+        epilog="verify and restore check or rebuild what earlier backups made",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="directories scanned and files linked or hashed at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="count the links (or new objects) that would be made without creating anything",
+    )
+    parser.add_argument(
+        "--content-addressed",
+        action="store_true",
+        help=f"copy new and changed files into BACKUP_DIR/{STORE_NAME} and write "
+        "tonight's snapshot manifest instead of making links",
+    )
+    parser.add_argument(
+        "--keep-daily",
+        type=int,
+        default=7,
+        help="newest N content-addressed snapshots kept (default: 7)",
+    )
+    parser.add_argument(
+        "--keep-weekly",
+        type=int,
+        default=4,
+        help="last snapshot of each of the last N weeks kept (default: 4)",
+    )
+    parser.add_argument(
+        "--keep-monthly",
+        type=int,
+        default=12,
+        help="last snapshot of each of the last N months kept (default: 12)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    verify_parser = commands.add_parser(
+        "verify",
+        parents=[shared],
+        help="check that the backups still match the datasets",
+    )
+    verify_parser.add_argument(
+        "--dataset", action="append", help="only verify this dataset (repeatable)"
+    )
+    verify_parser.add_argument(
+        "--date",
+        help="content-addressed snapshot to verify, MM-DD-YYYY (default: the latest)",
+    )
+    verify_parser.add_argument(
+        "--checksum-objects",
+        action="store_true",
+        help="hash every object of the snapshot, not only those that are the wrong size, "
+        "no longer read-only or linked elsewhere (content-addressed only)",
+    )
+    restore_parser = commands.add_parser(
+        "restore",
+        parents=[shared],
+        help="rebuild a dataset's backed up folders as they were on a date",
+    )
+    restore_parser.add_argument("--dataset", required=True)
+    restore_parser.add_argument(
+        "--date", required=True, help="MM-DD-YYYY, like the dates of the links"
+    )
+    restore_parser.add_argument(
+        "--target", required=True, help="folder to restore into, must be empty"
+    )
+    restore_parser.add_argument(
+        "--link",
+        action="store_true",
+        help="hard-link the store's objects instead of copying them (content-addressed "
+        "only); faster, but the restored files are the objects, a file made writable "
+        "and edited changes in every snapshot",
+    )
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        verify(args)
+    elif args.command == "restore":
+        restore(args)
+    else:
+        backup(args)
+
+
+def backup(args):
+    print("Beginning backup..." if not args.dry_run else "Beginning dry run...")
     print(f"Start time {datetime.datetime.now().isoformat()}")
+    datasets = []
     for dataset in os.listdir(DATASET_DIR):
         if dataset in SKIPPED_DATASETS:
             print(f"Skipping {dataset}")
             continue
         print(f"Backing up {dataset}")
-        backup_dataset(dataset)
+        datasets.append(dataset)
+
+    if args.content_addressed:
+        progress = Progress(args.dry_run, verb="stored")
+        content_addressed_backup(datasets, progress, args)
+    else:
+        progress = Progress(args.dry_run)
+        link_backup(datasets, progress, args)
 
-    print("Finished backup!")
+    if args.dry_run:
+        planned = "files" if args.content_addressed else "links"
+        for dataset, links in sorted(progress.links_by_dataset.items()):
+            print(f"{dataset}: {links} {planned} planned")
+    print(progress.summary())
+    print("Finished backup!" if not args.dry_run else "Finished dry run!")
     print(f"End time {datetime.datetime.now().isoformat()}")
 
 
-def backup_dataset(dataset: str):
+def run_tasks(tasks: list, workers: int):
+    """Runs (function, args) tasks on a thread pool, each returns more tasks to queue"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {executor.submit(function, *args) for function, args in tasks}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for function, args in future.result():
+                    pending.add(executor.submit(function, *args))
+
+
+def link_backup(datasets: list, progress: Progress, args):
+    # cron starts a backup every ten minutes, only one may write to the index
+    lock_path = os.path.join(BACKUP_DIR, f"{INDEX_NAME}.lock")
+    if not args.dry_run:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+    with open(lock_path if not args.dry_run else os.devnull, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another backup is running, exiting")
+            return
+        index = LinkIndex(os.path.join(BACKUP_DIR, INDEX_NAME), read_only=args.dry_run)
+        # every directory is a task, subdirectories found in it are queued as new
+        # tasks, so large datasets are spread over all workers
+        tasks = [
+            (backup_directory, root + (progress, index, args.dry_run))
+            for dataset in datasets
+            for root in dataset_roots(dataset, args.dry_run)
+        ]
+        try:
+            run_tasks(tasks, args.workers)
+        finally:
+            index.close()
+
+
+def dataset_roots(dataset: str, dry_run: bool = False) -> list:
+    """(dataset, source dir, target dir, rel path) of each backed up folder of the dataset"""
     dataset_backup = os.path.join(BACKUP_DIR, dataset)
     # ensure that our backup directory exists
-    if not os.path.isdir(dataset_backup):
+    if not dry_run and not os.path.isdir(dataset_backup):
         os.makedirs(dataset_backup, exist_ok=True)
 
+    roots = []
     for backup_subdir in BACKUP_LIST:
         source_dir = os.path.join(DATASET_DIR, dataset, backup_subdir)
         target_dir = os.path.join(dataset_backup, backup_subdir)
 
         if not os.path.isdir(source_dir):
             continue  # can't back up something that isn't there!
+        roots.append((dataset, source_dir, target_dir, "."))
+    return roots
 
-        # collect all files under the source dir
-        # NB: we do this *once* to minimize costly file system API calls
-        source_tree = {}
-        for root, _, files in os.walk(source_dir):
-            rel_path = os.path.relpath(root, source_dir)
-            source_tree[rel_path] = files
 
-        # mirror the dataset's directory structure to our backup path
-        for rel_path in source_tree:
-            backup_subdir_path = os.path.join(target_dir, rel_path)
-            if not os.path.isdir(backup_subdir_path):
-                os.makedirs(backup_subdir_path, exist_ok=True)
+def backup_directory(
+    dataset: str,
+    source_dir: str,
+    target_dir: str,
+    rel_path: str,
+    progress: Progress,
+    index: LinkIndex,
+    dry_run: bool = False,
+) -> list:
+    """Links the new and changed files of one source folder, returns the tasks for its subfolders"""
+    source_path = os.path.normpath(os.path.join(source_dir, rel_path))
+    # current folder in the backup
+    backup_subdir_path = os.path.normpath(os.path.join(target_dir, rel_path))
+    rel_dir = os.path.relpath(source_path, DATASET_DIR)
 
-        for rel_path, files in source_tree.items():
-            # current folder in the backup
-            backup_subdir_path = os.path.join(target_dir, rel_path)
+    # files are stat'ed to compare them with the index
+    scanned = scan_source(dataset, source_path, progress)
+    if scanned is None:
+        return []
+    subdirs, files = scanned
 
-            try:
-                existing_backup_items = os.listdir(backup_subdir_path)
-            except FileNotFoundError:
-                # if the folder somehow doesn't exist, create it and move on
-                os.makedirs(backup_subdir_path, exist_ok=True)
-                existing_backup_items = []
-
-            # build a quick set of 'basenames' that already have a hard link
-            # e.g. if "mydata-link-01-01-2025" exists, store "mydata" as linked
-            already_linked_basenames = set()
-            for item in existing_backup_items:
-                if "-link-" in item:
-                    # everything up to "-link-" is the original file's basename
-                    base_before_link = item.split("-link-")[0]
-                    already_linked_basenames.add(base_before_link)
-
-            # for each file in this source directory, create a link if needed
-            for filename in files:
-                if filename in already_linked_basenames:
-                    continue  # hard link already exists
-
-                src_file = os.path.join(source_dir, rel_path, filename)
-                link_name = f"{filename}-link-{DATE_STR}"
-                backup_file_path = os.path.join(backup_subdir_path, link_name)
-
-                print(f"Creating link {backup_file_path}")
-
-                try:  # hard link creation
-                    os.link(src_file, backup_file_path)
-                except FileExistsError:
-                    pass  # if link already exists, do nothing
+    indexed, known_dir = index.lookup(rel_dir)
+    if not known_dir:
+        # first time this folder is seen: mirror it in the backup and take over
+        # the links earlier runs made in it
+        if not dry_run:
+            os.makedirs(backup_subdir_path, exist_ok=True)
+        for name, (link_name, inode) in existing_links(backup_subdir_path).items():
+            if name in files:
+                indexed[name] = (inode, None, None, link_name)
+
+    # link each file that is new or no longer the file that was linked last
+    rows, links, errors = [], 0, 0
+    for filename, stat in files.items():
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        previous = indexed.get(filename)
+        if previous is not None and previous[0] == stat.st_ino:
+            # the latest link is this file, edits in place show up in it too
+            if previous[1:3] != (size, mtime_ns):
+                rows.append((filename, stat.st_ino, size, mtime_ns, previous[3]))
+            continue
+
+        src_file = os.path.join(source_path, filename)
+        link_name = f"{filename}-link-{DATE_STR}"
+        backup_file_path = os.path.join(backup_subdir_path, link_name)
+
+        if dry_run:
+            links += 1
+            continue
+
+        log(f"Creating link {backup_file_path}")
+
+        try:  # hard link creation
+            make_link(src_file, backup_file_path, stat.st_ino)
+            rows.append((filename, stat.st_ino, size, mtime_ns, link_name))
+            links += 1
+        except OSError as err:
+            # could be permission issues, etc.
+            log(f"Could not create link for {src_file}. Error: {err}")
+            errors += 1
+
+    removed = [name for name in indexed if name not in files]
+    index.update(rel_dir, rows, removed)
+    progress.add(dataset, files=len(files), links=links, errors=errors)
+    return [
+        (
+            backup_directory,
+            (
+                dataset,
+                source_dir,
+                target_dir,
+                os.path.join(rel_path, subdir),
+                progress,
+                index,
+                dry_run,
+            ),
+        )
+        for subdir in subdirs
+    ]
+
+
+def content_addressed_backup(datasets: list, progress: Progress, args):
+    root = os.path.join(BACKUP_DIR, STORE_NAME)
+    if not args.dry_run:
+        os.makedirs(root, exist_ok=True)
+    # cron starts a backup every ten minutes, only one may write to the store
+    lock_path = os.path.join(root, ".lock") if not args.dry_run else os.devnull
+    with open(lock_path, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another content-addressed backup is running, exiting")
+            return
+        store = ContentStore(root, args.dry_run)
+        tasks = []
+        for dataset in datasets:
+            for backup_subdir in BACKUP_LIST:
+                source_dir = os.path.join(DATASET_DIR, dataset, backup_subdir)
+                if os.path.isdir(source_dir):
+                    tasks.append(
+                        (
+                            snapshot_directory,
+                            (dataset, source_dir, store, progress, args.dry_run),
+                        )
+                    )
+        run_tasks(tasks, args.workers)
+
+        if not args.dry_run:
+            store.save(SNAPSHOT_DATE)
+            print(f"Wrote snapshot {SNAPSHOT_DATE} of {len(store.files)} files")
+        dates = store.snapshot_dates()
+        if args.dry_run and SNAPSHOT_DATE not in dates:
+            dates = sorted(dates + [SNAPSHOT_DATE])
+        keep = retained_snapshots(
+            dates, args.keep_daily, args.keep_weekly, args.keep_monthly
+        )
+        snapshots, objects, freed = store.prune(keep, args.dry_run)
+        if args.dry_run:
+            print(f"{snapshots} snapshots would be pruned")
+        else:
+            print(
+                f"Pruned {snapshots} snapshots and {objects} objects "
+                f"({freed / (1024 * 1024):.0f} MB), {len(keep)} snapshots kept"
+            )
+
+
+def snapshot_directory(
+    dataset: str,
+    source_path: str,
+    store: ContentStore,
+    progress: Progress,
+    dry_run: bool = False,
+) -> list:
+    """Adds the unchanged files of one source folder to the snapshot, returns the tasks for
+    its changed files and subfolders"""
+    tasks, files = [], 0
+    try:
+        with os.scandir(source_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            tasks.append(
+                                (
+                                    snapshot_directory,
+                                    (dataset, entry.path, store, progress, dry_run),
+                                )
+                            )
+                        continue
+                    stat = entry.stat()
                 except OSError as err:
-                    # could be permission issues, etc.
-                    print(f"Could not create link for {src_file}. Error: {err}")
+                    log(f"Could not stat {entry.path}. Error: {err}")
+                    progress.add(dataset, errors=1)
+                    continue
+                files += 1
+                rel = os.path.relpath(entry.path, DATASET_DIR)
+                previous = store.unchanged(rel, stat)
+                if previous is not None:
+                    store.add(rel, previous)
+                else:
+                    tasks.append(
+                        (
+                            snapshot_file,
+                            (dataset, entry.path, rel, stat, store, progress, dry_run),
+                        )
+                    )
+    except OSError as err:
+        log(f"Could not list {source_path}. Error: {err}")
+        progress.add(dataset, errors=1)
+    progress.add(dataset, files=files)
+    return tasks
+
+
+def snapshot_file(
+    dataset: str,
+    path: str,
+    rel: str,
+    stat: os.stat_result,
+    store: ContentStore,
+    progress: Progress,
+    dry_run: bool = False,
+) -> list:
+    """Hashes a new or changed file into the store"""
+    if dry_run:
+        progress.add(dataset, links=1)
+        return []
+    try:
+        digest, size, new = store.store(path, stat)
+    except OSError as err:
+        log(f"Could not store {path}. Error: {err}")
+        progress.add(dataset, errors=1)
+        if rel in store.previous:
+            store.add(rel, store.previous[rel])  # keep the last version we have
+        return []
+    store.add(rel, [digest, stat.st_size, stat.st_mtime_ns, stat.st_ino])
+    progress.add(dataset, links=1 if new else 0, bytes_read=size)
+    return []
+
+
+class Findings:
+    """Thread-safe tally of what verify found, problems are logged as they're found"""
+
+    PROBLEMS = (
+        "missing from backup",
+        "differs from backup",
+        "object missing",
+        "object corrupted",
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, status: str, path: str = None):
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+        if path is not None:
+            log(f"{status}: {path}")
+
+    def problems(self) -> int:
+        return sum(self.counts.get(status, 0) for status in self.PROBLEMS)
+
+
+def hash_file(path: str) -> str:
+    """blake2b hex digest of a file, the hash the content-addressed store names objects by"""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_date(date_str: str) -> datetime.date:
+    try:
+        return datetime.datetime.strptime(date_str, "%m-%d-%Y").date()
+    except ValueError:
+        sys.exit(f"Date {date_str} is not MM-DD-YYYY")
+
+
+def snapshot_for(store: ContentStore, date: datetime.date = None) -> str:
+    """Date of the newest snapshot on or before date (the newest of all without one)"""
+    dates = store.snapshot_dates()
+    if date is not None:
+        dates = [d for d in dates if d <= date.isoformat()]
+    if not dates:
+        sys.exit(
+            "No content-addressed snapshot "
+            + (f"on or before {date}" if date else "found")
+        )
+    return dates[-1]
+
+
+def scan_source(dataset: str, source_path: str, progress: Progress):
+    """(subfolders, {file name: stat}) of a source folder, split like os.walk, None if it can't be listed"""
+    subdirs, files = [], {}
+    try:
+        with os.scandir(source_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    files[entry.name] = entry.stat()
+                except OSError as err:
+                    log(f"Could not stat {entry.path}. Error: {err}")
+                    progress.add(dataset, errors=1)
+    except OSError as err:
+        log(f"Could not list {source_path}. Error: {err}")
+        progress.add(dataset, errors=1)
+        return None
+    return subdirs, files
+
+
+def verify(args):
+    datasets = args.dataset or [
+        dataset
+        for dataset in os.listdir(DATASET_DIR)
+        if dataset not in SKIPPED_DATASETS
+    ]
+    print(f"Verifying {', '.join(sorted(datasets))}")
+    print(f"Start time {datetime.datetime.now().isoformat()}")
+    progress = Progress(verb="checksummed")
+    findings = Findings()
+    if args.content_addressed:
+        store = ContentStore(os.path.join(BACKUP_DIR, STORE_NAME), dry_run=True)
+        date = snapshot_for(store, parse_date(args.date) if args.date else None)
+        print(f"Verifying snapshot {date}")
+        entries = [
+            (rel, entry)
+            for rel, entry in store.load_snapshot(date)["files"].items()
+            if rel.split(os.sep)[0] in datasets
+        ]
+        # stat'ing is the slow part too, so the entries are spread over the workers
+        checked = (
+            {}
+        )  # digest: problem, objects shared by several files are checked once
+        tasks = [
+            (
+                verify_entries,
+                (
+                    entries[i : i + 500],
+                    store,
+                    args.checksum_objects,
+                    checked,
+                    progress,
+                    findings,
+                ),
+            )
+            for i in range(0, len(entries), 500)
+        ]
+    else:
+        index = LinkIndex(os.path.join(BACKUP_DIR, INDEX_NAME), read_only=True)
+        tasks = [
+            (verify_directory, root + (index, progress, findings))
+            for dataset in datasets
+            for root in dataset_roots(dataset, dry_run=True)
+        ]
+    run_tasks(tasks, args.workers)
+
+    for status, count in sorted(findings.counts.items()):
+        print(f"{status}: {count}")
+    print(progress.summary())
+    print(f"End time {datetime.datetime.now().isoformat()}")
+    if findings.problems():
+        sys.exit(1)
+
+
+def verify_directory(
+    dataset: str,
+    source_dir: str,
+    target_dir: str,
+    rel_path: str,
+    index: LinkIndex,
+    progress: Progress,
+    findings: Findings,
+) -> list:
+    """Compares the files of one source folder with their latest links by stat, returns
+    checksum tasks for the pairs whose stats differ and the tasks for its subfolders"""
+    source_path = os.path.normpath(os.path.join(source_dir, rel_path))
+    backup_subdir_path = os.path.normpath(os.path.join(target_dir, rel_path))
+    scanned = scan_source(dataset, source_path, progress)
+    if scanned is None:
+        return []
+    subdirs, files = scanned
+
+    indexed, known_dir = index.lookup(os.path.relpath(source_path, DATASET_DIR))
+    if known_dir:
+        links = {name: row[3] for name, row in indexed.items()}
+    else:
+        links = {
+            name: link for name, (link, _) in existing_links(backup_subdir_path).items()
+        }
+
+    tasks = []
+    for filename, stat in files.items():
+        src_file = os.path.join(source_path, filename)
+        try:
+            backup_file_path = os.path.join(backup_subdir_path, links[filename])
+            backup_stat = os.stat(backup_file_path)
+        except (KeyError, FileNotFoundError):
+            findings.add("missing from backup", src_file)
+            continue
+        if backup_stat.st_ino == stat.st_ino or (
+            backup_stat.st_size == stat.st_size
+            and backup_stat.st_mtime_ns == stat.st_mtime_ns
+        ):
+            findings.add("same")
+        elif backup_stat.st_size != stat.st_size:
+            findings.add("differs from backup", src_file)
+        else:
+            tasks.append(
+                (
+                    verify_checksum,
+                    (dataset, src_file, backup_file_path, progress, findings),
+                )
+            )
+
+    progress.add(dataset, files=len(files))
+    return tasks + [
+        (
+            verify_directory,
+            (
+                dataset,
+                source_dir,
+                target_dir,
+                os.path.join(rel_path, subdir),
+                index,
+                progress,
+                findings,
+            ),
+        )
+        for subdir in subdirs
+    ]
+
+
+def verify_checksum(
+    dataset: str,
+    src_file: str,
+    backup_file_path: str,
+    progress: Progress,
+    findings: Findings,
+) -> list:
+    try:
+        same = hash_file(src_file) == hash_file(backup_file_path)
+    except OSError as err:
+        log(f"Could not checksum {src_file}. Error: {err}")
+        progress.add(dataset, errors=1)
+        return []
+    size = os.path.getsize(src_file)
+    progress.add(dataset, links=1, bytes_read=2 * size)
+    findings.add(
+        "same after checksum" if same else "differs from backup",
+        None if same else src_file,
+    )
+    return []
+
+
+def check_object(
+    store: ContentStore, digest: str, size: int, checksum: bool, checked: dict
+) -> tuple:
+    """(problem with an object or None, bytes hashed). An object is hashed when checksum is
+    set, or when it isn't read-only anymore or is linked elsewhere (by a restore with
+    --link), which is how an object edited in place shows"""
+    if digest in checked:
+        return checked[digest], 0
+    path = store.object_path(digest)
+    problem, hashed = None, 0
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        problem = "object missing"
+    else:
+        if stat.st_size != size:
+            problem = "object corrupted"
+        elif checksum or stat.st_mode & 0o777 != 0o444 or stat.st_nlink > 1:
+            hashed = size
+            if hash_file(path) != digest:
+                problem = "object corrupted"
+    checked[digest] = problem
+    return problem, hashed
+
+
+def verify_entries(
+    entries: list,
+    store: ContentStore,
+    checksum: bool,
+    checked: dict,
+    progress: Progress,
+    findings: Findings,
+) -> list:
+    """Checks a batch of snapshot entries: the object exists with the recorded size and, if
+    it may have changed, the recorded hash, and the dataset file has the recorded stats or,
+    if not, the recorded hash"""
+    for rel, (digest, size, mtime_ns, inode) in entries:
+        dataset = rel.split(os.sep)[0]
+        path = os.path.join(DATASET_DIR, rel)
+        try:
+            problem, hashed = check_object(store, digest, size, checksum, checked)
+        except OSError as err:
+            log(f"Could not checksum object {digest}. Error: {err}")
+            progress.add(dataset, files=1, errors=1)
+            continue
+        if hashed:
+            progress.add(dataset, links=1, bytes_read=hashed)
+        if problem is not None:
+            findings.add(problem, f"{path} ({digest})")
+            progress.add(dataset, files=1)
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            findings.add("not in dataset anymore")
+            progress.add(dataset, files=1)
+            continue
+        if [stat.st_size, stat.st_mtime_ns, stat.st_ino] == [size, mtime_ns, inode]:
+            findings.add("same")
+        elif stat.st_size != size:
+            findings.add("differs from backup", path)
+        else:
+            try:
+                same = hash_file(path) == digest
+            except OSError as err:
+                log(f"Could not checksum {path}. Error: {err}")
+                progress.add(dataset, files=1, errors=1)
+                continue
+            progress.add(dataset, links=1, bytes_read=size)
+            findings.add(
+                "same after checksum" if same else "differs from backup",
+                None if same else path,
+            )
+        progress.add(dataset, files=1)
+    return []
+
+
+def restore(args):
+    date = parse_date(args.date)
+    if os.path.isdir(args.target) and os.listdir(args.target):
+        sys.exit(f"{args.target} is not empty, restore into a new folder")
+    print(f"Restoring {args.dataset} as of {args.date} into {args.target}")
+    print(f"Start time {datetime.datetime.now().isoformat()}")
+    progress = Progress(verb="restored")
+    if args.content_addressed:
+        store = ContentStore(os.path.join(BACKUP_DIR, STORE_NAME), dry_run=True)
+        snapshot = snapshot_for(store, date)
+        print(f"Restoring from snapshot {snapshot}")
+        prefix = args.dataset + os.sep
+        entries = [
+            (rel, entry)
+            for rel, entry in store.load_snapshot(snapshot)["files"].items()
+            if rel.startswith(prefix)
+        ]
+        tasks = [
+            (
+                restore_entries,
+                (
+                    entries[i : i + 500],
+                    store,
+                    args.dataset,
+                    args.target,
+                    args.link,
+                    progress,
+                ),
+            )
+            for i in range(0, len(entries), 500)
+        ]
+    else:
+        dataset_backup = os.path.join(BACKUP_DIR, args.dataset)
+        tasks = [
+            (
+                restore_directory,
+                (args.dataset, dataset_backup, args.target, subdir, date, progress),
+            )
+            for subdir in BACKUP_LIST
+            if os.path.isdir(os.path.join(dataset_backup, subdir))
+        ]
+    run_tasks(tasks, args.workers)
+    print(progress.summary())
+    print(f"End time {datetime.datetime.now().isoformat()}")
+    if progress.errors:
+        sys.exit(1)
+
+
+def link_or_copy(src: str, dest: str, link: bool = True) -> int:
+    """Hard links src as dest, or copies it where that isn't possible or link is False;
+    returns the bytes copied"""
+    if link:
+        try:
+            os.link(src, dest)
+            return 0
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(src, dest)
+    os.chmod(dest, 0o644)
+    return os.path.getsize(dest)
+
+
+def restore_directory(
+    dataset: str,
+    backup_dir: str,
+    target_dir: str,
+    rel_path: str,
+    date: datetime.date,
+    progress: Progress,
+) -> list:
+    """Restores the newest link on or before date of each file in one backup folder,
+    returns the tasks for its subfolders"""
+    backup_path = os.path.join(backup_dir, rel_path)
+    target_path = os.path.join(target_dir, rel_path)
+    subdirs, latest = [], {}
+    with os.scandir(backup_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+                continue
+            match = LINK_RE.match(entry.name)
+            if not match:
+                continue
+            name, month, day, year = match.groups()
+            link_date = datetime.date(int(year), int(month), int(day))
+            if link_date <= date and (
+                name not in latest or link_date > latest[name][0]
+            ):
+                latest[name] = (link_date, entry.path)
+
+    os.makedirs(target_path, exist_ok=True)
+    restored, copied, errors = 0, 0, 0
+    for name, (_, link_path) in latest.items():
+        try:
+            copied += link_or_copy(link_path, os.path.join(target_path, name))
+            restored += 1
+        except OSError as err:
+            log(f"Could not restore {link_path}. Error: {err}")
+            errors += 1
+    progress.add(
+        dataset, files=len(latest), links=restored, errors=errors, bytes_read=copied
+    )
+    return [
+        (
+            restore_directory,
+            (
+                dataset,
+                backup_dir,
+                target_dir,
+                os.path.join(rel_path, subdir),
+                date,
+                progress,
+            ),
+        )
+        for subdir in subdirs
+    ]
+
+
+def restore_entries(
+    entries: list,
+    store: ContentStore,
+    dataset: str,
+    target_dir: str,
+    link: bool,
+    progress: Progress,
+) -> list:
+    """Restores a batch of snapshot entries from their objects, copied out of the store, or
+    linked read-only with link"""
+    restored, copied, errors = 0, 0, 0
+    for rel, (digest, _, mtime_ns, _) in entries:
+        dest = os.path.join(target_dir, os.path.relpath(rel, dataset))
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            copied_bytes = link_or_copy(store.object_path(digest), dest, link)
+            if not link or copied_bytes:
+                os.utime(dest, ns=(mtime_ns, mtime_ns))
+            copied += copied_bytes
+            restored += 1
+        except OSError as err:
+            log(f"Could not restore {rel}. Error: {err}")
+            errors += 1
+    progress.add(
+        dataset, files=len(entries), links=restored, errors=errors, bytes_read=copied
+    )
+    return []
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+import argparse
+import datetime
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+LOG_DIR = os.path.join("/home", "data", "NDClab", "other", "logs")
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# delete-logs.sh deletes what's listed here
+DELETE_LIST = os.path.join(SCRIPT_DIR, "to_be_deleted.txt")
+
+DATE_STR = datetime.datetime.now().strftime("%m-%d-%Y")
+# cron names every log by when it started, e.g. 07_03_2024::07:00:01.log
+LOG_RE = re.compile(r"^(\d{2})_(\d{2})_(\d{4})::(\d{2}):(\d{2}):(\d{2})\.log$")
+MONTHS = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find, list and delete old cron logs in one pass over the log folder"
+    )
+    parser.add_argument(
+        "log_dir", nargs="?", default=LOG_DIR, help=f"(default: {LOG_DIR})"
+    )
+    parser.add_argument(
+        "-r",
+        "--record",
+        action="store_true",
+        help="print how much space the logs from each month take up",
+    )
+    parser.add_argument(
+        "-d",
+        "--dates",
+        metavar="MM_YYYY-MM_YYYY",
+        help="mark logs from MM_YYYY to MM_YYYY for deletion",
+    )
+    parser.add_argument(
+        "--older-than",
+        type=int,
+        metavar="MONTHS",
+        help="mark logs from before the month MONTHS months ago for deletion",
+    )
+    parser.add_argument(
+        "--list",
+        default=DELETE_LIST,
+        help=f"where to write the logs marked for deletion (default: {DELETE_LIST})",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete the marked logs now instead of leaving them for delete-logs.sh",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="logs deleted at the same time (default: 8)",
+    )
+    args = parser.parse_args()
+    if not (args.record or args.dates or args.older_than is not None):
+        parser.error("nothing to do, give -r, -d or --older-than")
+
+    start, end = None, None
+    if args.dates:
+        start, end = parse_range(parser, args.dates)
+    elif args.older_than is not None:
+        today = datetime.date.today()
+        months = today.year * 12 + today.month - 1 - args.older_than
+        start, end = (0, 0), (months // 12, months % 12 + 1)
+        end = (end[0], end[1] - 1) if end[1] > 1 else (end[0] - 1, 12)
+
+    logs, skipped = scan_logs(args.log_dir)
+    print(f"Found {len(logs)} logs in {args.log_dir}")
+    if skipped:
+        print(f"Skipped {skipped} files not named like MM_DD_YYYY::HH:MM:SS.log")
+
+    if args.record:
+        for (year, month), size in sorted(month_sizes(logs).items()):
+            print(f"The logs from {MONTHS[month - 1]} {year} take up {size} KB.")
+
+    if start is None:
+        return
+    marked = sorted(
+        path for path, (year, month, _) in logs.items() if start <= (year, month) <= end
+    )
+    description = (
+        f"from {args.dates}"
+        if args.dates
+        else f"older than {args.older_than} months (up to {end[1]:02d}_{end[0]})"
+    )
+    if not args.delete:
+        write_list(args.list, marked)
+        print(f'Marked {len(marked)} logs {description} in "{args.list}"')
+        return
+
+    deleted, errors = delete_logs(marked, args.workers)
+    deleted_list = os.path.join(
+        os.path.dirname(args.list), f"deleted_log_files_{DATE_STR}.txt"
+    )
+    write_list(deleted_list, deleted)
+    print(f'Deleted {len(deleted)} logs {description}, listed in "{deleted_list}"')
+    if errors:
+        print(f"Could not delete {errors} logs")
+
+
+def parse_range(parser: argparse.ArgumentParser, dates: str) -> tuple:
+    """((start year, month), (end year, month)) of a MM_YYYY-MM_YYYY range"""
+    match = re.match(r"^(\d{2})_(\d{4})-(\d{2})_(\d{4})$", dates)
+    if not match:
+        parser.error('dates must be in "MM_YYYY-MM_YYYY" format')
+    start_month, start_year, end_month, end_year = (int(g) for g in match.groups())
+    if not (1 <= start_month <= 12 and 1 <= end_month <= 12):
+        parser.error("months must be between 01 and 12")
+    start, end = (start_year, start_month), (end_year, end_month)
+    if end < start:
+        parser.error('Start date must be before end date, in "MM_YYYY" format.')
+    return start, end
+
+
+def scan_logs(log_dir: str) -> tuple:
+    """({path: (year, month, KB on disk)} of every log under log_dir, files skipped)
+
+    The folder is walked once with os.scandir, the date comes from the file name and
+    the size from the same stat, so no log is looked at twice."""
+    logs, skipped = {}, 0
+    # absolute, so delete-logs.sh can remove what's listed from any folder
+    folders = [os.path.abspath(log_dir)]
+    while folders:
+        try:
+            entries = list(os.scandir(folders.pop()))
+        except OSError as err:
+            print(f"Could not list folder. Error: {err}")
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+                continue
+            match = LOG_RE.match(entry.name)
+            if not match:
+                skipped += 1
+                continue
+            month, _, year = match.groups()[:3]
+            try:
+                # disk usage like du -k, not the apparent size
+                size = entry.stat(follow_symlinks=False).st_blocks * 512 // 1024
+            except OSError:
+                size = 0
+            logs[entry.path] = (int(year), int(month), size)
+    return logs, skipped
+
+
+def month_sizes(logs: dict) -> dict:
+    sizes = {}
+    for year, month, size in logs.values():
+        sizes[(year, month)] = sizes.get((year, month), 0) + size
+    return sizes
+
+
+def write_list(path: str, logs: list):
+    with open(path, "w") as f:
+        for log in logs:
+            f.write(log + "\n")
+
+
+def delete_logs(logs: list, workers: int) -> tuple:
+    """(logs deleted, number that couldn't be), unlinked on a thread pool"""
+
+    def delete(path: str):
+        try:
+            os.remove(path)
+            return path
+        except OSError as err:
+            print(f"Could not delete {path}. Error: {err}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(delete, logs))
+    deleted = [path for path in results if path is not None]
+    return deleted, len(results) - len(deleted)
+
+
+if __name__ == "__main__":
+    main()
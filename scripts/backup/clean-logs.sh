@@ -1,12 +1,15 @@
 #!/bin/bash
-# A script to clean up log files past six months. Will be run automatically via cron.
-# USAGE: bash /home/data/NDClab/tools/lab-devOps/scripts/backup/clean-logs.sh
-usage() { echo "Usage: bash $0"; exit 0; }
+# A script to clean up log files older than a year. Will be run automatically via cron.
+# USAGE: bash /home/data/NDClab/tools/lab-devOps/scripts/backup/clean-logs.sh [log folder]
+# for monthly log sizes or marking a range of months for delete-logs.sh:
+# python3 /home/data/NDClab/tools/lab-devOps/scripts/backup/clean-logs.py -r -d MM_YYYY-MM_YYYY
+usage() { echo "Usage: bash $0 [log folder]"; exit 0; }
 
-log_dir="/home/data/NDClab/other/logs"
+SINGULARITY_VERSION="3.8.2"
+PYTHON_CONTAINER="/home/data/NDClab/tools/containers/python-3.9/python-3.9.simg"
+CLEAN_PYSCRIPT="/home/data/NDClab/tools/lab-devOps/scripts/backup/clean-logs.py"
 
-# delete logs older than six months
-older_than=`date -d "-12 month" +%y-%m`
-find "$log_dir" -name "*.log" -exec bash -c \
-  'timestamp=$(basename $1) && if [[ "${timestamp:8:2}"-"${timestamp:0:2}" < $2 ]]; \
-  then echo "deleting $1" && rm $1 2>&1; fi' bash {} $older_than ';'
+log_dir="${1:-/home/data/NDClab/other/logs}"
+
+module load "singularity-$SINGULARITY_VERSION"
+singularity exec -e "$PYTHON_CONTAINER" python3 -u "$CLEAN_PYSCRIPT" "$log_dir" --older-than 12 --delete
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # USAGE: bash delete-logs.sh
-# deletes all logs marked for deletion from "clean-logs-alt.sh"
+# deletes all logs marked for deletion by "clean-logs.py -d MM_YYYY-MM_YYYY"
 usage() { echo "Usage: bash $0"; exit 0; }
 
 if [ ! -f /home/data/NDClab/tools/lab-devOps/scripts/backup/to_be_deleted.txt ]
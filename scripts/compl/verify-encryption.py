@@ -0,0 +1,394 @@
+import argparse
+import binascii
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+DATA_PATH = os.path.join("/home", "data", "NDClab", "datasets")
+TOOL_PATH = os.path.join(
+    "/home", "data", "NDClab", "tools", "lab-devOps", "scripts", "configs"
+)
+LOG_PATH = os.path.join("/home", "data", "NDClab", "other", "logs", "encrypt-checks")
+CACHE_PATH = os.path.join(LOG_PATH, ".encryption-cache.sqlite")
+
+PATHS_TO_CHECK = re.compile(r"^(raw|checked)$")
+EXTS_TO_CHECK = re.compile(r"(mp3|mp4|m4a|wav|png|jpg|[mM]odel\.obj|[mM]odel\.mtl)")
+LAB_MGR = "ndclab"
+EMAIL_DOMAIN = "fiu.edu"
+HEADER_BYTES = 4096  # enough for the first packet header, also when ASCII armored
+NESTED_ZIP_IN_MEMORY = (
+    64 * 1024 * 1024
+)  # zips inside zips bigger than this are spooled to disk
+TODAY = datetime.date.today().isoformat()
+
+ENCRYPTED = "encrypted"
+NOT_ENCRYPTED = "not encrypted"
+UNEXPECTED = "unexpected"  # OpenPGP data, but not an encrypted message, or unreadable
+UNREADABLE = (
+    "could not read"  # never cached, a chmod or setfacl doesn't change the mtime
+)
+# OpenPGP packet tags (RFC 9580 section 5)
+PUBLIC_KEY_ENCRYPTED_SESSION_KEY = 1
+SYMMETRIC_KEY_ENCRYPTED_SESSION_KEY = 3
+ENCRYPTED_DATA = {9, 18, 20}  # symmetrically encrypted, integrity protected, AEAD
+# what the first body byte of a packet gpg can read may be, mostly the packet version,
+# anything else is reported as "packet(N) with unknown version V" and isn't OpenPGP data
+FIRST_BODY_BYTES = {
+    PUBLIC_KEY_ENCRYPTED_SESSION_KEY: {3, 6},
+    2: {3, 4, 5, 6},
+    SYMMETRIC_KEY_ENCRYPTED_SESSION_KEY: {4, 5, 6},
+    4: {3, 6},
+    5: {2, 3, 4, 5, 6},
+    6: {2, 3, 4, 5, 6},
+    7: {2, 3, 4, 5, 6},
+    8: {0, 1, 2, 3},  # the compression algorithm
+    9: set(range(256)),  # no version, encrypted from the first byte
+    10: {ord("P")},  # "PGP"
+    11: set(b"btu1lm"),  # the data format
+    14: {2, 3, 4, 5, 6},
+    18: {1, 2},
+    20: {1},
+}
+PACKET_NAMES = {
+    2: "signature",
+    4: "one-pass signature",
+    5: "secret key",
+    6: "public key",
+    7: "secret subkey",
+    8: "compressed data",
+    10: "marker",
+    11: "literal data",
+    14: "public subkey",
+}
+
+
+def dearmor(data: bytes) -> bytes:
+    """The first bytes of the binary packets in an ASCII armored message"""
+    lines = data.splitlines()
+    try:
+        start = lines.index(b"") + 1  # armor headers end with a blank line
+    except ValueError:
+        return b""
+    body = []
+    for line in lines[start:-1]:  # the last line may be cut off
+        if line.startswith(b"=") or line.startswith(b"-----"):
+            break
+        body.append(line.strip())
+    try:
+        return binascii.a2b_base64(b"".join(body))
+    except binascii.Error:
+        return b""
+
+
+def first_packet(data: bytes) -> tuple:
+    """(tag, first body byte) of the first OpenPGP packet in data, None if it doesn't start with one"""
+    if data.startswith(b"-----BEGIN PGP"):
+        data = dearmor(data)
+    if len(data) < 2 or not data[0] & 0x80:
+        return None
+    if data[0] & 0x40:
+        # new format: the tag is the low six bits, the length takes one to five octets
+        tag, length = data[0] & 0x3F, data[1]
+        header = 2 if length < 192 or 224 <= length < 255 else 3 if length < 224 else 6
+    else:
+        # old format: four bits of tag, two bits for how many length octets follow
+        tag = (data[0] >> 2) & 0x0F
+        header = 1 + {0: 1, 1: 2, 2: 4, 3: 0}[data[0] & 0x03]
+    return tag, data[header] if len(data) > header else None
+
+
+def encryption_status(data: bytes) -> tuple:
+    """(status, detail) of a file that starts with data, read like gpg --list-only would"""
+    packet = first_packet(data)
+    if packet is None or packet[0] not in FIRST_BODY_BYTES or packet[1] is None:
+        return NOT_ENCRYPTED, "no valid OpenPGP data found"
+    tag, version = packet
+    if version not in FIRST_BODY_BYTES[tag]:
+        # e.g. a PNG, its 0x89 is read as an old format signature packet
+        return NOT_ENCRYPTED, f"packet({tag}) with unknown version {version}"
+    if tag == PUBLIC_KEY_ENCRYPTED_SESSION_KEY:
+        return ENCRYPTED, "public key encrypted"
+    if tag == SYMMETRIC_KEY_ENCRYPTED_SESSION_KEY:
+        return ENCRYPTED, "passphrase encrypted"
+    if tag in ENCRYPTED_DATA:
+        return ENCRYPTED, "encrypted data"
+    return UNEXPECTED, f"OpenPGP {PACKET_NAMES[tag]} first, not an encrypted message"
+
+
+def should_check(name: str) -> bool:
+    return EXTS_TO_CHECK.search(os.path.basename(name)) is not None
+
+
+def inspect_zip(zf: zipfile.ZipFile, zip_path: str, nested: bool = False) -> list:
+    """[path, status, detail] of every member of a zip to check, and of those in zips inside it"""
+    results = []
+    for member in zf.infolist():
+        if member.is_dir():
+            continue
+        path = f"{zip_path}/{member.filename}"
+        try:
+            if should_check(member.filename):
+                with zf.open(member) as f:
+                    results.append([path, *encryption_status(f.read(HEADER_BYTES))])
+            if member.filename.lower().endswith(".zip") and not nested:
+                with tempfile.SpooledTemporaryFile(NESTED_ZIP_IN_MEMORY) as tmp:
+                    with zf.open(member) as f:
+                        shutil.copyfileobj(f, tmp, 1024 * 1024)
+                    with zipfile.ZipFile(tmp) as inner:
+                        results.extend(inspect_zip(inner, path, nested=True))
+        except (OSError, zipfile.BadZipFile, RuntimeError) as err:
+            results.append([path, UNEXPECTED, f"{UNREADABLE}: {err}"])
+    return results
+
+
+def inspect_file(path: str) -> list:
+    """[path, status, detail] of a file, and of the members of a zip"""
+    results = []
+    try:
+        if should_check(path):
+            with open(path, "rb") as f:
+                results.append([path, *encryption_status(f.read(HEADER_BYTES))])
+        if path.lower().endswith(".zip"):
+            with zipfile.ZipFile(path) as zf:
+                results.extend(inspect_zip(zf, path))
+    except (OSError, zipfile.BadZipFile, RuntimeError) as err:
+        results.append([path, UNEXPECTED, f"{UNREADABLE}: {err}"])
+    return results
+
+
+class ResultCache:
+    """SQLite cache of what each file was found to be, used as long as the file keeps its inode,
+    size and mtime. Failures keep the date they were first seen."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checks (path TEXT PRIMARY KEY, inode INTEGER, "
+            "size INTEGER, mtime_ns INTEGER, results TEXT)"
+        )
+        self.rows = {
+            row[0]: (tuple(row[1:4]), json.loads(row[4]))
+            for row in self.db.execute("SELECT * FROM checks")
+        }
+
+    @staticmethod
+    def key(stat: os.stat_result) -> tuple:
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, path: str, stat: os.stat_result):
+        row = self.rows.get(path)
+        if row is not None and row[0] == self.key(stat):
+            return row[1]
+        return None
+
+    def first_failed(self, path: str, results: list) -> list:
+        """results with the date each failure was first seen, carried over from the cache"""
+        previous = {
+            result[0]: result[3]
+            for result in self.rows.get(path, (None, []))[1]
+            if result[1] != ENCRYPTED
+        }
+        return [
+            result[:3]
+            + [previous.get(result[0], TODAY) if result[1] != ENCRYPTED else None]
+            for result in results
+        ]
+
+    def save(self, checked: dict, seen: set):
+        """checked: {path: (stat, results)} inspected this run, seen: every path found"""
+        self.db.executemany(
+            "DELETE FROM checks WHERE path = ?",
+            [(path,) for path in self.rows if path not in seen],
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?)",
+            [
+                (path,) + self.key(stat) + (json.dumps(results),)
+                for path, (stat, results) in checked.items()
+            ],
+        )
+        self.db.commit()
+        self.db.close()
+
+
+def find_files(dataset: str) -> tuple:
+    """(dataset, {path: stat}) of the files to check in sourcedata/raw and sourcedata/checked"""
+    files = {}
+    sourcedata = os.path.join(DATA_PATH, dataset, "sourcedata")
+    try:
+        data_mods = sorted(
+            entry.name
+            for entry in os.scandir(sourcedata)
+            if entry.is_dir() and PATHS_TO_CHECK.match(entry.name)
+        )
+    except OSError:
+        return dataset, files
+    for data_mod in data_mods:
+        print(f"Validating {dataset}/sourcedata/{data_mod} encryption")
+        folders = [os.path.join(sourcedata, data_mod)]
+        while folders:
+            try:
+                entries = list(os.scandir(folders.pop()))
+            except OSError as err:
+                print(f"Could not list folder. Error: {err}")
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file() and (
+                    should_check(entry.name) or entry.name.lower().endswith(".zip")
+                ):
+                    files[entry.path] = entry.stat()
+    return dataset, files
+
+
+def send_mail(subject: str, body: str, recipients: list, dry_run: bool = False):
+    addresses = ",".join(f"{user}@{EMAIL_DOMAIN}" for user in recipients)
+    print(f"emailing {addresses}: {subject}")
+    if dry_run:
+        print(body)
+        return
+    subprocess.run(
+        ["mail", "-s", subject, addresses], input=body, universal_newlines=True
+    )
+
+
+def file_listing(failures: list) -> str:
+    return "\n".join(f"{path} ({detail})" for path, status, detail, _ in failures)
+
+
+def notify(failures: dict, leads: dict, dry_run: bool = False):
+    """One email per project lead with the failures in all of their datasets, one to the lab
+    manager and technician for datasets without a lead and for anything unexpected"""
+    staff = [LAB_MGR, leads.get("technician", LAB_MGR)]
+    by_lead, no_lead, unexpected = {}, {}, []
+    for dataset, dataset_failures in sorted(failures.items()):
+        if dataset in leads:
+            by_lead.setdefault(leads[dataset], {})[dataset] = dataset_failures
+        else:
+            no_lead[dataset] = dataset_failures
+        unexpected.extend(f for f in dataset_failures if f[1] == UNEXPECTED)
+
+    for lead, datasets in sorted(by_lead.items()):
+        body = [
+            "The following files are not encrypted. They must be encrypted immediately. "
+            "Please contact the lab manager once corrected to confirm.",
+            "If a file appears to be properly encrypted, contact the lab manager.",
+        ]
+        for dataset, dataset_failures in datasets.items():
+            body += ["", f"{dataset}:", file_listing(dataset_failures)]
+        names = ", ".join(f'"{dataset}"' for dataset in datasets)
+        send_mail(f"Encrypt Check Failed in {names}", "\n".join(body), [lead], dry_run)
+
+    body = []
+    for dataset, dataset_failures in no_lead.items():
+        body += [
+            "",
+            f"{dataset} (project lead not found in config-leads.json):",
+            file_listing(dataset_failures),
+        ]
+    if unexpected:
+        body += ["", "Unexpected results, follow up with the project leads:"]
+        body.append(file_listing(unexpected))
+    if body:
+        send_mail("Encrypt Check Failed", "\n".join(body[1:]), staff, dry_run)
+
+    # failures already seen on an earlier day
+    still = [
+        f for fs in failures.values() for f in fs if f[3] is not None and f[3] < TODAY
+    ]
+    if still:
+        body = "\n".join(
+            f"{path} has been unencrypted since at least {since}"
+            for path, _, _, since in still
+        )
+        send_mail("Files still unencrypted", body, [LAB_MGR], dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the media files in every dataset's sourcedata/raw and "
+        "sourcedata/checked are gpg encrypted, and email project leads about those that aren't"
+    )
+    parser.add_argument(
+        "--dataset", action="append", help="only check this dataset (repeatable)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="files read at the same time (default: 8)",
+    )
+    parser.add_argument("--cache", default=CACHE_PATH, help=f"(default: {CACHE_PATH})")
+    parser.add_argument(
+        "--no-mail",
+        action="store_true",
+        help="print the emails instead of sending them",
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    with open(os.path.join(TOOL_PATH, "config-leads.json")) as f:
+        leads = json.load(f)
+    datasets = args.dataset or sorted(os.listdir(DATA_PATH))
+    cache = ResultCache(args.cache)
+
+    print("Checking repos in datasets")
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        found = dict(executor.map(find_files, datasets))
+        files = {
+            path: (dataset, stat)
+            for dataset, paths in found.items()
+            for path, stat in paths.items()
+        }
+        to_inspect = [
+            path
+            for path, (_, stat) in files.items()
+            if cache.lookup(path, stat) is None
+        ]
+        inspected = dict(zip(to_inspect, executor.map(inspect_file, to_inspect)))
+
+    checked = {}
+    failures = {}
+    for path, (dataset, stat) in sorted(files.items()):
+        if path in inspected:
+            results = cache.first_failed(path, inspected[path])
+            if not any(result[2].startswith(UNREADABLE) for result in results):
+                checked[path] = (stat, results)
+        else:
+            results = cache.lookup(path, stat)
+        for result in results:
+            if result[1] != ENCRYPTED:
+                failures.setdefault(dataset, []).append(result)
+    cache.save(checked, set(files))
+
+    getfacl = shutil.which("getfacl")
+    for dataset, dataset_failures in sorted(failures.items()):
+        for path, status, detail, _ in dataset_failures:
+            # the log of the day before is checked for these lines
+            print(f"UNENCRYPTED: {path}")
+            print(f"  {status}: {detail}")
+            if getfacl and os.path.exists(path):
+                subprocess.run([getfacl, "-p", path])
+        print(f'The above files in the project "{dataset}" are not encrypted')
+    notify(failures, leads, args.no_mail)
+
+    seconds = time.time() - start
+    print(
+        f"Checked {len(files)} files ({len(to_inspect)} read, {len(files) - len(to_inspect)} "
+        f"unchanged since the last run) in {seconds:.1f}s ({len(files) / seconds if seconds else 0:.0f} files/sec), "
+        f"{sum(len(f) for f in failures.values())} not encrypted"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -32,7 +32,7 @@ output=\$( python \${dataset}/data-monitoring/check-datadict.py \$dataset)
 echo -e "\$output"
 
 echo "calling verify-copy.py"
-output=\$( python \${dataset}/data-monitoring/verify-copy.py \$dataset)
+output=\$( python \${dataset}/data-monitoring/verify-copy.py \$dataset --workers \${SLURM_CPUS_PER_TASK:-1})
 echo -e "\$output"
 
 
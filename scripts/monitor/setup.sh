@@ -88,6 +88,13 @@ cp "${labpath}/template/verify-copy.py" "${project}/${datam_path}"
 cp "${labpath}/template/check-id.py" "${project}/${datam_path}"
 cp "${labpath}/template/check-datadict.py" "${project}/${datam_path}"
 cp "${labpath}/template/check_existence_datatype_folders.py" "${project}/${datam_path}"
+cp "${labpath}/template/file_inventory.py" "${project}/${datam_path}"
+cp "${labpath}/template/filename_matcher.py" "${project}/${datam_path}"
+cp "${labpath}/template/monitor_state.py" "${project}/${datam_path}"
+cp "${labpath}/template/file_copier.py" "${project}/${datam_path}"
+cp "${labpath}/template/redcap_cache.py" "${project}/${datam_path}"
+cp "${labpath}/template/combination_columns.py" "${project}/${datam_path}"
+cp "${labpath}/template/tracker_io.py" "${project}/${datam_path}"
 cp "${MADE_path}/subjects_yet_to_process.py" "${project}/${datam_path}"
 cp "${MADE_path}/update-tracker-postMADE.py" "${project}/${datam_path}"
 cp "${MADE_path}/MADE_pipeline.m" "${project}/${code_path}"
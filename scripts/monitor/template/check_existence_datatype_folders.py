@@ -4,6 +4,7 @@ from os.path import basename, normpath, join, isdir, isfile, splitext
 from os import listdir, walk
 import pathlib
 import re
+from tracker_io import TrackerTransaction
 
 if __name__ == "__main__":
     dataset = sys.argv[1]
@@ -19,7 +20,8 @@ if __name__ == "__main__":
     checked = "{}/sourcedata/checked".format(dataset)
 
     df_dd = pd.read_csv(datadict, index_col = "variable")
-    tracker_df = pd.read_csv(tracker, index_col = "id")
+    tracker_tx = TrackerTransaction(tracker)
+    tracker_df = tracker_tx.tracker
 
     visit_dict = {}
     for var, row in df_dd.iterrows():
@@ -109,7 +111,7 @@ if __name__ == "__main__":
             else:
                 tracker_df.loc[sub, visit+'_data_'+session+'_e1'] = 0
                 print("\033[31mError: Expected tasks " + ", ".join(missing_tasks) + " not seen in subject " + str(sub) + ", session " + session + ".\033[0m")
-    tracker_df.to_csv(tracker)
+    tracker_tx.commit(tracker_df)
 
 
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+class c:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+def get_combinations(dd_df):
+    """{"<combination var>_<suffix>": ["<component var>_<suffix>", ...]} from the datadict"""
+    combos_dict = dict()
+    for _, row in dd_df.iterrows():
+        if row["dataType"] == "combination":
+            idx = row["provenance"].split(" ").index("variables:")
+            vars = "".join(row["provenance"].split(" ")[idx+1:]).split(",")
+            vars = [var.strip("\"") for var in vars]
+            for ses in row["allowedSuffix"].split(", "):
+                combos_dict[row["variable"]+"_"+ses] = [var+"_"+ses for var in vars]
+    for key, cols in list(combos_dict.items()):
+        if len(cols) == 0:
+            print(c.RED + "Error: columns to combine not found for combination variable: " + key + ", can\'t update column." + c.ENDC)
+            del combos_dict[key]
+    return combos_dict
+
+def fill_combination_columns(tracker_df, dd_df):
+    """set each combination column to "1" where any of its component columns is "1", "0" elsewhere
+
+    Cells are compared as strings like before, so only "1" and 1 count (not 1.0).
+    Columns that would be all "0" are left blank.
+    """
+    for combined_col, cols in get_combinations(dd_df).items():
+        missing = [col for col in cols if col not in tracker_df.columns]
+        if len(missing) > 0:
+            sys.exit(c.RED + "Error: KeyError: " + ", ".join(missing) + ", please fix central tracker." + c.ENDC)
+        present = (tracker_df[cols].astype(str) == "1").any(axis=1).to_numpy()
+        if present.any():
+            tracker_df[combined_col] = np.where(present, "1", "0")
+        else:
+            tracker_df[combined_col] = "" # all zeros columns leave blank
+
+def old_fill_combination_columns(tracker_df, dd_df):
+    # row by row version update-tracker.py used before
+    for combined_col, cols in get_combinations(dd_df).items():
+        for id, row in tracker_df.iterrows():
+            present = False
+            for col in cols:
+                if str(tracker_df.loc[id, col]) == "1":
+                    present = True
+            if present:
+                tracker_df.loc[id, combined_col] = "1"
+            else:
+                tracker_df.loc[id, combined_col] = "0"
+        if not any(tracker_df.loc[:, combined_col] == "1"):
+            tracker_df.loc[:, combined_col] = "" # all zeros columns leave blank
+
+def benchmark(n_subjects=5000, n_combinations=50):
+    rng = np.random.default_rng(0)
+    rows = []
+    tracker = {"id": np.arange(3000000, 3000000 + n_subjects)}
+    for i in range(n_combinations):
+        components = ["task%d-v%d" % (i, v) for v in range(1, 3)]
+        rows.append({"variable": "task%d" % i, "dataType": "combination", "allowedSuffix": "s1_r1_e1",
+                     "provenance": "variables: " + ",".join("\"" + var + "\"" for var in components)})
+        for var in components:
+            # every 10th combination has no "1" at all, to exercise the blank column rule
+            choices = ["0", ""] if i % 10 == 0 else ["1", "0", ""]
+            tracker[var + "_s1_r1_e1"] = rng.choice(choices, n_subjects)
+    dd_df = pd.DataFrame(rows)
+    tracker_df = pd.DataFrame(tracker).set_index("id")
+
+    old_df = tracker_df.copy()
+    start = time.time()
+    old_fill_combination_columns(old_df, dd_df)
+    old_time = time.time() - start
+
+    new_df = tracker_df.copy()
+    start = time.time()
+    fill_combination_columns(new_df, dd_df)
+    new_time = time.time() - start
+
+    print("{} subjects, {} combination columns".format(n_subjects, n_combinations))
+    print("row by row:  {:.2f}s".format(old_time))
+    print("column-wise: {:.3f}s".format(new_time))
+    print("speedup: {:.0f}x, identical output: {}".format(old_time / new_time if new_time else float("inf"),
+          old_df.to_csv() == new_df.to_csv()))
+
+if __name__ == "__main__":
+    # benchmark against the row by row version on a synthetic tracker
+    # USAGE: python3 combination_columns.py [number of subjects] [number of combination columns]
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import shutil
+import hashlib
+from os.path import dirname, basename, join
+from concurrent.futures import ThreadPoolExecutor
+
+# bytes handed to the kernel per copy_file_range/sendfile call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def copy_data(src, dest):
+    """copy file contents inside the kernel where possible, returns the method used"""
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            offset = 0
+            try:
+                while offset < size:
+                    if method == "copy_file_range":
+                        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE)
+                    else:
+                        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, CHUNK_SIZE)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return method
+            except OSError:
+                # not supported between these filesystems, start over with the next method
+                if offset:
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                continue
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return "read/write"
+
+class FileCopier:
+    """In-process replacement for system('mkdir -p ...') and system('cp -p ...').
+
+    Files are copied by a bounded thread pool, written under a temporary name next
+    to the destination and renamed into place once the copy is verified, so a
+    partial file never shows up under its final name. Like cp -p the mode,
+    timestamps and, where permitted, the owner of the source are kept.
+    """
+    def __init__(self, workers=4, checksum=False):
+        self.workers = max(1, workers)
+        self.checksum = checksum
+        self.executor = None
+        self.pending = []
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.methods = dict()
+        self.start = None
+        self.copy_time = 0
+
+    def copy(self, src, dest, tag=None):
+        """queue a copy, results are collected by wait(), tag is handed back with them"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.start = time.time()
+        self.pending.append((src, tag, self.executor.submit(self._copy, src, dest)))
+
+    def _copy(self, src, dest):
+        os.makedirs(dirname(dest), exist_ok=True)
+        tmp_dest = join(dirname(dest), "." + basename(dest) + "." + str(os.getpid()) + ".tmp")
+        try:
+            method = copy_data(src, tmp_dest)
+            st = os.stat(src)
+            shutil.copystat(src, tmp_dest)
+            try:
+                os.chown(tmp_dest, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+            size = os.stat(tmp_dest).st_size
+            if size != st.st_size:
+                raise OSError("size mismatch, " + str(size) + " of " + str(st.st_size) + " bytes copied")
+            if self.checksum and file_md5(src) != file_md5(tmp_dest):
+                raise OSError("checksum mismatch")
+            os.replace(tmp_dest, dest)
+        except BaseException:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+            raise
+        return method, size
+
+    def wait(self):
+        """wait for queued copies, returns (src, tag, error) in the order they were queued"""
+        results = []
+        for src, tag, future in self.pending:
+            try:
+                method, size = future.result()
+                self.files += 1
+                self.bytes += size
+                self.methods[method] = self.methods.get(method, 0) + 1
+                results.append((src, tag, None))
+            except OSError as e:
+                self.errors += 1
+                results.append((src, tag, e))
+        self.pending = []
+        if self.executor is not None:
+            # no idle threads left behind when the caller forks its next worker pool
+            self.executor.shutdown()
+            self.executor = None
+            self.copy_time += time.time() - self.start
+        return results
+
+    def report(self):
+        mb = self.bytes / (1024 * 1024)
+        rate = mb / self.copy_time if self.copy_time else 0
+        methods = ", ".join(method + ": " + str(count) for method, count in sorted(self.methods.items()))
+        return "Copied {} files ({:.1f} MB) in {:.2f}s, {:.1f} MB/s with {} threads{}".format(
+            self.files, mb, self.copy_time, rate, self.workers, " (" + methods + ")" if methods else "")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import time
+from os.path import join
+from collections import namedtuple
+
+# a file seen during the inventory walk
+FileEntry = namedtuple("FileEntry", ["name", "size", "mtime", "is_dir"])
+
+# raw is laid out as [session/]datatype/sub-#/files and checked as sub-#/[session/]datatype/files,
+# so listing directories three levels down covers every folder verify-copy.py looks inside
+WALK_DEPTH = 3
+
+class Inventory:
+    """In-memory copy of the sourcedata/raw and sourcedata/checked directory trees.
+
+    Both trees are walked once with os.scandir when the inventory is built. Every
+    listdir/isdir/getsize the checks need afterwards is answered from memory, so the
+    number of metadata calls against the filesystem no longer grows with the number
+    of variables, suffixes and extensions in the datadict.
+    """
+    def __init__(self, dataset, trees=("raw", "checked"), roots=None, stat=True):
+        # roots overrides the default sourcedata/<tree> location, stat=False records names only (size and mtime 0)
+        self.roots = roots or {tree: join(dataset, "sourcedata", tree) for tree in trees}
+        self.stat = stat
+        self.dirs = dict() # (tree, *parts) -> list of FileEntry, in readdir order
+        self.scandir_calls = 0
+        self.stat_calls = 0
+        self.lookups = 0
+        self.walk_time = 0
+        start = time.time()
+        for tree, root in self.roots.items():
+            self._walk(tree, (), root, 0)
+        self.walk_time = time.time() - start
+
+    def _walk(self, tree, parts, path, depth):
+        entries = []
+        try:
+            self.scandir_calls += 1
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        entries.append(FileEntry(entry.name, 0, 0, True))
+                    elif not self.stat:
+                        entries.append(FileEntry(entry.name, 0, 0, False))
+                    else:
+                        self.stat_calls += 1
+                        st = entry.stat()
+                        entries.append(FileEntry(entry.name, st.st_size, st.st_mtime, False))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        self.dirs[(tree,) + parts] = entries
+        if depth < WALK_DEPTH:
+            for entry in entries:
+                if entry.is_dir:
+                    self._walk(tree, parts + (entry.name,), join(path, entry.name), depth + 1)
+
+    def _key(self, tree, parts):
+        # empty parts come from datasets without session folders, same as os.path.join(raw, "", datatype)
+        return (tree,) + tuple(part for part in parts if part)
+
+    def path(self, tree, *parts):
+        return join(self.roots[tree], *[part for part in parts if part])
+
+    def isdir(self, tree, *parts):
+        self.lookups += 1
+        return self._key(tree, parts) in self.dirs
+
+    def entries(self, tree, *parts):
+        """FileEntry list of a folder, raises FileNotFoundError like listdir if it wasn't seen"""
+        self.lookups += 1
+        key = self._key(tree, parts)
+        if key not in self.dirs:
+            raise FileNotFoundError(self.path(tree, *parts))
+        return self.dirs[key]
+
+    def listdir(self, tree, *parts):
+        return [entry.name for entry in self.entries(tree, *parts)]
+
+    def isfile(self, tree, *parts):
+        self.lookups += 1
+        key = self._key(tree, parts)
+        folder = self.dirs.get(key[:-1], [])
+        return any(entry.name == key[-1] and not entry.is_dir for entry in folder)
+
+    def folder(self, tree, session, datatype, subject):
+        """files in a subject's datatype folder, keyed by (tree, session, datatype, subject)"""
+        if tree == "raw":
+            return self.entries(tree, session, datatype, subject)
+        return self.entries(tree, subject, session, datatype)
+
+    def add_dir(self, tree, parts):
+        """record a folder created during the run (e.g. makedirs in checked)"""
+        parts = tuple(part for part in parts if part)
+        self.dirs.setdefault((tree,), [])
+        for i in range(len(parts)):
+            parent = (tree,) + parts[:i]
+            siblings = self.dirs[parent]
+            if not any(entry.name == parts[i] for entry in siblings):
+                siblings.append(FileEntry(parts[i], 0, 0, True))
+            self.dirs.setdefault(parent + (parts[i],), [])
+        return (tree,) + parts
+
+    def add_file(self, tree, parts, name, size, mtime):
+        """record a file written during the run (e.g. copied to checked) so later checks see it"""
+        folder = self.dirs[self.add_dir(tree, parts)]
+        folder[:] = [entry for entry in folder if entry.name != name]
+        folder.append(FileEntry(name, size, mtime, False))
+
+    def remove_file(self, tree, parts, name):
+        """forget a file, e.g. one whose copy to checked failed"""
+        folder = self.dirs.get(self._key(tree, parts), [])
+        folder[:] = [entry for entry in folder if entry.name != name]
+
+    def report(self):
+        return "Inventory: {} folders indexed with {} scandir and {} stat calls in {:.2f}s, {} lookups served from memory".format(
+            len(self.dirs), self.scandir_calls, self.stat_calls, self.walk_time, self.lookups)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+from collections import namedtuple
+
+# one parsed data filename, e.g. sub-3000001_flanker_eeg_s1_r1_e1_practice.eeg
+#   subject="sub-3000001", sub="3000001", task="flanker_eeg", sre="s1_r1_e1", session="s1_r1",
+#   ses="1", run="1", event="1", extra="_practice", ext=".eeg"
+# known is True when task, suffix and extension all come from the datadict
+FileRecord = namedtuple("FileRecord", ["name", "subject", "sub", "task", "sre", "session", "ses", "run", "event", "extra", "ext", "known"])
+
+# same naming convention check_filenames() has always used, extensions may contain digits (.mp3, .mp4)
+# extra text without a leading "_" parses too, deviation folders allow it, see conventional()
+GENERIC_RE = r"^(?P<subject>sub-(?P<sub>[0-9]*))_(?P<task>[a-zA-Z0-9_-]*)_(?P<sre>(?P<session>s(?P<ses>[0-9]*)_r(?P<run>[0-9]*))_e(?P<event>[0-9]*))(?P<extra>[a-zA-Z0-9_-]+)?(?P<ext>(?:\.[a-zA-Z0-9]+)*)$"
+
+def split_exts(ext_field):
+    """'.eeg, .zip.gpg|.tar.gpg' -> ['.eeg', '.zip.gpg', '.tar.gpg']"""
+    return sum([ext.split('|') for ext in ext_field.split(", ")], [])
+
+def alternation(values):
+    # longest first so e.g. "flanker_eeg" wins over "flanker"
+    return "|".join(re.escape(value) for value in sorted(set(values), key=len, reverse=True))
+
+class FilenameMatcher:
+    """Filename parser built once from the datadict and shared by verify-copy.py and update-tracker.py.
+
+    All task names, allowed suffixes and expected extensions are compiled into a single
+    pattern, and every filename is parsed at most once into a FileRecord. Checks then
+    compare record fields instead of building and matching a new regex per
+    subject/task/suffix/extension combination.
+    """
+    def __init__(self, df_dd):
+        if "variable" in df_dd.columns:
+            df_dd = df_dd.set_index("variable")
+        tasks, suffixes, exts = [], [], []
+        for var, row in df_dd.iterrows():
+            if not isinstance(row["expectedFileExt"], str):
+                continue
+            tasks.append(var)
+            exts.extend(split_exts(row["expectedFileExt"]))
+            if isinstance(row["allowedSuffix"], str):
+                suffixes.extend(row["allowedSuffix"].split(", "))
+        self.tasks = set(tasks)
+        self.generic = re.compile(GENERIC_RE)
+        if tasks and suffixes and exts:
+            combined = GENERIC_RE.replace("(?P<task>[a-zA-Z0-9_-]*)", "(?P<task>" + alternation(tasks) + ")") \
+                .replace("(?P<ext>(?:\\.[a-zA-Z0-9]+)*)", "(?P<ext>" + alternation(exts) + ")")
+            self.combined = re.compile(combined)
+            self.suffixes = set(suffixes)
+        else:
+            self.combined = None
+            self.suffixes = set()
+        self.cache = dict()
+
+    def parse(self, name):
+        """FileRecord for a filename, or None if it doesn't follow the naming convention"""
+        if name in self.cache:
+            return self.cache[name]
+        known = False
+        file_re = self.combined.match(name) if self.combined else None
+        if file_re and file_re.group("sre") in self.suffixes:
+            known = True
+        else:
+            file_re = self.generic.match(name)
+        if file_re:
+            fields = file_re.groupdict()
+            record = FileRecord(name=name, known=known, **{key: (fields[key] or "") for key in fields})
+        else:
+            record = None
+        self.cache[name] = record
+        return record
+
+    def records(self, names):
+        return [record for record in map(self.parse, names) if record]
+
+    def conventional(self, record):
+        """False if text follows the suffix without a "_" (e.g. s1_r1_e1firstrun), which breaks the naming convention"""
+        return not record.extra or record.extra.startswith("_")
+
+    def has_file(self, records, subject, task, sre, ext, allow_extra=True, any_extra=False):
+        """True if a file <subject>_<task>_<sre>[_extra]<ext> is among the records,
+        with any_extra (deviation folders) any text may come between <sre> and <ext>"""
+        for record in records:
+            if record.subject != subject or record.task != task or record.ext != ext:
+                continue
+            if any_extra and (record.sre + record.extra).startswith(sre):
+                return True  # like the old <sre>[a-zA-Z0-9_-]*<ext>, which also took s1_r1_e12 for s1_r1_e1
+            if record.sre == sre and (not record.extra or (allow_extra and self.conventional(record))):
+                return True
+        return False
+
+
+def old_has_file(names, subject, task, sre, ext):
+    # per-call regex the checks used before the matcher existed
+    for name in names:
+        if re.match('^'+subject+'_'+task+'_'+sre+'(_[a-zA-Z0-9_-]+)?'+ext+'$', name):
+            return True
+    return False
+
+def benchmark(n_subjects=10000):
+    import pandas as pd
+    tasks = {"flanker_eeg": ".eeg, .vmrk, .vhdr", "arrow-alert-v1-1_psychopy": ".csv, .log, .psydat",
+             "arrow-alert-v1-2_psychopy": ".csv, .log, .psydat", "audio_zoom": ".zip.gpg|.tar.gpg",
+             "video_zoom": ".mp4.gpg"}
+    suffixes = ["s1_r1_e1", "s2_r1_e1", "s3_r1_e1"]
+    df_dd = pd.DataFrame({"variable": list(tasks.keys()), "expectedFileExt": list(tasks.values()),
+                          "allowedSuffix": [", ".join(suffixes)] * len(tasks)})
+    # synthetic tree: every subject folder holds one file per task/suffix/extension
+    folders = []
+    for i in range(n_subjects):
+        subject = "sub-3%06d" % i
+        folders.append((subject, [subject + "_" + task + "_" + sfx + ext.split("|")[0]
+                                  for task, exts in tasks.items() for sfx in suffixes for ext in exts.split(", ")]))
+    lookups = [(task, sfx, ext) for task, exts in tasks.items() for sfx in suffixes for ext in split_exts(exts)]
+
+    start = time.time()
+    old_found = 0
+    for subject, names in folders:
+        for task, sfx, ext in lookups:
+            old_found += old_has_file(names, subject, task, sfx, ext)
+    old_time = time.time() - start
+
+    start = time.time()
+    matcher = FilenameMatcher(df_dd)
+    new_found = 0
+    for subject, names in folders:
+        records = matcher.records(names)
+        for task, sfx, ext in lookups:
+            new_found += matcher.has_file(records, subject, task, sfx, ext)
+    new_time = time.time() - start
+
+    n_files = sum(len(names) for _, names in folders)
+    print("{} subjects, {} files, {} lookups per subject".format(n_subjects, n_files, len(lookups)))
+    print("per-call regex:   {:.2f}s ({} files found)".format(old_time, old_found))
+    print("FilenameMatcher:  {:.2f}s ({} files found)".format(new_time, new_found))
+    print("speedup: {:.1f}x".format(old_time / new_time if new_time else float("inf")))
+
+if __name__ == "__main__":
+    # micro-benchmark against the old per-call regex approach
+    # USAGE: python3 filename_matcher.py [number of subjects]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -2,6 +2,7 @@ import pandas as pd
 import sys
 import math
 from os.path import basename, normpath
+from tracker_io import TrackerTransaction
 
 check_columns = []
 
@@ -12,10 +13,9 @@ if __name__ == "__main__":
     proj_name = basename(normpath(dataset))
 
     data_tracker_file = "{}/data-monitoring/central-tracker_{}.csv".format(dataset, proj_name)
-    tracker_df = pd.read_csv(data_tracker_file, index_col="id")
-    
     file_df = pd.read_csv(file, index_col="record_id")
-    tracker_df = pd.read_csv(data_tracker_file, index_col="id")
+    tracker_tx = TrackerTransaction(data_tracker_file)
+    tracker_df = tracker_tx.tracker
 
     for index, row in file_df.iterrows():
         id = row.name
@@ -32,5 +32,5 @@ if __name__ == "__main__":
             except Exception as e_msg:
                 tracker_df.loc[id, key] = 0
 
-    tracker_df.to_csv(data_tracker_file)
+    tracker_tx.commit(tracker_df)
     print("Success: data tracker updated.")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+from os.path import isfile, dirname, basename
+
+def datadict_hash(*tables):
+    """short hash of the datadict-derived tables a check depends on"""
+    return hashlib.md5(json.dumps(tables, sort_keys=True, default=str).encode()).hexdigest()[0:12]
+
+class ChangeJournal:
+    """Results of the last hallMonitor run, kept in a JSON file under data-monitoring/.
+
+    For every validated folder the journal stores the size and mtime of each file it
+    held and the result of each check run on it, e.g.
+
+        {"<dataset>/sourcedata/raw/s1_r1/eeg/sub-3000001": {
+            "files": {"sub-3000001_flanker_eeg_s1_r1_e1.eeg": [1048576, 1700000000.0], ...},
+            "checks": {"check_filenames ... <datadict hash>": "<printed output>"}}}
+
+    A check is only re-run when the folder's files or the datadict rows it depends on
+    changed since the last run, otherwise its saved result is replayed.
+    """
+    def __init__(self, path, full=False):
+        self.path = path
+        self.old = dict()
+        if isfile(path) and not full:
+            try:
+                with open(path) as f:
+                    self.old = json.load(f)
+            except ValueError:
+                print("Can't read state file " + path + ", running a full scan")
+        self.new = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, folder, files, check):
+        """saved result of a check on a folder, or None if it has to be re-run"""
+        entry = self.old.get(folder)
+        if entry and entry["files"] == files and check in entry["checks"]:
+            self.hits += 1
+            return entry["checks"][check]
+        self.misses += 1
+        return None
+
+    def record(self, folder, files, check, result):
+        entry = self.new.setdefault(folder, {"files": files, "checks": dict()})
+        entry["files"] = files
+        entry["checks"][check] = result
+
+    def save(self, prune=True):
+        """write the journal atomically, prune drops folders not seen during this run"""
+        if prune:
+            state = self.new
+        else:
+            state = self.old
+            for folder, entry in self.new.items():
+                if folder in state and state[folder]["files"] == entry["files"]:
+                    state[folder]["checks"].update(entry["checks"])
+                else:
+                    state[folder] = entry
+        tmp_path = os.path.join(dirname(self.path), "." + basename(self.path) + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def report(self):
+        return "Reused {} of {} folder checks from {}".format(self.hits, self.hits + self.misses, self.path)
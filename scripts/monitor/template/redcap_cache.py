@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import csv
+import time
+from os.path import realpath, basename
+from collections import Counter
+
+import pandas as pd
+
+# completion columns are 0 (incomplete), 1 (unverified), 2 (complete) or blank
+COMPLETE_DTYPE = "float64"
+
+class RedcapCache:
+    """Each REDCap export parsed once and shared by everything that reads it.
+
+    Only the header line is read to decide which columns to keep: the ones named in
+    `columns`, or starting with one of `prefixes` (ID columns, parent language
+    columns). Completion columns are parsed as floats instead of being inferred.
+    Frames are cached per file and per index column.
+    """
+    def __init__(self, columns=(), prefixes=()):
+        self.columns = set(columns)
+        self.prefixes = tuple(prefixes)
+        self.headers = dict()
+        self.frames = dict()
+
+    def header(self, path):
+        """column names in the first line of the export, duplicates included"""
+        path = realpath(path)
+        if path not in self.headers:
+            with open(path, newline="") as f:
+                self.headers[path] = next(csv.reader(f), [])
+        return self.headers[path]
+
+    def duplicate_columns(self, path):
+        return [col for col, count in Counter(self.header(path)).items() if count > 1]
+
+    def usecols(self, path):
+        return [col for col in self.header(path) if col in self.columns or col.startswith(self.prefixes)]
+
+    def frame(self, path, index_col=None):
+        path = realpath(path)
+        if (path, None) not in self.frames:
+            usecols = self.usecols(path)
+            dtype = {col: COMPLETE_DTYPE for col in usecols if col.endswith("_complete")}
+            start = time.time()
+            df = pd.read_csv(path, usecols=usecols, dtype=dtype)
+            print("Read {}: {} rows, {} of {} columns in {:.2f}s, {:.1f} MB".format(basename(path), len(df),
+                  len(df.columns), len(self.header(path)), time.time() - start, df.memory_usage(deep=True).sum() / 1e6))
+            self.frames[(path, None)] = df
+        if (path, index_col) not in self.frames:
+            self.frames[(path, index_col)] = self.frames[(path, None)].set_index(index_col)
+        return self.frames[(path, index_col)]
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+from os.path import splitext, isfile, dirname, basename, join
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    # without pyarrow the CSV stays the only copy of the tracker
+    feather = None
+
+INDEX_COL = "id"
+
+def binary_path(csv_path):
+    return splitext(csv_path)[0] + ".feather"
+
+def viewable_path(csv_path):
+    return splitext(csv_path)[0] + "_viewable.csv"
+
+def lock_path(csv_path):
+    return join(dirname(csv_path), "." + basename(csv_path) + ".lock")
+
+@contextmanager
+def tracker_lock(csv_path):
+    """exclusive lock for read-merge-write of the tracker, held on a separate file since the CSV is replaced"""
+    with open(lock_path(csv_path), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def atomic_write(path, write):
+    """write(tmp_path) to a temporary file next to path, then move it into place in one step"""
+    tmp_path = join(dirname(path), "." + basename(path) + "." + str(os.getpid()) + ".tmp")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if isfile(tmp_path):
+            os.remove(tmp_path)
+
+def csv_stamp(csv_path):
+    # the binary copy is only used while the CSV is the one it was written with
+    st = os.stat(csv_path)
+    return [st.st_size, st.st_mtime_ns]
+
+def as_read(df):
+    """df with the dtypes pd.read_csv(..., index_col="id") would give it back
+
+    Columns the scripts filled with a mix of "1", 1.0 and "" are re-parsed from their
+    CSV text, numeric columns already read back unchanged.
+    """
+    obj_cols = [col for col in df.columns if df[col].dtype == object]
+    if len(obj_cols) == 0 and df.index.dtype != object:
+        return df
+    parsed = pd.read_csv(io.StringIO(df[obj_cols].to_csv()), index_col=0)
+    df = df.copy()
+    df.index = parsed.index
+    for col in obj_cols:
+        df[col] = parsed[col]
+    return df
+
+def viewable(df):
+    # more readable csv with no blank columns
+    return df.loc[:, df.notnull().any(axis=0)].fillna("NA")
+
+def compact(df):
+    """arrow table of the tracker with 0/1 columns as int8 and text columns dictionary encoded"""
+    df = df.reset_index()
+    dtypes = dict()
+    columns = dict()
+    for col in df.columns:
+        values = df[col]
+        dtypes[col] = str(values.dtype)
+        if values.dtype == object:
+            values = values.astype("category")
+        elif values.dtype.kind in "if":
+            notna = values.dropna()
+            if ((notna == notna.round()) & (notna.abs() <= 127)).all():
+                values = values.astype("Int8")
+        columns[col] = values
+    table = pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+    return table, dtypes
+
+def write_binary(df, csv_path):
+    # uncompressed so loads can memory map it
+    table, dtypes = compact(df)
+    meta = {"index": df.index.name, "dtypes": dtypes, "csv": csv_stamp(csv_path)}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"tracker": json.dumps(meta).encode()})
+    atomic_write(binary_path(csv_path), lambda path: feather.write_feather(table, path, compression="uncompressed"))
+
+def read_binary(csv_path):
+    """tracker from the binary copy, or None if there is none or the CSV changed since it was written"""
+    if feather is None or not isfile(binary_path(csv_path)) or not isfile(csv_path):
+        return None
+    table = feather.read_table(binary_path(csv_path), memory_map=True)
+    meta = json.loads(table.schema.metadata[b"tracker"])
+    if meta["csv"] != csv_stamp(csv_path):
+        return None
+    df = table.to_pandas()
+    for col, dtype in meta["dtypes"].items():
+        df[col] = df[col].astype(dtype)
+    return df.set_index(meta["index"])
+
+def read_tracker(csv_path):
+    """central tracker indexed by id, same frame as pd.read_csv(csv_path, index_col="id")"""
+    df = read_binary(csv_path)
+    if df is None:
+        df = pd.read_csv(csv_path, index_col=INDEX_COL)
+    return df
+
+def write_tracker(df, csv_path, write_viewable=False):
+    """write the tracker CSV (and _viewable.csv) as export views and the typed binary copy
+
+    Every file is written atomically. Returns the tracker as it reads back.
+    """
+    start = time.time()
+    atomic_write(csv_path, df.to_csv)
+    df = as_read(df)
+    if write_viewable:
+        atomic_write(viewable_path(csv_path), viewable(df).to_csv)
+    if feather is not None:
+        write_binary(df, csv_path)
+    print("Wrote tracker {}: {} rows x {} columns in {:.2f}s".format(basename(csv_path), len(df), len(df.columns), time.time() - start))
+    return df
+
+def value_kind(value):
+    # "1", 1 and 1.0 are written differently to the CSV, so a change between them counts
+    if isinstance(value, str):
+        return str
+    if isinstance(value, (bool, np.bool_)):
+        return bool
+    if isinstance(value, (int, np.integer)):
+        return int
+    return float
+
+def same_value(a, b):
+    if pd.isna(a) and pd.isna(b):
+        return True
+    return value_kind(a) is value_kind(b) and a == b
+
+def tracker_patches(base, new):
+    """{column: ids whose value in new differs from base}, rows and columns new in `new` included"""
+    base = base.reindex(index=new.index)
+    patches = dict()
+    for col in new.columns:
+        if col not in base.columns:
+            changed = new[col].notna().to_numpy()
+        elif base[col].dtype == new[col].dtype and base[col].dtype != object:
+            changed = ((base[col] != new[col]) & ~(base[col].isna() & new[col].isna())).to_numpy()
+        else:
+            changed = np.array([not same_value(a, b) for a, b in zip(base[col], new[col])], dtype=bool)
+        if changed.any():
+            patches[col] = new.index[changed]
+    return patches
+
+class TrackerTransaction:
+    """A job's changes to the central tracker, merged into the version on disk when committed.
+
+    The job works on `tracker` (or any frame derived from it) and passes the result to
+    commit(). Only the cells, rows and columns it changed are written: commit() takes
+    the tracker lock, re-reads the tracker, applies the changes and writes it back, so
+    columns updated meanwhile by another job (e.g. preprocessing while hallMonitor
+    runs) are kept.
+
+        tx = TrackerTransaction(tracker_path)
+        tracker_df = tx.tracker
+        tracker_df.loc[sub, col] = 1
+        tx.commit(tracker_df)
+    """
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.base = read_tracker(csv_path)
+        self.tracker = self.base.copy()
+
+    def commit(self, df=None, write_viewable=False):
+        """merge the changes in df (default: self.tracker) into the tracker on disk, returns the merged tracker"""
+        new = self.tracker if df is None else df
+        if new.index.name != self.base.index.name:
+            new = new.set_index(self.base.index.name)
+        patches = tracker_patches(self.base, new)
+        dropped = [col for col in self.base.columns if col not in new.columns]
+        with tracker_lock(self.csv_path):
+            current = read_tracker(self.csv_path)
+            concurrent = tracker_patches(self.base, current)
+            conflicts = sum(len(ids.intersection(concurrent[col])) for col, ids in patches.items() if col in concurrent)
+            current = current.drop(columns=[col for col in dropped if col in current.columns])
+            new_ids = set(new.index)
+            current = current.reindex(list(new.index) + [id for id in current.index if id not in new_ids])
+            for col in new.columns:
+                if col not in current.columns:
+                    current[col] = new[col].reindex(current.index)
+                elif col in patches:
+                    current.loc[patches[col], col] = new.loc[patches[col], col].to_numpy()
+            merged = write_tracker(current, self.csv_path, write_viewable)
+        print("Committed {} changed cells in {} columns to {}{}".format(sum(len(ids) for ids in patches.values()),
+              len(patches), basename(self.csv_path), ", {} of them also changed by another job".format(conflicts) if conflicts else ""))
+        self.base = merged
+        self.tracker = merged.copy()
+        return merged
+
+if __name__ == "__main__":
+    # rebuild the binary copy of a tracker from its CSV, e.g. after editing the CSV by hand
+    # USAGE: python3 tracker_io.py <path to central-tracker_<proj>.csv>
+    if feather is None:
+        sys.exit("pyarrow is not installed, the tracker is only kept as CSV")
+    csv_path = sys.argv[1]
+    write_binary(pd.read_csv(csv_path, index_col=INDEX_COL), csv_path)
@@ -1,12 +1,21 @@
 import pandas as pd
+import numpy as np
 import sys
+import argparse
 from os.path import basename, normpath, join, isdir, isfile, splitext
 from os import listdir, walk
 import pathlib
 import re
 import math
 import datetime
+import time
 from collections import defaultdict
+from filename_matcher import FilenameMatcher
+from monitor_state import ChangeJournal, datadict_hash
+from redcap_cache import RedcapCache
+from file_inventory import Inventory
+from combination_columns import fill_combination_columns
+from tracker_io import TrackerTransaction
 
 # list hallMonitor key
 
@@ -118,7 +127,7 @@ def get_IDs(datadict_df):
             
     if "consent_redcap" not in locals():
         sys.exit("Can\'t find" + id_rc + "redcap to read IDs from")
-    consent_redcap = pd.read_csv(consent_redcap, index_col=var)
+    consent_redcap = redcap_cache.frame(consent_redcap, index_col=var)
     ids = consent_redcap.index.tolist()
     return ids
 
@@ -129,34 +138,137 @@ def get_study_no(datadict_df):
     intervals = list(filter(lambda x: x not in [",", ""], intervals))
     return intervals[0][0:2] # first two digits should be study no.
 
-def fill_combination_columns(tracker_df, dd_df):
-    combos_dict = dict()
-    for _, row in dd_df.iterrows():
-        if row["dataType"] == "combination":
-            idx = row["provenance"].split(" ").index("variables:")
-            vars = "".join(row["provenance"].split(" ")[idx+1:]).split(",")
-            vars = [var.strip("\"") for var in vars]
-            for ses in row["allowedSuffix"].split(", "):
-                combos_dict[row["variable"]+"_"+ses] = [var+"_"+ses for var in vars]
-    for key, cols in combos_dict.items():
-        if len(cols) == 0:
-            print(c.RED + "Error: columns to combine not found for combination variable: " + key + ", can\'t update column." + c.ENDC)
-            del combos_dict[key]
-    for combined_col, cols in combos_dict.items():
-        for id, row in tracker_df.iterrows():
-            present = False
-            for col in cols:
-                try:
-                    if str(tracker_df.loc[id, col]) == "1":
-                        present = True
-                except KeyError as e_msg:
-                    sys.exit(c.RED + "Error: KeyError:" + e_msg + ", please fix central tracker." + c.ENDC)
-            if present:
-                tracker_df.loc[id, combined_col] = "1"
+def redcap_rows(rc_df, redcap_path):
+    # tracker row of each redcap row, as (position in redcap, child id), skipped rows are reported like before
+    rows = []
+    for pos, index in enumerate(rc_df.index):
+        if (isinstance(index, float) or isinstance(index, int)) and not math.isnan(index):
+            id = int(index)
+        else:
+            print("skipping nan value in ", str(redcap_path), ": ", str(index))
+            continue
+        if child == 'true':
+            if re.search(study_no + '[089](\d{4})', str(id)):
+                child_id = study_no + '0' + re.search(study_no + '[089](\d{4})', str(id)).group(1)
+                child_id = int(child_id)
+            else:
+                print(str(id), "doesn't match expected child or parent id format of \"" + study_no +"{0,8, or 9}XXXX\", skipping")
+                continue
+        else:
+            child_id = id
+        if child_id not in tracker_df.index:
+            print(child_id, "missing in tracker file, skipping")
+            continue
+        rows.append((pos, child_id))
+    return rows
+
+def update_from_redcap(rc_df, all_keys, redcap_path, keys_in_redcap):
+    """set tracker columns to "1" where the redcap column is 2 and "0" otherwise, one column at a time
+
+    A child may have several redcap rows (child and parent IDs) and several redcap
+    columns may map to the same tracker column (English and Spanish surveys); the
+    cell ends up "1" if any of them is 2. A "1" set earlier in this run is never
+    overwritten. Returns the keys found in the redcap, or keys_in_redcap unchanged
+    if no row of the redcap is in the tracker.
+    """
+    rows = redcap_rows(rc_df, redcap_path)
+    if len(rows) == 0:
+        return keys_in_redcap
+    positions = np.array([pos for pos, _ in rows])
+    child_ids = np.array([child_id for _, child_id in rows])
+    # a redcap ID seen twice can't be read as a single value, its rows are left out
+    unique = ~rc_df.index.duplicated(keep=False)[positions]
+    keys_in_redcap = {key: value for key, value in all_keys.items() if key in rc_df.columns}
+    if not unique.any():
+        return keys_in_redcap
+    completed_rows = pd.DataFrame((rc_df[list(keys_in_redcap)] == 2).to_numpy()[positions[unique]],
+                                  index=child_ids[unique], columns=list(keys_in_redcap))
+    completed_rows = completed_rows.groupby(level=0, sort=False).any()
+    for key, value in keys_in_redcap.items():
+        completed = completed_rows[key]
+        if value in tracker_df.columns:
+            completed = completed[(tracker_df.loc[completed.index, value] != "1").to_numpy()]
+        tracker_df.loc[completed.index, value] = np.where(completed.to_numpy(), "1", "0")
+    return keys_in_redcap
+
+def file_presence(filenames, subdir, task, sfx, file_exts):
+    # "1" if every expected file of the task is in the folder, "0" if not, "no-data" if a no-data.txt was uploaded
+    corrected = False
+    for filename in filenames:
+        if re.match('^[Dd]eviation.*$', filename):
+            corrected = True
+            break
+        if re.match('^no-data\.txt$', filename):
+            return "no-data"
+    records = matcher.records(filenames)
+    for ext in file_exts:
+        # when deviation.txt file present allow string between suffix and ext (e.g. "s1_r1_e1_firstrun_practice.eeg", "s1_r1_e1firstrun.eeg")
+        if not any(matcher.has_file(records, subdir, task, sfx, ext2, allow_extra=corrected, any_extra=corrected) for ext2 in ext.split("|")):
+            return "0"
+    return "1"
+
+def get_redcap_usecols(datadict_df, redcheck_columns):
+    # redcap columns the tracker is built from, and prefixes of ID and parent language columns
+    columns = {"record_id"}
+    prefixes = []
+    for rc_cols in redcheck_columns.values():
+        for key, value in rc_cols.items():
+            if key == "id_column":
+                prefixes.append(value)
             else:
-                tracker_df.loc[id, combined_col] = "0"
-        if not any(tracker_df.loc[:, combined_col] == "1"):
-            tracker_df.loc[:, combined_col] = "" # all zeros columns leave blank
+                columns.add(key)
+    for _, row in datadict_df.iterrows():
+        if row["variable"] == "id" or row["dataType"] in ["parent_identity", "parent_lang"]:
+            prov = row["provenance"].split(" ")
+            if "variable:" in prov:
+                rc_variable = prov[prov.index("variable:")+1].strip("\"\';,()")
+                columns.add(rc_variable)
+                if row["dataType"] == "parent_lang":
+                    prefixes.append(rc_variable + "_")
+    return columns, prefixes
+
+def presence_matrix(inventory, subjects):
+    """subject x <task>_<suffix> frame of "1"/"0" for the tasks of this session, from one scan of checked
+
+    A missing folder is "0". A no-data.txt makes the first suffix of the task "0" and
+    leaves the others empty (NaN), they are not written to the tracker.
+    """
+    start = time.time()
+    matrix = dict()
+    folders = 0
+    for task, values in tasks_dict.items():
+        datatype = values[0]
+        file_exts = values[1].split(", ")
+        file_sfxs = []
+        for sfx in values[2].split(", "):
+            suf_re = re.match('^(s[0-9]+_r[0-9]+)_e[0-9]+$', sfx)
+            if suf_re and suf_re.group(1) == session:
+                file_sfxs.append(sfx)
+        task_hash = datadict_hash(task, values)
+        for subj in subjects:
+            subdir = "sub-" + str(subj)
+            if not inventory.isdir("checked", subdir, session, datatype):
+                for sfx in file_sfxs:
+                    matrix.setdefault(task + "_" + sfx, dict())[subj] = "0"
+                continue
+            folders += 1
+            folder = inventory.path("checked", subdir, session, datatype)
+            filenames = inventory.listdir("checked", subdir, session, datatype)
+            files = dict.fromkeys(filenames, 0)
+            for sfx in file_sfxs:
+                check = task + "_" + sfx + " " + task_hash
+                result = journal.lookup(folder, files, check)
+                if result is None:
+                    result = file_presence(filenames, subdir, task, sfx, file_exts)
+                    journal.record(folder, files, check, result)
+                if result == "no-data":
+                    matrix.setdefault(task + "_" + sfx, dict())[subj] = "0"
+                    break
+                matrix.setdefault(task + "_" + sfx, dict())[subj] = result
+    presence = pd.DataFrame(matrix, index=subjects, columns=list(matrix))
+    print("Scanned {} subject folders in checked ({} listed) in {:.2f}s: {} rows x {} task columns".format(
+          folders, len(inventory.dirs), time.time() - start + inventory.walk_time, len(presence), len(presence.columns)))
+    return presence
 
 def parent_columns(datadict_df):
     parent_info = dict()
@@ -171,7 +283,7 @@ def parent_columns(datadict_df):
                 parent_info.setdefault(rc_filename,[]).append(row["variable"])
             else:
                 continue
-            rc_df = pd.read_csv(all_redcap_paths[rc_filename])
+            rc_df = redcap_cache.frame(all_redcap_paths[rc_filename])
             parent_ids = list(rc_df.loc[:, rc_variable])
             for id in parent_ids:
                 if re.search(study_no + '[089](\d{4})', str(id)):
@@ -196,19 +308,20 @@ def parent_columns(datadict_df):
                 parent_info.setdefault(rc_filename,[]).append(row["variable"])
             else:
                 continue
-            rc_df = pd.read_csv(all_redcap_paths[rc_filename], index_col="record_id")
+            rc_df = redcap_cache.frame(all_redcap_paths[rc_filename], index_col="record_id")
             for col in rc_df.columns:
                 lang_re = re.match(rc_variable + "_(s[0-9]+_r[0-9]+_e[0-9]+)", col)
                 if lang_re:
-                    for _, rc_row in rc_df.iterrows():
-                        if re.search(study_no + '[089](\d{4})', str(rc_row.name)):
-                            child_id = study_no + '0' + re.search(study_no + '([089])(\d{4})', str(rc_row.name)).group(2)
+                    # read the column on its own, a row of only numeric columns would turn 1 into "1.0"
+                    for rc_id, lang in rc_df[col].items():
+                        if re.search(study_no + '[089](\d{4})', str(rc_id)):
+                            child_id = study_no + '0' + re.search(study_no + '([089])(\d{4})', str(rc_id)).group(2)
                             child_id = int(child_id)
-                            if str(rc_row[col]) == "1" or str(rc_row[col]) == "2":
+                            if str(lang) == "1" or str(lang) == "2":
                                 try:
                                     for suf in row["allowedSuffix"].split(", "):
                                         if re.match("^" + session + "_e[0-9]+$", suf):
-                                            tracker_df.loc[child_id, row["variable"] + "_" + suf] = str(rc_row[col])
+                                            tracker_df.loc[child_id, row["variable"] + "_" + suf] = str(lang)
                                 except:
                                     continue
                             else:
@@ -216,11 +329,19 @@ def parent_columns(datadict_df):
     return parent_info
 
 if __name__ == "__main__":
-    checked_path = sys.argv[1]
-    dataset = sys.argv[2]
-    redcaps = sys.argv[3]
-    session = sys.argv[4]
-    child = sys.argv[5]
+    parser = argparse.ArgumentParser(description="Update the central tracker from redcaps and sourcedata/checked")
+    parser.add_argument("checked_path")
+    parser.add_argument("dataset")
+    parser.add_argument("redcaps", help="comma-separated list of redcaps, or \"none\"")
+    parser.add_argument("session", help="session folder, or \"none\"")
+    parser.add_argument("child", help="\"true\" if redcap IDs are parent/child IDs")
+    parser.add_argument("--full", action="store_true", help="re-check every folder, ignoring results saved by the last run")
+    args = parser.parse_args()
+    checked_path = args.checked_path
+    dataset = args.dataset
+    redcaps = args.redcaps
+    session = args.session
+    child = args.child
 
     redcaps = redcaps.split(',')
     if session == "none":
@@ -233,6 +354,9 @@ if __name__ == "__main__":
     df_dd = pd.read_csv(DATA_DICT)
     redcheck_columns, allowed_duplicate_columns = get_redcap_columns(df_dd)
     tasks_dict = get_tasks(df_dd)
+    matcher = FilenameMatcher(df_dd)
+    # every redcap is parsed once, with only the columns named in the datadict
+    redcap_cache = RedcapCache(*get_redcap_usecols(df_dd, redcheck_columns))
     ids = get_IDs(df_dd)
     study_no = get_study_no(df_dd)
     
@@ -240,7 +364,9 @@ if __name__ == "__main__":
     proj_name = basename(normpath(dataset))
 
     data_tracker_file = "{}/data-monitoring/central-tracker_{}.csv".format(dataset, proj_name)
-    tracker_df = pd.read_csv(data_tracker_file)
+    # changes are merged into the tracker on disk at the end, other jobs may update it meanwhile
+    tracker_tx = TrackerTransaction(data_tracker_file)
+    tracker_df = tracker_tx.tracker.reset_index()
 
     tracker_ids = tracker_df["id"].tolist()
     new_subjects = list(set(ids).difference(tracker_ids))
@@ -258,6 +384,7 @@ if __name__ == "__main__":
     if redcaps[0] != "none":
         all_rc_dfs = dict()
         all_rc_subjects = dict()
+        keys_in_redcap = dict()
         for expected_rc in redcheck_columns.keys():
             present = False
             for redcap in redcaps:
@@ -269,23 +396,18 @@ if __name__ == "__main__":
                     sys.exit(c.RED + "Error: multiple redcaps found with name specified in datadict, " + redcap_path + " and " + redcap + ", exiting." + c.ENDC)
             if present == False:
                 sys.exit(c.RED + "Error: can't find redcap specified in datadict " + expected_rc + ", exiting." + c.ENDC)
+            # Exit if duplicate column names in redcap
+            dupes = redcap_cache.duplicate_columns(redcap_path)
+            if len(dupes) > 0:
+                sys.exit(c.RED + 'Error: Duplicate columns found in redcap ' + redcap_path + ': ' + ', '.join(dupes) + '. Exiting' + c.ENDC)
             if "id_column" in redcheck_columns[expected_rc].keys():
                 id_col = redcheck_columns[expected_rc]["id_column"]
-                for column in pd.read_csv(redcap_path).columns:
+                for column in redcap_cache.header(redcap_path):
                     if column.startswith(id_col):
-                        all_rc_dfs[expected_rc] = pd.read_csv(redcap_path, index_col = column)
+                        all_rc_dfs[expected_rc] = redcap_cache.frame(redcap_path, index_col = column)
             else:
                 id_col = "record_id"
-                all_rc_dfs[expected_rc] = pd.read_csv(redcap_path, index_col = id_col)
-            # If hallMonitor passes "redcap" arg, data exists and passed checks 
-            vals = pd.read_csv(redcap_path, header=None, nrows=1).iloc[0,:].value_counts()
-            # Exit if duplicate column names in redcap
-            if any(vals.values != 1):
-                dupes = []
-                for rc_col in vals.keys():
-                    if vals[rc_col] > 1:
-                        dupes.append(rc_col)
-                sys.exit(c.RED + 'Error: Duplicate columns found in redcap ' + redcap_path + ': ' + ', '.join(dupes) + '. Exiting' + c.ENDC)
+                all_rc_dfs[expected_rc] = redcap_cache.frame(redcap_path, index_col = id_col)
         for expected_rc in redcheck_columns.keys():
             rc_df = all_rc_dfs[expected_rc]
             rc_subjects = []
@@ -309,58 +431,22 @@ if __name__ == "__main__":
                     continue
                 if not re.match('^.*es(_[a-zA-Z])?_s[0-9]+_r[0-9]+_e[0-9]+_complete', key) and key not in all_rc_dfs[expected_rc].columns:
                     other_rcs = []
-                    other_rc_dfs = {rc: all_rc_dfs[rc] for rc in all_rc_dfs if rc != expected_rc}
-                    for redcap, other_rc_df in other_rc_dfs.items():
-                        if key in other_rc_df.columns:
+                    for redcap in all_rc_dfs:
+                        if redcap != expected_rc and key in redcap_cache.header(all_redcap_paths[redcap]):
                             other_rcs.append(redcap)
                     if len(other_rcs) >= 1:
                         sys.exit(c.RED + "Error: can\'t find " + key + " in " + expected_rc + " redcap, but found in " + ", ".join(other_rcs) + " redcaps, exiting." + c.ENDC)
                     else:
                         sys.exit(c.RED + "Error: can\'t find " + key + " in " + expected_rc + " redcap, exiting." + c.ENDC)
 
-            for index, row in rc_df.iterrows():
-                if (isinstance(index, float) or isinstance(index, int)) and not math.isnan(index):
-                    id = int(row.name)
-                else:
-                    print("skipping nan value in ", str(all_redcap_paths[expected_rc]), ": ", str(index))
-                    continue
-                if child == 'true':
-                    if re.search(study_no + '[089](\d{4})', str(id)):
-                        child_id = study_no + '0' + re.search(study_no + '[089](\d{4})', str(id)).group(1)
-                        child_id = int(child_id)
-                    else:
-                        print(str(id), "doesn't match expected child or parent id format of \"" + study_no +"{0,8, or 9}XXXX\", skipping")
-                        continue
-                else:
-                    child_id = id
-                if child_id not in tracker_df.index:
-                    print(child_id, "missing in tracker file, skipping")
-                    continue
-
-                keys_in_redcap = dict()
-                for key, value in all_keys.items():
-                    try:
-                        val = rc_df.loc[id, key]
-                        keys_in_redcap[key] = value
-                        try:
-                            if tracker_df.loc[child_id, value] == "1":
-                                # if value already set continue
-                                continue
-                            else:
-                                tracker_df.loc[child_id, value] = "1" if val == 2 else "0"
-                        except:
-                            tracker_df.loc[child_id, value] = "1" if val == 2 else "0"
-                    except Exception as e_msg:
-                        continue
+            keys_in_redcap = update_from_redcap(rc_df, all_keys, all_redcap_paths[expected_rc], keys_in_redcap)
 
             # for subject IDs missing from redcap, fill in "0" in redcap columns
-            for subj in set(subjects).difference(rc_subjects):
+            missing_subjects = list(set(subjects).difference(rc_subjects))
+            if len(missing_subjects) > 0:
                 for key, value in keys_in_redcap.items():
                     if re.match('^.*' + session + '_e[0-9]+$', value):
-                        try:
-                            tracker_df.loc[subj, value] = "0"
-                        except Exception as e_msg:
-                            continue
+                        tracker_df.loc[missing_subjects, value] = "0"
 
             duplicate_cols = []
             # drop any duplicate columns ending in ".NUMBER"
@@ -368,9 +454,8 @@ if __name__ == "__main__":
                 if re.match('^.*\.[0-9]+$', col):
                     duplicate_cols.append(col)
             tracker_df.drop(columns=duplicate_cols, inplace=True)
-            tracker_df.to_csv(data_tracker_file)
 
-            for col in rc_df.columns:
+            for col in redcap_cache.header(all_redcap_paths[expected_rc]):
                 if col.endswith(completed):
                     all_redcap_columns.setdefault(col,[]).append(all_redcap_paths[expected_rc])
 
@@ -401,61 +486,20 @@ if __name__ == "__main__":
     else:
         sys.exit('Can\'t find redcaps in ' + dataset + '/sourcedata/raw/redcap, skipping ')
 
-    for task, values in tasks_dict.items():
-        datatype = values[0]
-        file_exts = values[1].split(", ")
-        file_sfxs = values[2].split(", ")
-        for subj in subjects:
-            no_data = False
-            subdir = "sub-" + str(subj)
-            dir_id = int(subj)
-            for sfx in file_sfxs:
-                suf_re = re.match('^(s[0-9]+_r[0-9]+)_e[0-9]+$', sfx)
-                if suf_re and suf_re.group(1) == session:
-                    try:
-                        corrected = False
-                        for filename in listdir(join(checked_path, subdir, session, datatype)):
-                            if re.match('^[Dd]eviation.*$', filename):
-                                corrected = True
-                                break
-                            if re.match('^no-data\.txt$', filename):
-                                tracker_df.loc[dir_id, task + "_" + sfx] = "0"
-                                no_data = True
-                                break
-                        if no_data:
-                            break
-                        all_files_present = True
-                        for ext in file_exts:
-                            file_present = False
-                            for filename in listdir(join(checked_path, subdir, session, datatype)):
-                                if corrected:
-                                    if re.match('^sub-' + str(dir_id) + '_' + task + '_' + sfx + '[a-zA-Z0-9_-]*\\' + ext + '$', filename):
-                                    # when deviation.txt file present allow string between suffix and ext (e.g. "s1_r1_e1_firstrun_practice.eeg")
-                                        file_present = True
-                                        break
-                                else:
-                                    if re.match('^sub-' + str(dir_id) + '_' + task + '_' + sfx + '\\' + ext + '$', filename):
-                                        file_present = True
-                                        break
-                            if not file_present:
-                                all_files_present = False
-                        if all_files_present:
-                            tracker_df.loc[dir_id, task + "_" + sfx] = "1"
-                        else:
-                            tracker_df.loc[dir_id, task + "_" + sfx] = "0"
-                    except:
-                        tracker_df.loc[dir_id, task + "_" + sfx] = "0"
+    # presence results of the last run, only folders whose file list changed are matched again
+    journal = ChangeJournal(join(dataset, "data-monitoring", "update-tracker_state.json"), full=args.full)
+    inventory = Inventory(dataset, trees=("checked",), roots={"checked": checked_path}, stat=False)
+    presence = presence_matrix(inventory, subjects)
+    for col in presence.columns:
+        found = presence[col].dropna()
+        tracker_df.loc[found.index, col] = found.to_numpy()
+    journal.save(prune=False)
+    print(journal.report())
 
     fill_combination_columns(tracker_df, df_dd)
 
-    tracker_df.to_csv(data_tracker_file)
-
-    # Create more readable csv with no blank columns
-    tracker_df = pd.read_csv(data_tracker_file, index_col="id")
-    data_tracker_filename = splitext(data_tracker_file)[0]
-    tracker_df_no_blank_columns = tracker_df.loc[:, tracker_df.notnull().any(axis=0)]
-    tracker_df_no_blank_columns = tracker_df_no_blank_columns.fillna("NA")
-    tracker_df_no_blank_columns.to_csv(data_tracker_filename + "_viewable.csv")
+    # also writes the more readable csv with no blank columns
+    tracker_tx.commit(tracker_df, write_viewable=True)
 
             # make remaining empty values equal to 0
             # tracker_df[collabel] = tracker_df[collabel].fillna("0")
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
 import sys
-from os import listdir, makedirs, system
-from os.path import join, isdir, isfile, splitext, getsize, basename
+import os
+import argparse
+import io
+import json
+from contextlib import redirect_stdout
+from os import makedirs
+from os.path import join, splitext
 
-import shutil
 import pandas as pd
 import re
 import math
 from collections import defaultdict
 import importlib
+import multiprocessing
+from file_inventory import Inventory
+from filename_matcher import FilenameMatcher
+from monitor_state import ChangeJournal, datadict_hash
+from file_copier import FileCopier
 
 class c:
     RED = '\033[31m'
@@ -31,10 +40,12 @@ def allowed_val(allowed_vals, value):
             break
     return allowed
 
-def check_number_of_files(path, datatype, tasks, corrected):
+def check_number_of_files(tree, parts, sub, datatype, tasks, corrected):
     if corrected:
         return
-    for raw_file in listdir(path):
+    path = inventory.path(tree, *parts)
+    files = inventory.listdir(tree, *parts)
+    for raw_file in files:
         file_re = re.match('^sub-([0-9]{7})_(.*)_(s[0-9]+_r[0-9]+_e[0-9]+)\.([a-z0-9.]+)$', raw_file)
         if re.match('^[Dd]eviation$', raw_file):
             return
@@ -60,13 +71,13 @@ def check_number_of_files(path, datatype, tasks, corrected):
         if not comb:
             # not a combination row
             taskssum += len(dd_dict[task][2].split(",")) # number files expected from expectedFileExt
-    obs_files = len(listdir(path))
+    obs_files = len(files)
     if obs_files > taskssum:
         print(c.RED + "Error: number of", datatype, "data files in subject folder", sub, str(obs_files), "greater than the expected number", str(taskssum) + c.ENDC)
     if obs_files < taskssum:
         print(c.RED + "Error: number of", datatype, "data files in subject folder", sub, str(obs_files), "less than the expected number", str(taskssum) + c.ENDC)
     tasks_seen = []
-    for raw_file in listdir(path):
+    for raw_file in files:
         file_re = re.match('^sub-([0-9]+)_(.*)_(s[0-9]+_r[0-9]+_e[0-9]+)\.([a-z0-9]+)$', raw_file)
         if file_re and file_re.group(2) not in tasks_seen:
             tasks_seen.append(file_re.group(2))
@@ -75,56 +86,53 @@ def check_number_of_files(path, datatype, tasks, corrected):
         if len(combination_rows_seen) > 1:
             print(c.RED + "Error: multiple different combination rows", str(combination_rows_seen), "seen in subject folder", sub, ": ", str(path), ", only one expected." + c.ENDC)
 
-def check_filenames(path, sub, ses, datatype, allowed_suffixes, possible_exts, corrected):
-        task_files_counter = defaultdict(lambda: 0)
-        task_names = []
-        for raw_file in listdir(path):
-            for task in task_vars:
-                if re.match('^sub-([0-9]{7})_('+task +')_(s[0-9]+_r[0-9]+_e[0-9]+)\.([a-z0-9.]+)$', raw_file):
-                    if task not in task_names:
-                        task_names.append(task)
-                    task_files_counter[task] += 1
-        for raw_file in listdir(path):
+def check_filenames(tree, parts, sub, ses, datatype, allowed_suffixes, possible_exts, corrected):
+        path = inventory.path(tree, *parts)
+        entries = inventory.entries(tree, *parts)
+        for entry in entries:
+            raw_file = entry.name
             #check sub-#, check session folder, check extension
-            if getsize(join(path, raw_file)) == 0 and not re.match('deviation\.txt', raw_file):
+            if entry.size == 0 and not entry.is_dir and not re.match('deviation\.txt', raw_file):
                 print(c.RED + "Error: empty file", join(path, raw_file), "seen, please notify EEG RAs that an empty file was uploaded and upload correct file." + c.ENDC)
                 continue
-            file_re = re.match("^(sub-([0-9]*))_([a-zA-Z0-9_-]*)_((s([0-9]*)_r([0-9]*))_e([0-9]*))(_[a-zA-Z0-9_-]+)?((?:\.[a-zA-Z]+)*)$", raw_file)
-            if file_re:
-                if file_re.group(1) != sub:
-                    print(c.RED + "Error: file from subject", file_re.group(1), "found in", sub, "folder:", join(path, raw_file) + c.ENDC)
-                if file_re.group(5) != ses and len(ses) > 0:
-                    print(c.RED + "Error: file from session", file_re.group(5), "found in", ses, "folder:", join(path, raw_file) + c.ENDC)
-                if file_re.group(10) not in possible_exts and len(file_re.group(10)) > 0:
-                    print(c.RED + "Error: file with extension", file_re.group(10), "found, doesn\'t match expected extensions", ", ".join(possible_exts), ":", join(path, raw_file) + c.ENDC)
-                if file_re.group(2) != '' and not allowed_val(allowed_subs, file_re.group(2)):
-                    print(c.RED + "Error: subject number", file_re.group(2), "not an allowed subject value", allowed_subs, "in file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(3) not in dd_dict.keys():
-                    print(c.RED + "Error: variable name", file_re.group(3), "does not match any datadict variables, in file:", join(path, raw_file) + c.ENDC)
-                if datatype not in file_re.group(3):
-                    print(c.RED + "Error: variable name", file_re.group(3), "does not contain the name of the enclosing datatype folder", datatype, "in file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(4) not in allowed_suffixes:
-                    print(c.RED + "Error: suffix", file_re.group(4), "not in allowed suffixes", ", ".join(allowed_suffixes), "in file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(2) == "":
+            record = matcher.parse(raw_file)
+            if record and matcher.conventional(record):
+                if record.subject != sub:
+                    print(c.RED + "Error: file from subject", record.subject, "found in", sub, "folder:", join(path, raw_file) + c.ENDC)
+                if record.session != ses and len(ses) > 0:
+                    print(c.RED + "Error: file from session", record.session, "found in", ses, "folder:", join(path, raw_file) + c.ENDC)
+                if record.ext not in possible_exts and len(record.ext) > 0:
+                    print(c.RED + "Error: file with extension", record.ext, "found, doesn\'t match expected extensions", ", ".join(possible_exts), ":", join(path, raw_file) + c.ENDC)
+                if record.sub != '' and not allowed_val(allowed_subs, record.sub):
+                    print(c.RED + "Error: subject number", record.sub, "not an allowed subject value", allowed_subs, "in file:", join(path, raw_file) + c.ENDC)
+                if record.task not in dd_dict.keys():
+                    print(c.RED + "Error: variable name", record.task, "does not match any datadict variables, in file:", join(path, raw_file) + c.ENDC)
+                if datatype not in record.task:
+                    print(c.RED + "Error: variable name", record.task, "does not contain the name of the enclosing datatype folder", datatype, "in file:", join(path, raw_file) + c.ENDC)
+                if record.sre not in allowed_suffixes:
+                    print(c.RED + "Error: suffix", record.sre, "not in allowed suffixes", ", ".join(allowed_suffixes), "in file:", join(path, raw_file) + c.ENDC)
+                if record.sub == "":
                     print(c.RED + "Error: subject # missing from file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(3) == "":
+                if record.task == "":
                     print(c.RED + "Error: variable name missing from file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(6) == "":
+                if record.ses == "":
                     print(c.RED + "Error: session # missing from file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(7) == "":
+                if record.run == "":
                     print(c.RED + "Error: run # missing from file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(8) == "":
+                if record.event == "":
                     print(c.RED + "Error: event # missing from file:", join(path, raw_file) + c.ENDC)
-                if file_re.group(10) == "":
+                if record.ext == "":
                     print(c.RED + "Error: extension missing from file, does\'nt match expected extensions", ", ".join(possible_exts), ":", join(path, raw_file) + c.ENDC)
-                if datatype == "psychopy" and file_re.group(10) == ".csv" and file_re.group(2) != "":
+                if datatype == "psychopy" and record.ext == ".csv" and record.sub != "":
                     # Call check-id.py for psychopy files
-                    check_id.check_id(file_re.group(2), join(path, raw_file))
+                    check_id.check_id(record.sub, join(path, raw_file))
             else:
                 if not re.match('[Dd]eviation\.txt', raw_file):
                     print(c.RED + "Error: file ", join(path, raw_file), " does not match naming convention <sub-#>_<variable/task-name>_<session>.<ext>" + c.ENDC)
 
-def check_for_files(path, sub, allowed_suffixes, possible_exts, var):
+def check_for_files(tree, parts, sub, allowed_suffixes, possible_exts, var):
+    path = inventory.path(tree, *parts)
+    records = matcher.records(inventory.listdir(tree, *parts))
     combination = False
     for dict_var, values in combination_rows.items():
         if var in values:
@@ -137,61 +145,189 @@ def check_for_files(path, sub, allowed_suffixes, possible_exts, var):
             for suf in allowed_suffixes:
                 if combination:
                     for eitheror_var in combination_rows[combination_var]:
-                        for rawfile in listdir(path):
-                            if re.match('^'+sub+'_'+eitheror_var+'_'+suf+'(_[a-zA-Z0-9_-]+)?'+ext2+'$', rawfile):
-                                file_present = True
-                                break
-                else:
-                    for rawfile in listdir(path):
-                        if re.match('^'+sub+'_'+var+'_'+suf+'(_[a-zA-Z0-9_-]+)?'+ext2+'$', rawfile):
+                        if matcher.has_file(records, sub, eitheror_var, suf, ext2):
                             file_present = True
                             break
+                else:
+                    if matcher.has_file(records, sub, var, suf, ext2):
+                        file_present = True
         if not file_present:
                 print(c.RED + "Error: no such file", sub+'_'+var+'_sX_rX_eX'+ext, "can be found in", path + c.ENDC)
 
-def check_eeg_metadata(sub_path, eeg_path):
+def check_eeg_metadata(tree, parts):
     # Check that DataFile and MarkerFile match up with filename in both .vmrk and .vhdr files
-    for sub in listdir(sub_path):
-        path = join(sub_path, sub, eeg_path)
-        if isdir(path):
-            for file in listdir(path):
-                vhdr_fname = splitext(file)[0]
-                if file.endswith('.vhdr'):
-                    with open(join(sub_path, sub, eeg_path, file)) as f:
-                        for i, line in enumerate(f):
-                            if i == 5: # Should be "DataFile" line
-                                fname = line.split('=')[1].strip('\n')
-                            if i == 6: # "MarkerFile"
-                                vmrk = line.split('=')[1].strip('\n')
-                                break
-                    f.close()
-                    eeg_fname = splitext(fname)[0]
-                    vmrk_fname = splitext(vmrk)[0]
-                    if vhdr_fname != eeg_fname:
-                        print(c.RED + "Error: DataFile in header " + fname + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
-                    if vhdr_fname != vmrk_fname:
-                        print(c.RED + "Error: MarkerFile in header " + vmrk + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
-                elif file.endswith('.vmrk'):
-                    with open(join(sub_path, sub, eeg_path, file)) as f:
-                        for i, line in enumerate(f):
-                            if i == 4: # "DataFile"
-                                fname = line.split('=')[1].strip('\n')
-                                break
-                    f.close()
-                    eeg_fname = splitext(fname)[0]
-                    if vhdr_fname != eeg_fname:
-                        print(c.RED + "Error: DataFile in header " + fname + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
+    path = inventory.path(tree, *parts)
+    for file in inventory.listdir(tree, *parts):
+        vhdr_fname = splitext(file)[0]
+        if file.endswith('.vhdr'):
+            with open(join(path, file)) as f:
+                for i, line in enumerate(f):
+                    if i == 5: # Should be "DataFile" line
+                        fname = line.split('=')[1].strip('\n')
+                    if i == 6: # "MarkerFile"
+                        vmrk = line.split('=')[1].strip('\n')
+                        break
+            f.close()
+            eeg_fname = splitext(fname)[0]
+            vmrk_fname = splitext(vmrk)[0]
+            if vhdr_fname != eeg_fname:
+                print(c.RED + "Error: DataFile in header " + fname + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
+            if vhdr_fname != vmrk_fname:
+                print(c.RED + "Error: MarkerFile in header " + vmrk + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
+        elif file.endswith('.vmrk'):
+            with open(join(path, file)) as f:
+                for i, line in enumerate(f):
+                    if i == 4: # "DataFile"
+                        fname = line.split('=')[1].strip('\n')
+                        break
+            f.close()
+            eeg_fname = splitext(fname)[0]
+            if vhdr_fname != eeg_fname:
+                print(c.RED + "Error: DataFile in header " + fname + " does not match up with name of file " + file + " in folder " + path + "." + c.ENDC)
+
+def check_eeg_folders(tree, sub_parts, eeg_parts):
+    for sub in inventory.listdir(tree, *sub_parts):
+        parts = sub_parts + (sub,) + eeg_parts
+        if inventory.isdir(tree, *parts):
+            run_check(tree, parts, check_eeg_metadata)
+
+def run_check(tree, parts, check, *check_args):
+    """run a check on one folder, or replay its saved output if the folder's files and the datadict are unchanged"""
+    folder = inventory.path(tree, *parts)
+    files = {entry.name: [entry.size, entry.mtime] for entry in inventory.entries(tree, *parts)}
+    # suffix/extension lists are built from sets, sort them so the key is stable between runs
+    key_args = [sorted(arg) if isinstance(arg, list) else arg for arg in check_args]
+    key = check.__name__ + " " + json.dumps(key_args) + " " + dd_hash
+    output = journal.lookup(folder, files, key)
+    if output is not None:
+        print(output, end="")
+        journal.record(folder, files, key, output)
+    elif phase.pool:
+        phase.items.append((folder, files, key, phase.pool.apply_async(captured_check, (tree, parts, check.__name__, check_args))))
+    else:
+        phase.finish_check(folder, files, key, captured_check(tree, parts, check.__name__, check_args))
+
+def captured_check(tree, parts, check_name, check_args):
+    # runs in the pool workers too, so exits are returned instead of raised
+    buf = io.StringIO()
+    exit_msg = None
+    with redirect_stdout(buf):
+        try:
+            globals()[check_name](tree, parts, *check_args)
+        except SystemExit as e:
+            exit_msg = e.code
+    return buf.getvalue(), exit_msg
+
+class Phase:
+    """One pass over raw or checked, printed in the same order as a serial run.
+
+    Used as a context manager around the pass. Everything printed during the pass is
+    queued together with the pending folder checks and written out when it ends, also
+    when it ends with an error, and sys.stdout is restored. With --workers > 1 the
+    checks are sent to a process pool forked when the pass starts, so the workers see
+    the inventory as it is at that point, e.g. the checked pass sees the files the raw
+    pass copied.
+    Copies to checked stay in the main process, in serial order.
+    """
+    def __init__(self, workers):
+        self.pool = multiprocessing.get_context("fork").Pool(workers) if workers > 1 else None
+        self.items = []
+        self.stdout = sys.stdout
+        sys.stdout = self
+
+    def write(self, text):
+        # without a pool nothing runs ahead of the main process, so there is nothing to reorder
+        if self.pool:
+            self.items.append(text)
+        else:
+            self.stdout.write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def finish_check(self, folder, files, key, result):
+        output, exit_msg = result
+        print(output, end="")
+        if exit_msg is not None:
+            sys.stdout = self.stdout
+            sys.exit(exit_msg)
+        journal.record(folder, files, key, output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(failed=exc_type is not None)
+        return False
+
+    def close(self, failed=False):
+        # after an error only what is already done is written, so the messages explaining it aren't lost
+        sys.stdout = self.stdout
+        try:
+            for item in self.items:
+                if isinstance(item, str):
+                    print(item, end="")
+                elif not failed:
+                    folder, files, key, result = item
+                    self.finish_check(folder, files, key, result.get())
+                elif item[3].ready() and item[3].successful():
+                    print(item[3].get()[0], end="")
+        finally:
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+
+def record_copy(subject, ses, datatype, raw_file):
+    # keep the inventory in sync with files copied into checked
+    try:
+        st = os.stat(join(checked, subject, ses, datatype, raw_file))
+    except FileNotFoundError:
+        return
+    inventory.add_file("checked", (subject, ses, datatype), raw_file, st.st_size, st.st_mtime)
+
+def copy_to_checked(subject, ses, datatype, raw_file):
+    """queue a copy of a raw file into checked, it's listed in the inventory right away so it isn't queued twice"""
+    raw_entry = [entry for entry in inventory.entries("raw", ses, datatype, subject) if entry.name == raw_file][0]
+    if inventory.isdir("checked", subject, ses, datatype):
+        for entry in inventory.entries("checked", subject, ses, datatype):
+            if entry.name == raw_file and entry.size == raw_entry.size and entry.mtime == raw_entry.mtime:
+                # copied by an earlier run and unchanged since
+                return
+    copier.copy(join(raw, ses, datatype, subject, raw_file), join(checked, subject, ses, datatype, raw_file),
+                (subject, ses, datatype, raw_file))
+    inventory.add_file("checked", (subject, ses, datatype), raw_file, raw_entry.size, raw_entry.mtime)
+
+def finish_copies():
+    # wait for the queued copies and put their real size/mtime in the inventory
+    for src, (subject, ses, datatype, raw_file), error in copier.wait():
+        if error:
+            print(c.RED + "Error: could not copy " + src + " to checked: " + str(error) + c.ENDC)
+            inventory.remove_file("checked", (subject, ses, datatype), raw_file)
+        else:
+            record_copy(subject, ses, datatype, raw_file)
 
 if __name__ == "__main__":
-    dataset = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Verify files in sourcedata/raw and copy them to sourcedata/checked")
+    parser.add_argument("dataset", help="path to the dataset")
+    parser.add_argument("--profile", action="store_true", help="report the number of filesystem calls made")
+    parser.add_argument("--full", action="store_true", help="re-check every folder, ignoring results saved by the last run")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes running folder checks (default: 1)")
+    parser.add_argument("--copy-workers", type=int, default=4, help="number of files copied to checked at once (default: 4)")
+    parser.add_argument("--checksum", action="store_true", help="compare md5 checksums of copied files, not just their size")
+    args = parser.parse_args()
+    dataset = args.dataset
 
     raw = join(dataset,"sourcedata","raw")
     checked = join(dataset,"sourcedata","checked")
 
     datadict = "{}/data-monitoring/data-dictionary/central-tracker_datadict.csv".format(dataset)
 
+    # walk raw and checked once, every check below reads from this index
+    inventory = Inventory(dataset)
+    copier = FileCopier(args.copy_workers, checksum=args.checksum)
+
     sessions = False
-    for dir in listdir(join(dataset,"sourcedata","raw")):
+    for dir in inventory.listdir("raw"):
         if re.match("s[0-9]+_r[0-9]+(_e[0-9]+)?", dir):
             sessions = True
             break
@@ -219,220 +355,235 @@ if __name__ == "__main__":
 
     allowed_subs = df_dd.loc["id", "allowedValues"]
 
+    # compiled once from the datadict, parses each filename a single time
+    matcher = FilenameMatcher(df_dd)
+
+    # results of the last run, folders whose files and datadict rows are unchanged aren't re-checked
+    journal = ChangeJournal(join(dataset, "data-monitoring", "verify-copy_state.json"), full=args.full)
+    dd_hash = datadict_hash(dd_dict, combination_rows, allowed_subs)
+
     # now search sourcedata/raw for correct files
-    dtypes = []
-    dtype_exts = defaultdict(lambda: [])
-    dtype_sfxs = defaultdict(lambda: [])
-    for variable, values in dd_dict.items():
-        print("Verifying files in raw for:", variable)
-        variable = variable
-        datatype = values[0]
-        allowed_suffixes = values[1].split(", ")
-        fileexts = values[2].split(", ") # with or without . ?
-        allowed_vals = values[3].split(", ")
-        possible_exts = sum([ext.split('|') for ext in fileexts], []) #shouldn't this be done later?
-        numfiles = len(fileexts)
-
-        dtype_exts[datatype] = list(set(dtype_exts[datatype]).union(set(possible_exts)))
-        dtype_sfxs[datatype] = list(set(dtype_sfxs[datatype]).union(set(allowed_suffixes)))
-        if datatype not in dtypes:
-            dtypes.append(datatype)
-
-        if sessions:
-            expected_sessions = []
-            for ses in allowed_suffixes:
-                ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
-                if ses_re:
-                    expected_sessions.append(ses_re.group(1))
-        else:
-            expected_sessions = [""]
-        for ses in expected_sessions:
-            if isdir(join(raw, ses, datatype)):
-                # for EEG check that filename in vhdr matches up w/ .eeg file
-                if '.eeg' in possible_exts and '.vmrk' in possible_exts and '.vhdr' in possible_exts:
-                    path = join(raw, ses, datatype)
-                    check_eeg_metadata(path, "")
-                for subject in listdir(join(raw, ses, datatype)):
-                    if not re.match("^sub-[0-9]+$", subject):
-                        print(c.RED + "Error: subject directory ", subject, " does not match sub-# convention" + c.ENDC)
-                        continue
-                    path = join(raw, ses, datatype, subject)
-                    # check that files in raw match conventions
-                    corrected = False
-                    no_data = False
-                    for raw_file in listdir(path):
-                        if re.match('^[Dd]eviation.*$', raw_file):
-                            corrected = True
-                            system('mkdir -p ' + join(checked, subject, ses, datatype))
-                            system('cp ' + join(raw, ses, datatype, subject, raw_file) + ' ' + join(checked, subject, ses, datatype, raw_file))
-                        if re.match('^no-data\.txt$', raw_file):
-                            no_data = True
-                            system('mkdir -p ' + join(checked, subject, ses, datatype))
-                            system('cp ' + join(raw, ses, datatype, subject, raw_file) + ' ' + join(checked, subject, ses, datatype, raw_file))
-                    if no_data:
-                        continue
-                    check_for_files(path, subject, allowed_suffixes, possible_exts, variable)
-                    # copy to checked
-                    # copy file to checked, unless "deviation" is seen
-                    if corrected:
-                        continue
-                    for suffix in allowed_suffixes:
-                        presence = False
-                        copied_files = []
-                        for req_ext in fileexts:
-                            for ext in req_ext.split('|'):
-                                for raw_file in listdir(join(raw, ses, datatype, subject)):
-                                    if re.match(subject + "_" + variable + "_" + suffix + ext, raw_file):
-                                        presence = True
-                                        if not isdir(join(checked, subject, ses, datatype)):
-                                            print(c.GREEN + "Creating ", join(subject, ses, datatype), " directory in checked" + c.ENDC)
-                                            makedirs(join(checked, subject, ses, datatype))
-                                        if not isfile(join(checked, subject, ses, datatype, raw_file)) and splitext(raw_file)[1] != '.gpg':
-                                            print(c.GREEN + "Copying ", raw_file, " to checked" + c.ENDC)
-                                            system('cp -p ' + join(raw, ses, datatype, subject, raw_file) + ' ' + join(checked, subject, ses, datatype, raw_file))
-                                        copied_files.append(raw_file)
+    with Phase(args.workers) as phase:
+        dtypes = []
+        dtype_exts = defaultdict(lambda: [])
+        dtype_sfxs = defaultdict(lambda: [])
+        for variable, values in dd_dict.items():
+            print("Verifying files in raw for:", variable)
+            variable = variable
+            datatype = values[0]
+            allowed_suffixes = values[1].split(", ")
+            fileexts = values[2].split(", ") # with or without . ?
+            allowed_vals = values[3].split(", ")
+            possible_exts = sum([ext.split('|') for ext in fileexts], []) #shouldn't this be done later?
+            numfiles = len(fileexts)
+
+            dtype_exts[datatype] = list(set(dtype_exts[datatype]).union(set(possible_exts)))
+            dtype_sfxs[datatype] = list(set(dtype_sfxs[datatype]).union(set(allowed_suffixes)))
+            if datatype not in dtypes:
+                dtypes.append(datatype)
+
+            if sessions:
+                expected_sessions = []
+                for ses in allowed_suffixes:
+                    ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
+                    if ses_re:
+                        expected_sessions.append(ses_re.group(1))
             else:
-                print(c.RED + "Error: can\'t find", datatype, "directory under", raw+"/"+ses + c.ENDC)
-    for dtype in dtypes:
-        if sessions:
-            expected_sessions = []
-            for ses in dtype_sfxs[dtype]:
-                ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
-                if ses_re:
-                    expected_sessions.append(ses_re.group(1))
-        else:
-            expected_sessions = [""]
-        for ses in expected_sessions:
-            if isdir(join(raw, ses, dtype)):
-                for subject in listdir(join(raw, ses, dtype)):
-                    if not re.match("^sub-[0-9]+$", subject):
-                        continue
-                    path = join(raw, ses, dtype, subject)
-                    # check that files in raw match conventions
-                    corrected = False
-                    no_data = False
-                    for raw_file in listdir(path):
-                        if re.match('^[Dd]eviation.*$', raw_file):
-                            corrected = True
-                        if re.match('^no-data\.txt$', raw_file):
-                            no_data = True
-                    if no_data:
-                        continue
-                    check_filenames(path, subject, ses, dtype, dtype_sfxs[dtype], dtype_exts[dtype], corrected)
-
-
-    print("Verifying numbers of files in subdirectories in raw")
-    datatype_folders = []
-    for subdir in dd_dict.values():
-        if subdir[0] not in datatype_folders:
-            datatype_folders.append(subdir[0])
-    for session_folder in listdir(raw):
-        if isdir(join(raw, session_folder)):
-            for datatype_folder in datatype_folders:
-                tasks = []
-                for task, vals in dd_dict.items():
-                    if vals[0] == datatype_folder:
-                        tasks.append(task)
-                if isdir(join(raw, session_folder, datatype_folder)):
-                    for sub in listdir(join(raw, session_folder, datatype_folder)):
-                        path = join(raw, session_folder, datatype_folder, sub)
-                        corrected = False
-                        for raw_file in listdir(path):
-                            if re.match('^[Dd]eviation.*$', raw_file) or re.match('^no-data\.txt$', raw_file):
-                                corrected = True
-                                break
-                        check_number_of_files(path, datatype_folder, tasks, corrected)
-    # do same filename checks for checked files
-    dtypes = []
-    dtype_exts = defaultdict(lambda: [])
-    dtype_sfxs = defaultdict(lambda: [])
-    for variable, values in dd_dict.items():
-        print("Verifying files in checked for:", variable)
-        variable = variable
-        datatype = values[0]
-        allowed_suffixes = values[1].split(", ")
-        fileexts = values[2].split(", ") # with or without . ?
-        allowed_vals = values[3].split(", ")
-        possible_exts = sum([ext.split('|') for ext in fileexts], [])
-        numfiles = len(fileexts)
-
-        dtype_exts[datatype] = list(set(dtype_exts[datatype]).union(set(possible_exts)))
-        dtype_sfxs[datatype] = list(set(dtype_sfxs[datatype]).union(set(allowed_suffixes)))
-        if datatype not in dtypes:
-            dtypes.append(datatype)
-
-        if sessions:
-            expected_sessions = []
-            for ses in allowed_suffixes:
-                ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
-                if ses_re:
-                    expected_sessions.append(ses_re.group(1))
-        else:
-            expected_sessions = [""]
-        # for EEG check that filename in vhdr matches up w/ .eeg file
-        if '.eeg' in possible_exts and '.vmrk' in possible_exts and '.vhdr' in possible_exts:
+                expected_sessions = [""]
             for ses in expected_sessions:
-                path = checked
-                check_eeg_metadata(path, join(ses, datatype))
-        for sub in listdir(checked):
-            if sub.startswith("sub-"):
-                for ses in expected_sessions:
-                    if isdir(join(checked, sub, ses, datatype)):
-                        # check that files in checked match conventions
-                        path = join(checked, sub, ses, datatype)
+                if inventory.isdir("raw", ses, datatype):
+                    # for EEG check that filename in vhdr matches up w/ .eeg file
+                    if '.eeg' in possible_exts and '.vmrk' in possible_exts and '.vhdr' in possible_exts:
+                        check_eeg_folders("raw", (ses, datatype), ())
+                    for subject in inventory.listdir("raw", ses, datatype):
+                        if not re.match("^sub-[0-9]+$", subject):
+                            print(c.RED + "Error: subject directory ", subject, " does not match sub-# convention" + c.ENDC)
+                            continue
+                        parts = (ses, datatype, subject)
+                        # check that files in raw match conventions
                         corrected = False
                         no_data = False
-                        for raw_file in listdir(path):
+                        for raw_file in inventory.listdir("raw", *parts):
                             if re.match('^[Dd]eviation.*$', raw_file):
                                 corrected = True
+                                copy_to_checked(subject, ses, datatype, raw_file)
                             if re.match('^no-data\.txt$', raw_file):
                                 no_data = True
+                                copy_to_checked(subject, ses, datatype, raw_file)
                         if no_data:
-                            break
-                        check_for_files(path, sub, allowed_suffixes, possible_exts, variable)
-
-    for dtype in dtypes:
-        if sessions:
-            expected_sessions = []
-            for ses in dtype_sfxs[dtype]:
-                ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
-                if ses_re:
-                    expected_sessions.append(ses_re.group(1))
-        else:
-            expected_sessions = [""]
-        for sub in listdir(checked):
-            if sub.startswith("sub-"):
-                for ses in expected_sessions:
-                    if isdir(join(checked, sub, ses, dtype)):
-                        path = join(checked, sub, ses, dtype)
+                            continue
+                        run_check("raw", parts, check_for_files, subject, allowed_suffixes, possible_exts, variable)
+                        # copy to checked
+                        # copy file to checked, unless "deviation" is seen
+                        if corrected:
+                            continue
+                        for suffix in allowed_suffixes:
+                            presence = False
+                            copied_files = []
+                            for req_ext in fileexts:
+                                for ext in req_ext.split('|'):
+                                    for record in matcher.records(inventory.listdir("raw", *parts)):
+                                        raw_file = record.name
+                                        if record.subject == subject and record.task == variable and record.sre == suffix and not record.extra and record.ext.startswith(ext):
+                                            presence = True
+                                            if not inventory.isdir("checked", subject, ses, datatype):
+                                                print(c.GREEN + "Creating ", join(subject, ses, datatype), " directory in checked" + c.ENDC)
+                                                makedirs(join(checked, subject, ses, datatype), exist_ok=True)
+                                                inventory.add_dir("checked", (subject, ses, datatype))
+                                            if not inventory.isfile("checked", subject, ses, datatype, raw_file) and splitext(raw_file)[1] != '.gpg':
+                                                print(c.GREEN + "Copying ", raw_file, " to checked" + c.ENDC)
+                                                copy_to_checked(subject, ses, datatype, raw_file)
+                                            copied_files.append(raw_file)
+                else:
+                    print(c.RED + "Error: can\'t find", datatype, "directory under", raw+"/"+ses + c.ENDC)
+        for dtype in dtypes:
+            if sessions:
+                expected_sessions = []
+                for ses in dtype_sfxs[dtype]:
+                    ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
+                    if ses_re:
+                        expected_sessions.append(ses_re.group(1))
+            else:
+                expected_sessions = [""]
+            for ses in expected_sessions:
+                if inventory.isdir("raw", ses, dtype):
+                    for subject in inventory.listdir("raw", ses, dtype):
+                        if not re.match("^sub-[0-9]+$", subject):
+                            continue
+                        parts = (ses, dtype, subject)
+                        # check that files in raw match conventions
                         corrected = False
                         no_data = False
-                        for raw_file in listdir(path):
+                        for raw_file in inventory.listdir("raw", *parts):
                             if re.match('^[Dd]eviation.*$', raw_file):
                                 corrected = True
                             if re.match('^no-data\.txt$', raw_file):
                                 no_data = True
                         if no_data:
-                            break
-                        else:
-                            check_filenames(path, sub, ses, dtype, dtype_sfxs[dtype], dtype_exts[dtype], corrected)
-
-    print("Verifying numbers of files in subdirectories in checked")
-    for sub in listdir(checked):
-        if isdir(join(checked, sub)):
-            for session_folder in listdir(join(checked, sub)):
-                if isdir(join(checked, sub, session_folder)):
-                    for datatype_folder in datatype_folders:
-                        tasks = []
-                        for task, vals in dd_dict.items():
-                            if vals[0] == datatype_folder:
-                                tasks.append(task)
-                        path = join(checked, sub, session_folder, datatype_folder)
-                        if isdir(path):
+                            continue
+                        run_check("raw", parts, check_filenames, subject, ses, dtype, dtype_sfxs[dtype], dtype_exts[dtype], corrected)
+
+
+        print("Verifying numbers of files in subdirectories in raw")
+        datatype_folders = []
+        for subdir in dd_dict.values():
+            if subdir[0] not in datatype_folders:
+                datatype_folders.append(subdir[0])
+        for session_folder in inventory.listdir("raw"):
+            if inventory.isdir("raw", session_folder):
+                for datatype_folder in datatype_folders:
+                    tasks = []
+                    for task, vals in dd_dict.items():
+                        if vals[0] == datatype_folder:
+                            tasks.append(task)
+                    if inventory.isdir("raw", session_folder, datatype_folder):
+                        for sub in inventory.listdir("raw", session_folder, datatype_folder):
+                            parts = (session_folder, datatype_folder, sub)
                             corrected = False
-                            for raw_file in listdir(path):
+                            for raw_file in inventory.listdir("raw", *parts):
                                 if re.match('^[Dd]eviation.*$', raw_file) or re.match('^no-data\.txt$', raw_file):
                                     corrected = True
                                     break
-                            check_number_of_files(path, datatype_folder, tasks, corrected)
+                            run_check("raw", parts, check_number_of_files, sub, datatype_folder, tasks, corrected)
+        finish_copies()
+
+    # do same filename checks for checked files, the pool is forked again so it sees the copies made above
+    with Phase(args.workers) as phase:
+        dtypes = []
+        dtype_exts = defaultdict(lambda: [])
+        dtype_sfxs = defaultdict(lambda: [])
+        for variable, values in dd_dict.items():
+            print("Verifying files in checked for:", variable)
+            variable = variable
+            datatype = values[0]
+            allowed_suffixes = values[1].split(", ")
+            fileexts = values[2].split(", ") # with or without . ?
+            allowed_vals = values[3].split(", ")
+            possible_exts = sum([ext.split('|') for ext in fileexts], [])
+            numfiles = len(fileexts)
+
+            dtype_exts[datatype] = list(set(dtype_exts[datatype]).union(set(possible_exts)))
+            dtype_sfxs[datatype] = list(set(dtype_sfxs[datatype]).union(set(allowed_suffixes)))
+            if datatype not in dtypes:
+                dtypes.append(datatype)
+
+            if sessions:
+                expected_sessions = []
+                for ses in allowed_suffixes:
+                    ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
+                    if ses_re:
+                        expected_sessions.append(ses_re.group(1))
+            else:
+                expected_sessions = [""]
+            # for EEG check that filename in vhdr matches up w/ .eeg file
+            if '.eeg' in possible_exts and '.vmrk' in possible_exts and '.vhdr' in possible_exts:
+                for ses in expected_sessions:
+                    check_eeg_folders("checked", (), (ses, datatype))
+            for sub in inventory.listdir("checked"):
+                if sub.startswith("sub-"):
+                    for ses in expected_sessions:
+                        if inventory.isdir("checked", sub, ses, datatype):
+                            # check that files in checked match conventions
+                            parts = (sub, ses, datatype)
+                            corrected = False
+                            no_data = False
+                            for raw_file in inventory.listdir("checked", *parts):
+                                if re.match('^[Dd]eviation.*$', raw_file):
+                                    corrected = True
+                                if re.match('^no-data\.txt$', raw_file):
+                                    no_data = True
+                            if no_data:
+                                break
+                            run_check("checked", parts, check_for_files, sub, allowed_suffixes, possible_exts, variable)
+
+        for dtype in dtypes:
+            if sessions:
+                expected_sessions = []
+                for ses in dtype_sfxs[dtype]:
+                    ses_re = re.match("(s[0-9]+_r[0-9]+)(_e[0-9]+)?", ses)
+                    if ses_re:
+                        expected_sessions.append(ses_re.group(1))
+            else:
+                expected_sessions = [""]
+            for sub in inventory.listdir("checked"):
+                if sub.startswith("sub-"):
+                    for ses in expected_sessions:
+                        if inventory.isdir("checked", sub, ses, dtype):
+                            parts = (sub, ses, dtype)
+                            corrected = False
+                            no_data = False
+                            for raw_file in inventory.listdir("checked", *parts):
+                                if re.match('^[Dd]eviation.*$', raw_file):
+                                    corrected = True
+                                if re.match('^no-data\.txt$', raw_file):
+                                    no_data = True
+                            if no_data:
+                                break
+                            else:
+                                run_check("checked", parts, check_filenames, sub, ses, dtype, dtype_sfxs[dtype], dtype_exts[dtype], corrected)
+
+        print("Verifying numbers of files in subdirectories in checked")
+        for sub in inventory.listdir("checked"):
+            if inventory.isdir("checked", sub):
+                for session_folder in inventory.listdir("checked", sub):
+                    if inventory.isdir("checked", sub, session_folder):
+                        for datatype_folder in datatype_folders:
+                            tasks = []
+                            for task, vals in dd_dict.items():
+                                if vals[0] == datatype_folder:
+                                    tasks.append(task)
+                            parts = (sub, session_folder, datatype_folder)
+                            if inventory.isdir("checked", *parts):
+                                corrected = False
+                                for raw_file in inventory.listdir("checked", *parts):
+                                    if re.match('^[Dd]eviation.*$', raw_file) or re.match('^no-data\.txt$', raw_file):
+                                        corrected = True
+                                        break
+                                run_check("checked", parts, check_number_of_files, sub, datatype_folder, tasks, corrected)
+
+    journal.save()
+    print(journal.report())
+    print(copier.report())
+    if args.profile:
+        print(inventory.report())
 
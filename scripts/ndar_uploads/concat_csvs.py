@@ -1,57 +1,106 @@
 import os
-from os.path import basename, join, isdir
+from os.path import basename, dirname, join, isdir
 import sys
 import re
+import time
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 ### combines identically-named .csv files in multiple folders (up to sX_rX_eX) into single .csv files for NIH uploads
 ###
-### USAGE: python3 concat_csvs.py <folder1,folder2,folder3...> <output folder>
+### USAGE: python3 concat_csvs.py <folder1,folder2,folder3...> <output folder> [--workers N]
+
+# bytes per read/write when copying the rows of an input
+CHUNK_SIZE = 1024 * 1024
+
+def find_inputs(folders):
+    # {output base: [input files in folder order]}, a base only has to be in one of the folders
+    inputs = {}
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            file_re = re.match(r"^(.+)_s\d+_r\d+_e\d+_incomplete.csv$", file)
+            if file_re:
+                inputs.setdefault(file_re.group(1), []).append(join(folder, file))
+    return inputs
+
+def read_header(path):
+    # NDAR header line and column names, the two lines that are only written once
+    with open(path, "rb") as f:
+        return f.readline(), f.readline()
+
+def check_headers(files):
+    # None if all files have the same NDAR header and columns, otherwise what differs
+    headers = [read_header(file) for file in files]
+    for file, (ndar_line, columns_line) in zip(files[1:], headers[1:]):
+        if ndar_line.split(b",")[0:2] != headers[0][0].split(b",")[0:2]:
+            return "NDAR structure of " + file + " (" + ndar_line.decode().strip().strip(",") + ") differs from " + files[0] + " (" + headers[0][0].decode().strip().strip(",") + ")"
+        if columns_line != headers[0][1]:
+            return "columns of " + file + " differ from " + files[0]
+    return None
+
+def concat(filename_base, files, out_path):
+    # header lines of the first file, then the rows of every file streamed into a temporary file that is renamed when complete
+    out_file = join(out_path, filename_base + "_combined_incomplete.csv")
+    tmp_file = join(dirname(out_file), "." + basename(out_file) + "." + str(os.getpid()) + ".tmp")
+    start = time.time()
+    try:
+        with open(tmp_file, "wb") as o:
+            for i, file in enumerate(files):
+                with open(file, "rb") as f:
+                    if i > 0:
+                        f.readline()
+                        f.readline()
+                    shutil.copyfileobj(f, o, CHUNK_SIZE)
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n": # so the next file's rows don't continue this file's last line
+                            o.write(b"\n")
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return out_file, os.stat(out_file).st_size, time.time() - start
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("python3 concat_csvs.py <folder1,folder2,folder3...> <output folder>")
-        exit()
+    parser = argparse.ArgumentParser(usage="python3 concat_csvs.py <folder1,folder2,folder3...> <output folder> [--workers N]")
+    parser.add_argument("folders")
+    parser.add_argument("out_path")
+    parser.add_argument("--workers", type=int, default=4, help="output files written at the same time")
+    args = parser.parse_args()
 
-    folders = sys.argv[1]
-    out_path = sys.argv[2]
-    folders = folders.split(",")
+    folders = args.folders.split(",")
+    out_path = args.out_path
     if not isdir(out_path):
         os.mkdir(out_path)
-    files_in_common = os.listdir(folders[0])
-    unique_files = {}
-    for file in files_in_common:
-        file_re = re.match(r"^(.+)_s\d+_r\d+_e\d+_incomplete.csv", file)
-        if file_re:
-            unique_files[file_re.group(1)] = [join(folders[0], file)]
+    unique_files = find_inputs(folders)
     if len(unique_files) == 0:
         sys.exit('No unique files ending in "sX_rX_eX_incomplete.csv" seen in folders')
-    for i in range(1, len(folders)):
-        folder = folders[i]
-        files = os.listdir(folder)
-        files_in_folder = []
-        for file in files:
-            file_re = re.match(r"^(.+)_s\d+_r\d+_e\d+_incomplete.csv", file)
-            if file_re:
-                files_in_folder.append(file_re.group(1))
-                if file_re.group(1) not in unique_files.keys():
-                    unique_files.pop(file, None)
-                else:
-                    unique_files[file_re.group(1)].append(join(folder, file))
-    file_dict = {}
-    for filename_base in unique_files.keys():
-        first_file = True
-        with open(join(out_path, filename_base + "_combined_incomplete.csv"), "w") as o:
-            for file in unique_files[filename_base]:
-                with open(file, "r") as file_dict[i]:
-                    lines = file_dict[i].readlines()
-                    if first_file:
-                        lines_to_write = range(0, len(lines))
-                        first_file = False
-                    else:
-                        lines_to_write = range(2, len(lines))
-                    for j in lines_to_write:
-                        o.write(lines[j])
-                file_dict[i].close()
-        print("wrote out " + join(out_path, filename_base + "_combined_incomplete.csv"))
-        o.close()
+
+    failed = False
+    to_write = {}
+    for filename_base, files in unique_files.items():
+        if len(files) < len(folders):
+            print("Warning: " + filename_base + " only found in " + str(len(files)) + " of " + str(len(folders)) + " folders, combining those")
+        problem = check_headers(files)
+        if problem is not None:
+            print("Error: can't combine " + filename_base + ", " + problem)
+            failed = True
+        else:
+            to_write[filename_base] = files
+
+    start = time.time()
+    total_size = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [executor.submit(concat, filename_base, files, out_path) for filename_base, files in to_write.items()]
+        for future in futures:
+            out_file, size, seconds = future.result()
+            total_size += size
+            print("wrote out {} ({:.1f} MB in {:.2f}s)".format(out_file, size / (1024 * 1024), seconds))
+    seconds = time.time() - start
+    print("Combined {} files, {:.1f} MB in {:.2f}s, {:.1f} MB/s".format(len(to_write), total_size / (1024 * 1024), seconds,
+          total_size / (1024 * 1024) / seconds if seconds else 0))
+    if failed:
+        sys.exit(1)
@@ -1,15 +1,31 @@
 import pandas as pd
 
 import os
-from os.path import basename, join, isdir
+from os.path import basename, dirname, join, isdir, realpath
 
 import sys
+import gzip
 import json
 import math
 import re
+import time
 import numpy as np
 from datetime import datetime
 
+from mapping_formula import compile_formulas, FormulaError
+
+
+# every export parsed once, sessions in a batch share the consent redcap and redcaps from earlier sessions
+redcap_frames = {}
+# (bytes, seconds) of each CSV written
+write_stats = []
+
+def read_redcap(path):
+    path = realpath(path)
+    if path not in redcap_frames.keys():
+        redcap_frames[path] = pd.read_csv(path, index_col="record_id")
+    return redcap_frames[path]
+
 
 def get_redcaps(datadict_df, redcaps, ndar_json, other_sessions=False):
     df = datadict_df
@@ -39,7 +55,7 @@ def get_redcaps(datadict_df, redcaps, ndar_json, other_sessions=False):
         for redcap in redcaps:
             if expected_rc in basename(redcap.lower()) and present == False:
                 redcap_path = redcap
-                redcaps_dict[expected_rc] = pd.read_csv(redcap_path, index_col="record_id")
+                redcaps_dict[expected_rc] = read_redcap(redcap_path)
                 present = True
             elif expected_rc in basename(redcap.lower()) and present == True:
                 sys.error("Error: multiple redcaps found with name specified in datadict, " + redcap_path + " and " + redcap + ", exiting.")
@@ -48,6 +64,13 @@ def get_redcaps(datadict_df, redcaps, ndar_json, other_sessions=False):
     return redcaps_dict
 
 
+def writable_column(ndar_df, col):
+    # copy of a column to set values in before assigning it back, blank if the frame doesn't have it yet
+    if col in ndar_df.columns:
+        return ndar_df[col].to_numpy(dtype=object).copy()
+    return np.full(len(ndar_df.index), np.nan, dtype=object)
+
+
 def map_race(ndar_df, ndar_json, redcap, race_col, sre, col_name, sessionless=False, parent=False):
     race_dict = { "10": "White", "11": "Black or African American", "12": "American Indian/Alaska Native", "13": "American Indian/Alaska Native", \
                   "14": "Hawaiian or Pacific Islander", "15": "Hawaiian or Pacific Islander", "16": "Hawaiian or Pacific Islander", \
@@ -62,25 +85,35 @@ def map_race(ndar_df, ndar_json, redcap, race_col, sre, col_name, sessionless=Fa
     for col in rc_df.columns:
         if col.startswith(race_col_base.col) or col.startswith(race_col_base.coles):
             race_cols.append(col)
-    for child_id in ndar_df.index:
-        if parent:
-            id = int(str(child_id)[0:2] + "8" + str(child_id)[3:])
-        else:
-            id = child_id
-        sum = 0
-        for col in race_cols:
-            sum += rc_df.loc[id, col]
-        if sum == 1:
-            for col in race_cols:
-                if rc_df.loc[id, col] == 1:
-                    race_num = re.match('^demo(es)?_[de]_race_s[0-9]+_r[0-9]+_e[0-9]+_+([0-9]+)$', col).group(2)
-                    # TODO this needs to be drawn from the JSON
-                    race = race_dict[race_num]
-                    ndar_df.loc[child_id, col_name] = race
-        elif sum > 1:
-            ndar_df.loc[child_id, col_name] = "More than one race"
-        elif sum == 0:
-            ndar_df.loc[child_id, col_name] = "Unknown or not reported"
+    ids = swap_id_digit(ndar_df.index, "8") if parent else list(ndar_df.index)
+    # one row of checkboxes per subject, the number of boxes ticked decides which of the three answers applies
+    checked = rc_df[race_cols].reindex(ids).to_numpy(dtype=float)
+    total = checked.sum(axis=1)
+    values = writable_column(ndar_df, col_name)
+    values[total > 1] = "More than one race"
+    values[total == 0] = "Unknown or not reported"
+    one = (total == 1) & (checked == 1).any(axis=1)
+    # last ticked box, in case the checkboxes aren't all 0/1
+    race_pos = len(race_cols) - 1 - np.argmax((checked == 1)[:, ::-1], axis=1)
+    for pos in np.unique(race_pos[one]):
+        race_num = re.match('^demo(es)?_[de]_race_s[0-9]+_r[0-9]+_e[0-9]+_+([0-9]+)$', race_cols[pos]).group(2)
+        # TODO this needs to be drawn from the JSON
+        values[one & (race_pos == pos)] = race_dict[race_num]
+    ndar_df[col_name] = values
+
+
+def add_rows(ndar_df, ids):
+    # blank rows for ids appended in one go, with the dtypes appending them one at a time with .loc gave
+    columns = dict()
+    for pos in range(len(ndar_df.columns)):
+        values = ndar_df.iloc[:, pos].to_numpy()
+        if values.dtype.kind in "iu":
+            values = values.astype(float) # integer columns become float once they have blank rows
+        blank = np.full(len(ids), np.nan, dtype=values.dtype if values.dtype.kind == "f" else object)
+        columns[pos] = np.concatenate([values.astype(blank.dtype), blank])
+    enlarged = pd.DataFrame(columns, index=list(ndar_df.index) + list(ids))
+    enlarged.columns = ndar_df.columns
+    return enlarged
 
 
 def map_interview_date(ndar_df, ndar_json, sre, rc, rc_col):
@@ -88,147 +121,185 @@ def map_interview_date(ndar_df, ndar_json, sre, rc, rc_col):
     rc_col = Column(rc_col)
     rc_variable = rc_col.col
     rc_variable_es = rc_col.coles
-    for id in rc_df.index:
-        child_id = int(str(id)[0:2] + "0" + str(id)[3:])
-        date_string = rc_df.loc[id, rc_variable]
-        if not isinstance(date_string, str) and isinstance(rc_df.loc[id, rc_variable_es], str):
-            date_string = rc_df.loc[id, rc_variable_es]
-        if isinstance(date_string, str):
-            date_string = date_string.split(" ")[0]
-            date_obj = datetime.strptime(date_string, "%Y-%m-%d")
-            val = date_obj.strftime("%m/%d/%Y")
-            ndar_df.loc[child_id, "interview_date"] = val
-        else:
-            continue
+    dates = rc_df[rc_variable].to_numpy(dtype=object)
+    if rc_variable_es in rc_df.columns:
+        dates_es = rc_df[rc_variable_es].to_numpy(dtype=object)
+        use_es = np.array([not isinstance(date, str) and isinstance(date_es, str) for date, date_es in zip(dates, dates_es)], dtype=bool)
+        dates[use_es] = dates_es[use_es]
+    has_date = np.array([isinstance(date_string, str) for date_string in dates], dtype=bool)
+    child_ids = swap_id_digit(rc_df.index[has_date], "0")
+    vals = [datetime.strptime(date_string.split(" ")[0], "%Y-%m-%d").strftime("%m/%d/%Y") for date_string in dates[has_date]]
+    # last date of each child, in the order the children first appear in the redcap
+    dates = dict(zip(child_ids, vals))
+    # children with a date but not in the list of IDs get a row of their own, like setting each date one at a time did
+    new_ids = [child_id for child_id in dates.keys() if child_id not in ndar_df.index]
+    if len(new_ids) > 0:
+        ndar_df = add_rows(ndar_df, new_ids)
+    found = ndar_df.index.isin(list(dates.keys()))
+    values = writable_column(ndar_df, "interview_date")
+    values[found] = [dates[child_id] for child_id in ndar_df.index[found]]
+    ndar_df["interview_date"] = values
+    return ndar_df
 
 
 
 
-def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
-    rc = ndar_json[ndar_csv]["req_columns"][ndar_col]["redcap"] if "redcap" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys() else math.nan
-    rc_variable = ndar_json[ndar_csv]["req_columns"][ndar_col]["rc_variable"] if "rc_variable" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys() else math.nan
-    #rc_variable = Column(ndar_json[ndar_csv]["req_columns"][ndar_col]["rc_variable"]) if "rc_variable" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys() else math.nan
-    rc_df = redcaps_dict[rc] if isinstance(rc, str) else math.nan
-    if isinstance(rc_df, pd.core.frame.DataFrame):
-        if isinstance(rc_variable, str):
-        #if isinstance(rc_variable, Column):
-            if "sessionless" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                rc_column = rc_variable # "record_id" and "interview_date" don't have sX-rX-eX appended
-            else:
-                rc_column = rc_variable + "_" + sre
-        else:
-            rc_column = math.nan
+def swap_id_digit(ids, digit):
+    # child 3000001 <-> parent 3080001, the third digit of an ID says whose redcap row it is
+    return [int(str(id)[0:2] + digit + str(id)[3:]) for id in ids]
+
+
+def codes(values, kinds="fi"):
+    # numbers as the strings the JSON mappings are keyed by (2.0 -> "2"), NaN and text left as they are
+    out = values.astype(object)
+    if values.dtype.kind in kinds:
+        present = ~pd.isna(values)
+        out[present] = values[present].astype(np.int64).astype(str).astype(object)
+    return out
+
+
+def compile_conditional(ndar_col, spec, sre):
+    # codes of the conditional column indexed by that redcap's record_id, with the "es" survey filled in for parents
+    conditional_rc = spec["conditional_column"]["redcap"]
+    if "sessionless" in spec["conditional_column"].keys():
+        conditional_rc_column = spec["conditional_column"]["rc_variable"]
+    else:
+        conditional_rc_column = spec["conditional_column"]["rc_variable"] + "_" + sre
+    try:
+        conditional_rc_df = redcaps_dict[conditional_rc]
+    except KeyError:
+        sys.exit("Can't find redcap " + conditional_rc + ", exiting.")
+    if conditional_rc_column not in conditional_rc_df.columns:
+        sys.exit("Can't find " + conditional_rc_column + " in redcap " + conditional_rc + " for conditional column of " + str(ndar_col) + ", exiting.")
+    # only float columns were ever turned into codes here, an all-integer column never matches
+    values = conditional_rc_df[conditional_rc_column]
+    keys = codes(values.to_numpy(), kinds="f")
+    if "parent" in spec["conditional_column"] and spec["conditional_column"]["parent"].lower() == 'true':
+        conditional_rc_column_es = Column(conditional_rc_column).coles
+        if conditional_rc_column_es in conditional_rc_df.columns: # look at "es" surveys too if it's a parent survey
+            values_es = conditional_rc_df[conditional_rc_column_es]
+            use_es = (values.isna() & values_es.notna()).to_numpy()
+            keys[use_es] = codes(values_es.to_numpy(), kinds="f")[use_es]
+    # conditional redcap could be parent or child, 300's or 308's or 309's
+    return pd.Series(keys, index=conditional_rc_df.index), str(conditional_rc_df.index[0])[2]
+
 
-    for id in ndar_df.index:
-        if parent:
-            id = int(str(id)[0:2] + "8" + str(id)[3:]) # will IDs always be XX8XXXX?
-            col_re = re.match('^([a-zA-Z0-9]+)_(.*)$', rc_column)
-            rc_column_es = col_re.group(1) + "es_" + col_re.group(2)
+def compile_column(ndar_col, spec, sre, parent=False):
+    # turns the JSON spec of one NDAR column into a function computing that column for a list of child IDs
+    rc = spec["redcap"] if "redcap" in spec.keys() else None
+    if rc is not None and rc not in redcaps_dict.keys():
+        sys.exit("Can't find redcap " + rc + ", exiting.")
+    rc_df = redcaps_dict[rc] if rc is not None else None
+    rc_column = None
+    if rc_df is not None and "rc_variable" in spec.keys():
+        if "sessionless" in spec.keys():
+            rc_column = spec["rc_variable"] # "record_id" and "interview_date" don't have sX-rX-eX appended
         else:
-            rc_column_es = math.nan
-        if str(id)[2] == "8" or str(id)[2] == "9":
-            child_id = int(str(id)[0:2] + "0" + str(id)[3:])
+            rc_column = spec["rc_variable"] + "_" + sre
+    rc_column_es = None
+    if parent:
+        col_re = re.match('^([a-zA-Z0-9]+)_(.*)$', rc_column)
+        rc_column_es = col_re.group(1) + "es_" + col_re.group(2)
+
+    if rc_column is None:
+        if "default" in spec.keys():
+            default = spec["default"]
+            compute = lambda ids: np.full(len(ids), default, dtype=object)
+        elif "computed" in spec.keys():
+            if not "components" in spec.keys():
+                sys.exit("Can't compute value for " + str(ndar_col) + ", must specify components to compute value from, exiting.")
+            if spec["computed"] not in ["sum", "average"]:
+                sys.exit("Can't compute value for " + str(ndar_col) + ", must specify \"sum\" or \"average.\", exiting.")
+            if rc_df is None:
+                sys.exit("Can't compute value for " + str(ndar_col) + ", must specify redcap to compute value from, exiting.")
+            compute = lambda ids: computed_values(ndar_col, spec, rc_df, sre, ids)
         else:
-            child_id = id
-        if isinstance(rc_df, pd.core.frame.DataFrame):
-            if id not in rc_df.index:
-                ndar_df.loc[child_id, ndar_col] = "" # "NA" ?
-                continue
-        if not isinstance(rc, str) or not isinstance(rc_variable, str):
-            if "default" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                val = ndar_json[ndar_csv]["req_columns"][ndar_col]["default"]
-                ndar_df.loc[child_id, ndar_col] = val
-                continue
-            elif "computed" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                if not "components" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                    sys.exit("Can't compute value for " + str(ndar_col) + ", must specify components to compute value from, exiting.")
-                if ndar_json[ndar_csv]["req_columns"][ndar_col]["computed"] == "sum" and "components" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                    sum = 0
-                    for comp in ndar_json[ndar_csv]["req_columns"][ndar_col]["components"]:
-                        val = float(rc_df.loc[id, comp + "_" + sre])
-                        sum += val
-                    if math.isnan(sum) and "missing" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                        ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][ndar_col]["missing"]
-                    else:
-                        sum = str(int(sum))
-                        ndar_df.loc[child_id, ndar_col] = sum
-                    continue
-                elif ndar_json[ndar_csv]["req_columns"][ndar_col]["computed"] == "average" and "components" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                    sum = 0
-                    ncols = len(ndar_json[ndar_csv]["req_columns"][ndar_col]["components"])
-                    for comp in ndar_json[ndar_csv]["req_columns"][ndar_col]["components"]:
-                        val = float(rc_df.loc[id, comp + "_" + sre])
-                        sum += val
-                    if math.isnan(sum) and "missing" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                        ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][ndar_col]["missing"]
-                    else:
-                        avg = str(float(sum/ncols))
-                        ndar_df.loc[child_id, ndar_col] = avg
-                    continue
-                else:
-                    sys.exit("Can't compute value for " + str(ndar_col) + ", must specify \"sum\" or \"average.\", exiting.")
-            else:
-                sys.exit("Can't assign value for " + str(ndar_col) + ", name of redcap or redcap variable name missing, exiting.")
-        if "conditional_column" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys() and "conditional_column_mapping" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-            # should really do this and "mapping" in a separate function
-            conditional_rc = ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"]["redcap"]
-            if "sessionless" in ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"].keys():
-                conditional_rc_variable = ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"]["rc_variable"]
-            else:
-                conditional_rc_variable = ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"]["rc_variable"] + "_" + sre
-            try:
-                conditional_rc_df = redcaps_dict[conditional_rc]
-            except KeyError:
-                sys.exit("Can't find redcap " + conditional_rc + ", exiting.")
-            for col in conditional_rc_df.columns:
-                if col == conditional_rc_variable:
-                    conditional_rc_column = col
-                    if "parent" in ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"] and ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"]["parent"].lower() == 'true':
-                        conditional_rc_column_es = Column(conditional_rc_column).coles
-                    else:
-                        conditional_rc_column_es = math.nan
-                    break
-            conditional_rc_id = int(str(id)[0:2] + str(conditional_rc_df.index[0])[2] + str(id)[3:]) # conditional redcap could be parent or child, 300's or 308's or 309's
-            val = conditional_rc_df.loc[conditional_rc_id, conditional_rc_column]
-            if math.isnan(val) and conditional_rc_column_es in conditional_rc_df.columns and not math.isnan(conditional_rc_df.loc[conditional_rc_id, conditional_rc_column_es]): # look at "es" surveys too if it's a parent survey
-                val = conditional_rc_df.loc[conditional_rc_id, conditional_rc_column_es]
-            if (isinstance(val, float) or isinstance(val, int)) and not math.isnan(val):
-                val = str(int(val))
-            if val in  ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column_mapping"].keys():
-                ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column_mapping"][val]
-                continue
-        if "mapping" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-            val = rc_df.loc[id, rc_column]
-            if math.isnan(val) and rc_column_es in rc_df.columns and not math.isnan(rc_df.loc[id, rc_column_es]):
-                val = rc_df.loc[id, rc_column_es]
-            if (isinstance(val, np.float64) or isinstance(val, np.float32) or isinstance(val, np.int32) or isinstance(val, np.int64)) and not math.isnan(val):
-                val = str(int(val))
-            if val in ndar_json[ndar_csv]["req_columns"][ndar_col]["mapping"].keys():
-                ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][ndar_col]["mapping"][val]
-                continue
-            if math.isnan(rc_df.loc[id, rc_column]) and "missing" in ndar_json[ndar_csv]["req_columns"][ndar_col]["mapping"].keys():
-                ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][ndar_col]["mapping"]["missing"]
-                continue
-            if "mapping_formula" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                x = rc_df.loc[id, rc_column]
-                val = eval(ndar_json[ndar_csv]["req_columns"][ndar_col]["mapping_formula"])
-                if -0.01 < val-round(val) < 0.01: # don't round if val is a decimal
-                    val = str(int(val))
-                ndar_df.loc[child_id, ndar_col] = val
-                continue
-            #if none of the above apply just take the exact value
-            if isinstance(rc_df.loc[id, rc_column], float) and not math.isnan(rc_df.loc[id, rc_column]):
-                val = str(int(rc_df.loc[id, rc_column]))
-                ndar_df.loc[child_id, ndar_col] = val
-            else:
-                ndar_df.loc[child_id, ndar_col] = rc_df.loc[id, rc_column]
-            continue
+            sys.exit("Can't assign value for " + str(ndar_col) + ", name of redcap or redcap variable name missing, exiting.")
+    else:
+        conditional = None
+        if "conditional_column" in spec.keys() and "conditional_column_mapping" in spec.keys():
+            conditional = compile_conditional(ndar_col, spec, sre)
+        formula = None
+        if "mapping" in spec.keys() and "mapping_formula" in spec.keys():
+            formula = formulas[spec["mapping_formula"]]
+        compute = lambda ids: mapped_values(spec, rc_df, rc_column, rc_column_es, conditional, formula, ids)
+
+    def column_values(child_ids):
+        ids = swap_id_digit(child_ids, "8") if parent else list(child_ids) # will IDs always be XX8XXXX?
+        values = np.full(len(ids), "", dtype=object) # "NA" ?
+        if rc_df is not None:
+            found = np.isin(ids, rc_df.index)
         else:
-            if isinstance(rc_df.loc[id, rc_column], float) and not math.isnan(rc_df.loc[id, rc_column]):
-                val = str(int(rc_df.loc[id, rc_column]))
-                ndar_df.loc[child_id, ndar_col] = val
-            else:
-                ndar_df.loc[child_id, ndar_col] = rc_df.loc[id, rc_column]
+            found = np.ones(len(ids), dtype=bool)
+        if found.any():
+            values[found] = compute(np.array(ids)[found])
+        return values
+    return column_values
+
+
+def computed_values(ndar_col, spec, rc_df, sre, ids):
+    # columns are added one at a time in the order of the spec, so the float sums come out exactly as before
+    total = np.zeros(len(ids))
+    for comp in spec["components"]:
+        total = total + rc_df[comp + "_" + sre].reindex(ids).to_numpy(dtype=float)
+    missing = np.isnan(total)
+    if missing.any() and not "missing" in spec.keys():
+        sys.exit("Can't compute value for " + str(ndar_col) + ", components missing for some subjects and no \"missing\" value specified, exiting.")
+    values = np.full(len(ids), np.nan, dtype=object)
+    if missing.any():
+        values[missing] = spec["missing"]
+    if spec["computed"] == "sum":
+        values[~missing] = codes(total[~missing])
+    else:
+        values[~missing] = [str(float(avg)) for avg in (total[~missing] / len(spec["components"])).tolist()]
+    return values
+
+
+def mapped_values(spec, rc_df, rc_column, rc_column_es, conditional, formula, ids):
+    raw = rc_df[rc_column].reindex(ids).to_numpy()
+    values = np.full(len(ids), np.nan, dtype=object)
+    done = np.zeros(len(ids), dtype=bool)
+    if conditional is not None:
+        conditional_keys, digit = conditional
+        keys = conditional_keys.reindex(swap_id_digit(ids, digit))
+        hit = keys.isin(spec["conditional_column_mapping"].keys()).to_numpy()
+        values[hit] = keys[hit].map(spec["conditional_column_mapping"]).to_numpy()
+        done |= hit
+    if "mapping" in spec.keys():
+        mapping = spec["mapping"]
+        val = raw
+        if rc_column_es in rc_df.columns:
+            raw_es = rc_df[rc_column_es].reindex(ids).to_numpy()
+            val = np.where(pd.isna(raw) & pd.notna(raw_es), raw_es, raw)
+        keys = pd.Series(codes(val))
+        hit = ~done & keys.isin(mapping.keys()).to_numpy()
+        values[hit] = keys[hit].map(mapping).to_numpy()
+        done |= hit
+        if "missing" in mapping.keys():
+            # blank in the survey itself, even if the "es" survey had an unmapped value
+            missing = ~done & pd.isna(raw)
+            values[missing] = mapping["missing"]
+            done |= missing
+        if formula is not None:
+            val = formula(raw[~done])
+            whole = np.abs(val - np.round(val)) < 0.01 # don't round if val is a decimal
+            formula_values = val.astype(object)
+            formula_values[whole] = codes(val[whole])
+            values[~done] = formula_values
+            done[:] = True
+    #if none of the above apply just take the exact value
+    values[~done] = codes(raw[~done])
+    return values
+
+
+# compiled once per NDAR csv and column, "all" columns are reused for every csv
+compiled_columns = {}
+
+def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
+    key = (ndar_csv, ndar_col, sre, parent)
+    if key not in compiled_columns:
+        compiled_columns[key] = compile_column(ndar_col, ndar_json[ndar_csv]["req_columns"][ndar_col], sre, parent=parent)
+    ndar_df[ndar_col] = compiled_columns[key](ndar_df.index)
 
 
 def map_adis(ndar_df, ndar_col, ndar_csv, ndar_json, sre, all_columns=False, parent=False):
@@ -237,110 +308,129 @@ def map_adis(ndar_df, ndar_col, ndar_csv, ndar_json, sre, all_columns=False, par
                         "6": "agorpdx", "7": "gad_pdx", "8": "ocd_pdx", "9": "ptsdpdx", "10": "mdd_pdx", "12": "adhdpdx", "13": "odd_pdx" }
     for col in ndar_json[ndar_csv]["req_columns"].keys():
         ndar_df.loc[:, col] = 0
-    for id in ndar_df.index:
-    #for id in list(rc_df.index):
-        diagnoses = []
-        for i in range(1, 9):
-            val = rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre]
-            if not math.isnan(val):
-                val = str(int(val))
-                if val not in diagnoses and val != "3":
-                    diagnoses.append(val)
-        for diagnosis in diagnoses:
-            if diagnosis == "0":
-                continue
-            else:
-                col = diagnoses_dict[diagnosis]
-                ndar_df.loc[id, col] = "1"
-        specific_phobias = []
-        for i in range(1, 9):
-            if not math.isnan(rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre]) and str(int(rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre])) == "3":
-                specific_phobias.append(rc_df.loc[id, "adis_fn_dx" + str(i) + "_sp_" + sre])
-        for i in range(1, len(specific_phobias)+1):
-            ndar_df.loc[id, "sph_pdx" + str(i)] = "1"
-            ndar_df.loc[id, "phobtype" + str(i)] = specific_phobias[i-1]
+    ids = list(ndar_df.index)
+    # the 8 diagnosis slots of every subject as one matrix, codes compared as whole numbers like str(int(val)) did
+    diagnoses = np.trunc(rc_df[["adis_fn_dx" + str(i) + "_lb_" + sre for i in range(1, 9)]].reindex(ids).to_numpy(dtype=float))
+    phobia_types = rc_df[["adis_fn_dx" + str(i) + "_sp_" + sre for i in range(1, 9)]].reindex(ids).to_numpy(dtype=object)
+    unknown = set(np.unique(diagnoses[~np.isnan(diagnoses)]).astype(int).astype(str)) - set(diagnoses_dict.keys())
+    if len(unknown) > 0:
+        sys.exit("Error: unknown ADIS diagnosis code(s) " + ", ".join(sorted(unknown)) + ", exiting.")
+    for diagnosis, col in diagnoses_dict.items():
+        if diagnosis == "0" or diagnosis == "3":
+            continue
+        present = (diagnoses == int(diagnosis)).any(axis=1)
+        if present.any():
+            values = writable_column(ndar_df, col)
+            values[present] = "1"
+            ndar_df[col] = values
+    # specific phobias are numbered in slot order, each with the phobia type from its slot
+    specific_phobia = diagnoses == 3
+    phobia_number = np.cumsum(specific_phobia, axis=1)
+    for i in range(1, specific_phobia.sum(axis=1).max(initial=0)+1):
+        slot = specific_phobia & (phobia_number == i)
+        present = slot.any(axis=1)
+        for col, value in [("sph_pdx" + str(i), "1"), ("phobtype" + str(i), phobia_types[present, np.argmax(slot[present], axis=1)])]:
+            values = writable_column(ndar_df, col)
+            values[present] = value
+            ndar_df[col] = values
+
+def write_ndar_csv(path, ndar_csv, frames, compress=False):
+    # NDAR header line, column names and the rows of each frame streamed into one file, moved into place once complete
+    if compress:
+        path = path + ".gz"
+    tmp_path = join(dirname(path), "." + basename(path) + "." + str(os.getpid()) + ".tmp")
+    start = time.time()
+    try:
+        with (gzip.open(tmp_path, 'wt') if compress else open(tmp_path, 'w')) as f:
+            f.write(ndar_csv[0:-2] + ",01" + ","*(len(frames[0].columns)-2) + "\n")
+            for i, ndar_df in enumerate(frames):
+                ndar_df.to_csv(f, index=False, header=(i == 0))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    size = os.stat(path).st_size
+    seconds = time.time() - start
+    write_stats.append((size, seconds))
+    print("wrote out {}: {} rows, {:.1f} KB in {:.3f}s".format(path, sum(len(ndar_df) for ndar_df in frames), size / 1024, seconds))
+
 
 def save_csv(ndar_csv, ndar_df):
-    ndar_df.to_csv('tmpfile.csv', index=False)
-    f = open('tmpfile.csv', 'r')
-    csvstring = f.read()
-    f.close()
-    #with open(join(out_path, ndar_csv + '_incomplete.csv'), 'w') as f:
-    with open(join(out_path, ndar_csv + '_' + sre + '_incomplete.csv'), 'w') as f:
-        f.write(ndar_csv[0:-2] + ",01" + ","*(len(df.columns)-2) + "\n")
-        f.write(csvstring)
-    f.close()
-    os.remove('tmpfile.csv')
+    write_ndar_csv(join(out_path, ndar_csv + '_' + sre + '_incomplete.csv'), ndar_csv, [ndar_df], compress)
 
-class Column:
-    def __init__(self, col):
-        self.col = col
-        col_re = re.match('^([a-zA-Z0-9]+)(_.*)?$', col)
-        if not col_re:
-            raise ValueError('column ' + col + ' does not fit column naming conventions.')
-        else:
-            after_es_str = col_re.group(2) if col_re.group(2) else ""
-            self.coles = col_re.group(1) + "es" + after_es_str
-    def __str__(self):
-        return self.col
 
+def save_combined_csv(ndar_csv, session_frames):
+    # same file concat_csvs.py makes from the per-session CSVs: NDAR header and column names once, then each session's rows
+    columns = list(session_frames[0][1].columns)
+    for sre, ndar_df in session_frames:
+        if list(ndar_df.columns) != columns:
+            sys.exit("Error: columns of " + ndar_csv + " for " + sre + " differ from " + session_frames[0][0] + ", can't combine them, exiting.")
+    write_ndar_csv(join(out_path, ndar_csv + '_combined_incomplete.csv'), ndar_csv, [ndar_df for sre, ndar_df in session_frames], compress)
 
-if __name__ == "__main__":
-    redcaps = sys.argv[1] # comma-separated list of all input redcaps
-    df_dd = sys.argv[2] # filename of data dictionary
-    ndar_json = sys.argv[3] # json with mapping info
-    sre = sys.argv[4] # session run event, like "s1_r1_e1"
-    out_path = sys.argv[5] # output folder for CSVs
-    if len(sys.argv) == 7:
-        redcaps_other_sessions = sys.argv[6] # full filenames of any redcaps needed that aren't from the session from "sre" (comma-seperated)
 
-    if not isdir(out_path):
-        os.mkdir(out_path)
-    redcaps = redcaps.split(',')
-    df_dd = pd.read_csv(df_dd)
-    with open(ndar_json, 'r') as json_file:
+def report_writes():
+    size = sum(size for size, seconds in write_stats)
+    seconds = sum(seconds for size, seconds in write_stats)
+    print("Wrote {} CSVs, {:.1f} MB in {:.2f}s".format(len(write_stats), size / (1024 * 1024), seconds))
+
+
+def load_ndar_json(path):
+    with open(path, 'r') as json_file:
         ndar_json = json.load(json_file)
-    json_file.close()
+    try:
+        formulas = compile_formulas(ndar_json) # checked before any redcap is read
+    except FormulaError as e:
+        sys.exit("Error: " + str(e) + ", exiting.")
+    return ndar_json, formulas
+
 
+def load_redcaps(df_dd, redcaps, ndar_json, redcaps_other_sessions=None):
     redcaps_dict = get_redcaps(df_dd, redcaps, ndar_json) # dataframes of each redcap
-    if 'redcaps_other_sessions' in locals() and redcaps_other_sessions.lower() != "none":
-        redcaps_other_sessions = redcaps_other_sessions.split(',')
+    if redcaps_other_sessions is not None and len(redcaps_other_sessions) > 0:
         redcaps_dict_other_sessions = get_redcaps(df_dd, redcaps_other_sessions, ndar_json, other_sessions=True)
         if len(set(redcaps_dict.keys()).intersection(set(redcaps_dict_other_sessions.keys()))) != 0:
             sys.exit("error......")
         else:
             redcaps_dict.update(redcaps_dict_other_sessions)
+    return redcaps_dict
 
 
-    if "src_subject_id" in ndar_json["all"]["req_columns"].keys(): # src_subject_id required to get ids/indices at least for thrive
-        redcap = ndar_json["all"]["req_columns"]["src_subject_id"]["redcap"]
-        if redcap in redcaps_dict.keys():
-            id_redcap = redcaps_dict[redcap]
-            ids = list(id_redcap.index)
-        # for thrive, drop rows who haven't filled out infosht
-        rc_variable = ndar_json["all"]["req_columns"]["src_subject_id"]["rc_variable"]
-        rc_variable_es = rc_variable.split("_")[0] + "es_" + "_".join(rc_variable.split("_")[1:])
-        if not "sessionless" in ndar_json["all"]["req_columns"]["src_subject_id"].keys():
-            rc_variable = rc_variable + "_" + sre + "_complete"
-            rc_variable_es = rc_variable + "es_" + sre + "_complete"
-        complete_infosht_ids = []
-        for id in ids:
-            if id_redcap.loc[id, rc_variable] == 2 or id_redcap.loc[id, rc_variable_es] == 2:
-                complete_infosht_ids.append(id)
-        ids = [int(str(id)[0:2] + "0" + str(id)[3:]) for id in complete_infosht_ids] #quick fix to parent ids -> child ids
+def subject_ids(ndar_json, sre):
+    if not "src_subject_id" in ndar_json["all"]["req_columns"].keys(): # src_subject_id required to get ids/indices at least for thrive
+        sys.exit("Error: src_subject_id missing from \"all\" in JSON, can't tell which subjects to include, exiting.")
+    redcap = ndar_json["all"]["req_columns"]["src_subject_id"]["redcap"]
+    if redcap not in redcaps_dict.keys():
+        sys.exit("Error: can't find redcap " + redcap + " for src_subject_id, exiting.")
+    id_redcap = redcaps_dict[redcap]
+    # for thrive, drop rows who haven't filled out infosht
+    rc_variable = ndar_json["all"]["req_columns"]["src_subject_id"]["rc_variable"]
+    rc_variable_es = rc_variable.split("_")[0] + "es_" + "_".join(rc_variable.split("_")[1:])
+    if not "sessionless" in ndar_json["all"]["req_columns"]["src_subject_id"].keys():
+        rc_variable = rc_variable + "_" + sre + "_complete"
+        rc_variable_es = rc_variable + "es_" + sre + "_complete"
+    complete = (id_redcap[rc_variable] == 2).to_numpy()
+    if rc_variable_es in id_redcap.columns:
+        complete |= (id_redcap[rc_variable_es] == 2).to_numpy()
+    return swap_id_digit(id_redcap.index[complete], "0") #quick fix to parent ids -> child ids
 
+
+def generate_frames(ndar_json, sre):
+    # {ndar csv: frame} for one session, from the redcaps in redcaps_dict
+    compiled_columns.clear() # specs differ between sessions
+    ids = subject_ids(ndar_json, sre)
+    frames = {}
     for ndar_csv in ndar_json.keys():
         if ndar_csv == "all":
             continue
         ndar_columns = ndar_json[ndar_csv]["all_columns"]
         df = pd.DataFrame(columns = ndar_columns, index = ids)
         if ndar_csv == "adis_v01":
-            map_adis(df, col, ndar_csv, ndar_json, sre)
+            map_adis(df, None, ndar_csv, ndar_json, sre)
         for col in ndar_json["all"]["req_columns"].keys():
             if col == "interview_date":
                 rc = ndar_json["all"]["req_columns"]["interview_date"]["redcap"]
                 rc_col = ndar_json["all"]["req_columns"]["interview_date"]["rc_variable"]
-                map_interview_date(df, ndar_json, sre, rc, rc_col)
+                df = map_interview_date(df, ndar_json, sre, rc, rc_col)
                 continue
             if col == "interview_age":
                 df.loc[:, col] = "" # just ignore for now
@@ -372,4 +462,67 @@ if __name__ == "__main__":
             if "parent" in ndar_json[ndar_csv]["req_columns"][col] and ndar_json[ndar_csv]["req_columns"][col]["parent"].lower() == "true":
                 parent_col = True
             map_vals(df, col, ndar_csv, ndar_json, sre, parent=parent_col)
+        frames[ndar_csv] = df
+    return frames
+
+
+class Column:
+    def __init__(self, col):
+        self.col = col
+        col_re = re.match('^([a-zA-Z0-9]+)(_.*)?$', col)
+        if not col_re:
+            raise ValueError('column ' + col + ' does not fit column naming conventions.')
+        else:
+            after_es_str = col_re.group(2) if col_re.group(2) else ""
+            self.coles = col_re.group(1) + "es" + after_es_str
+    def __str__(self):
+        return self.col
+
+
+if __name__ == "__main__":
+    compress = "--gzip" in sys.argv # gzip-compressed CSVs for staging
+    if compress:
+        sys.argv.remove("--gzip")
+    if len(sys.argv) == 4 and sys.argv[1] == "--batch":
+        # several sessions in one run, written straight to combined CSVs
+        # USAGE: python3 gen_NDAR_csvs.py --batch <batch JSON> <output folder> [--gzip]
+        # batch JSON: {"datadict": <data dictionary>, "sessions": [{"sre": "s1_r1_e1", "ndar_json": <JSON file>,
+        #              "redcaps": [<redcap>, ...], "redcaps_other_sessions": [<redcap>, ...]}, ...]}
+        with open(sys.argv[2], 'r') as batch_file:
+            batch = json.load(batch_file)
+        out_path = sys.argv[3]
+        if not isdir(out_path):
+            os.mkdir(out_path)
+        df_dd = pd.read_csv(batch["datadict"])
+        sessions = [(session, load_ndar_json(session["ndar_json"])) for session in batch["sessions"]] # all formulas checked up front
+        session_frames = {}
+        for session, (ndar_json, formulas) in sessions:
+            start = time.time()
+            sre = session["sre"]
+            redcaps_dict = load_redcaps(df_dd, session["redcaps"], ndar_json, session.get("redcaps_other_sessions"))
+            for ndar_csv, df in generate_frames(ndar_json, sre).items():
+                session_frames.setdefault(ndar_csv, []).append((sre, df))
+            print("Generated " + sre + " from " + basename(session["ndar_json"]) + " in {:.2f}s".format(time.time() - start))
+        for ndar_csv, frames in session_frames.items():
+            save_combined_csv(ndar_csv, frames)
+        report_writes()
+        sys.exit(0)
+
+    redcaps = sys.argv[1] # comma-separated list of all input redcaps
+    df_dd = sys.argv[2] # filename of data dictionary
+    ndar_json = sys.argv[3] # json with mapping info
+    sre = sys.argv[4] # session run event, like "s1_r1_e1"
+    out_path = sys.argv[5] # output folder for CSVs
+    redcaps_other_sessions = None
+    if len(sys.argv) == 7 and sys.argv[6].lower() != "none":
+        redcaps_other_sessions = sys.argv[6].split(',') # full filenames of any redcaps needed that aren't from the session from "sre" (comma-seperated)
+
+    if not isdir(out_path):
+        os.mkdir(out_path)
+    redcaps = redcaps.split(',')
+    df_dd = pd.read_csv(df_dd)
+    ndar_json, formulas = load_ndar_json(ndar_json)
+    redcaps_dict = load_redcaps(df_dd, redcaps, ndar_json, redcaps_other_sessions)
+    for ndar_csv, df in generate_frames(ndar_json, sre).items():
         save_csv(ndar_csv, df)
+    report_writes()
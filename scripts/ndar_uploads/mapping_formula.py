@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import ast
+import sys
+import json
+import operator
+
+import numpy as np
+
+# everything a mapping_formula may use besides numbers and x, all applied to whole numpy columns
+BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY_OPS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+FUNCTIONS = {
+    "abs": np.abs,
+    "round": np.round,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "trunc": np.trunc,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "log10": np.log10,
+    "min": np.minimum,
+    "max": np.maximum,
+}
+CONSTANTS = {
+    "pi": np.pi,
+    "e": np.e,
+}
+
+class FormulaError(ValueError):
+    pass
+
+class Formula:
+    """A mapping_formula from an NDAR spec, parsed once and evaluated over a whole column.
+
+    Only arithmetic on numbers and x (the redcap value) is allowed, plus the functions
+    in FUNCTIONS, written either bare or as math.<name>, e.g. "x + 1" or
+    "math.floor(x / 2)". Anything else raises FormulaError when the formula is parsed,
+    nothing from the spec is ever executed.
+    """
+    def __init__(self, text):
+        self.text = text
+        try:
+            tree = ast.parse(text.strip(), mode="eval")
+        except SyntaxError as e:
+            raise FormulaError("can't parse mapping_formula \"" + text + "\": " + str(e.msg))
+        self.evaluate = self.compile(tree.body)
+
+    def __call__(self, x):
+        """formula applied to x, an array of floats, as an array of the same length"""
+        x = np.asarray(x, dtype=float)
+        with np.errstate(all="ignore"):
+            return np.broadcast_to(np.asarray(self.evaluate(x), dtype=float), x.shape)
+
+    def __str__(self):
+        return self.text
+
+    def fail(self, node, what):
+        raise FormulaError(what + " not allowed in mapping_formula \"" + self.text + "\" (column " + str(node.col_offset + 1) + ")")
+
+    def compile(self, node):
+        # returns a function of the x column for the subtree at node
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            return lambda x: value
+        if isinstance(node, ast.Constant):
+            self.fail(node, "value " + repr(node.value))
+        if isinstance(node, ast.Name):
+            if node.id == "x":
+                return lambda x: x
+            if node.id in CONSTANTS:
+                value = CONSTANTS[node.id]
+                return lambda x: value
+            self.fail(node, "name \"" + node.id + "\"")
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in BINARY_OPS:
+                self.fail(node, "operator " + type(node.op).__name__)
+            op = BINARY_OPS[type(node.op)]
+            left, right = self.compile(node.left), self.compile(node.right)
+            return lambda x: op(left(x), right(x))
+        if isinstance(node, ast.UnaryOp):
+            if type(node.op) not in UNARY_OPS:
+                self.fail(node, "operator " + type(node.op).__name__)
+            op = UNARY_OPS[type(node.op)]
+            operand = self.compile(node.operand)
+            return lambda x: op(operand(x))
+        if isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in ("math", "np"):
+                name = func.attr
+            elif isinstance(func, ast.Name):
+                name = func.id
+            else:
+                self.fail(node, "call to " + (ast.get_source_segment(self.text.strip(), func) or type(func).__name__))
+            if name not in FUNCTIONS:
+                self.fail(node, "function \"" + name + "\"")
+            if node.keywords:
+                self.fail(node, "keyword arguments")
+            nargs = 2 if name in ("min", "max") else 1
+            if len(node.args) != nargs:
+                self.fail(node, str(len(node.args)) + " arguments to " + name + "()")
+            function = FUNCTIONS[name]
+            args = [self.compile(arg) for arg in node.args]
+            return lambda x: function(*[arg(x) for arg in args])
+        self.fail(node, type(node).__name__)
+
+def compile_formulas(ndar_json):
+    """{formula text: Formula} for every mapping_formula in an NDAR spec, raises FormulaError naming the column"""
+    formulas = dict()
+    for ndar_csv in ndar_json.keys():
+        for ndar_col, spec in ndar_json[ndar_csv]["req_columns"].items():
+            if "mapping_formula" not in spec.keys() or spec["mapping_formula"] in formulas:
+                continue
+            try:
+                formulas[spec["mapping_formula"]] = Formula(spec["mapping_formula"])
+            except FormulaError as e:
+                raise FormulaError(ndar_csv + " " + ndar_col + ": " + str(e))
+    return formulas
+
+if __name__ == "__main__":
+    # check the mapping formulas of NDAR specs without generating any CSVs
+    # USAGE: python3 mapping_formula.py <JSON file> [<JSON file> ...]
+    failed = False
+    for path in sys.argv[1:]:
+        with open(path, 'r') as json_file:
+            ndar_json = json.load(json_file)
+        try:
+            formulas = compile_formulas(ndar_json)
+            print(path + ": " + str(len(formulas)) + " formulas OK (" + ", ".join(formulas.keys()) + ")")
+        except FormulaError as e:
+            print("Error: " + path + ": " + str(e))
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -1,66 +1,228 @@
 import os
-from os.path import basename, join, isdir
+from os.path import basename, join, isdir, exists
 import sys
 import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import datetime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-if __name__ == "__main__":
-    dataset = sys.argv[1]
-    current_submission = sys.argv[2]
-    dataset = '/home/data/NDClab/datasets/' + dataset
+### stages the EEG folders of sessions not sent to NDAR yet in data-monitoring/ndar/<current submission>/eeg
+### and writes eeg_sub_files01.csv for them
+###
+### which archive was staged for which submission, with the size, mtime and sha256 of every file in it, is kept in
+### data-monitoring/ndar/eeg_manifest.json, new submissions are everything in sourcedata/checked not in that manifest
+###
+### USAGE: python3 new_ndar_submission.py <dataset> <current submission> [--workers N] [--include-changed]
+
+MANIFEST = "eeg_manifest.json"
+# bytes per read/write when copying and hashing
+CHUNK_SIZE = 1024 * 1024
+ARCHIVE_RE = '(sub-[0-9]+)_[a-zA-Z0-9_-]+_(s[0-9]+_r[0-9]+)_e[0-9]+\.zip'
+
+def now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+def load_manifest(ndar_path):
+    manifest_file = join(ndar_path, MANIFEST)
+    if not exists(manifest_file):
+        return {"submissions": {}, "archives": {}}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def save_manifest(ndar_path, manifest):
+    # temporary file renamed into place, an interrupted run never leaves half a manifest
+    manifest_file = join(ndar_path, MANIFEST)
+    tmp_file = join(ndar_path, "." + MANIFEST + "." + str(os.getpid()) + ".tmp")
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, manifest_file)
+    finally:
+        if exists(tmp_file):
+            os.remove(tmp_file)
+
+def import_submissions(ndar_path, manifest, current_submission):
+    # submission folders made before the manifest (or by hand) are added from the zips in their eeg folder, once
+    imported = 0
+    for entry in sorted(os.scandir(ndar_path), key=lambda e: e.name):
+        if not entry.is_dir() or entry.name.startswith(".") or entry.name == current_submission or entry.name in manifest["submissions"]:
+            continue
+        archives = []
+        if isdir(join(entry.path, 'eeg')):
+            for file in sorted(os.listdir(join(entry.path, 'eeg'))):
+                if re.match(ARCHIVE_RE, file) and file not in manifest["archives"]:
+                    manifest["archives"][file] = {"submission": entry.name, "hash": None, "files": None}
+                    archives.append(file)
+        manifest["submissions"][entry.name] = {"imported": now(), "archives": archives}
+        imported += len(archives)
+        print("imported " + str(len(archives)) + " archives of " + entry.name + " into " + MANIFEST)
+    return imported
+
+def list_files(path, rel=""):
+    # {relative path: [size, mtime in ns, None]} of every file under path
+    files = dict()
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            files.update(list_files(entry.path, rel + entry.name + "/"))
+        else:
+            stat = entry.stat()
+            files[rel + entry.name] = [stat.st_size, stat.st_mtime_ns, None]
+    return files
+
+def scan_subject(checked, sub_folder):
+    # {archive: (eeg folder, files)} for the sessions of a subject that have EEG data
+    archives = dict()
+    for sess in os.scandir(join(checked, sub_folder)):
+        eeg = join(sess.path, 'eeg')
+        if not sess.is_dir() or not isdir(eeg):
+            continue
+        entries = os.listdir(eeg)
+        if len(entries) > 0 and 'no-data.txt' not in entries:
+            archives[sub_folder + '_all_eeg_' + sess.name + '_e1.zip'] = (eeg, list_files(eeg))
+    return archives
+
+def scan_checked(dataset, workers):
+    # every subject folder is listed by its own thread, the filesystem latency is what takes time here
+    checked = join(dataset, 'sourcedata', 'checked')
+    sub_folders = sorted(f for f in os.listdir(checked) if f.startswith('sub-'))
+    archives = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sub_archives in executor.map(lambda sub_folder: scan_subject(checked, sub_folder), sub_folders):
+            archives.update(sub_archives)
+    return archives
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def folder_hash(files):
+    # one hash for the whole archive, over the relative path and hash of each file
+    sha = hashlib.sha256()
+    for rel in sorted(files.keys()):
+        sha.update((rel + " " + files[rel][2] + "\n").encode())
+    return sha.hexdigest()
+
+def hash_folder(src, files):
+    for rel in files.keys():
+        files[rel][2] = hash_file(join(src, rel))
+    return folder_hash(files)
+
+def same_stats(files, recorded):
+    if recorded is None or sorted(files.keys()) != sorted(recorded.keys()):
+        return False
+    return all(files[rel][0:2] == recorded[rel][0:2] for rel in files.keys())
+
+def stage(src, dest, tmp_dest, files):
+    # copies src to a temporary folder, hashing every file on the way, and renames it to dest once complete,
+    # a folder staged by an earlier run is only hashed
+    start = time.time()
+    if isdir(dest):
+        return hash_folder(src, files), 0, time.time() - start
+    size = 0
+    try:
+        for rel in sorted(files.keys()):
+            os.makedirs(join(tmp_dest, os.path.dirname(rel)), exist_ok=True)
+            sha = hashlib.sha256()
+            with open(join(src, rel), 'rb') as f, open(join(tmp_dest, rel), 'wb') as o:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    o.write(chunk)
+                    size += len(chunk)
+            shutil.copystat(join(src, rel), join(tmp_dest, rel))
+            files[rel][2] = sha.hexdigest()
+        os.replace(tmp_dest, dest)
+    finally:
+        if isdir(tmp_dest):
+            shutil.rmtree(tmp_dest)
+    return folder_hash(files), size, time.time() - start
+
+def sort_by_session(archives):
+    # session first, then subject, the order of the rows in eeg_sub_files01.csv
+    file_by_session = defaultdict(list)
+    for file in archives:
+        file_re = re.match('(sub-[0-9]+)_[a-zA-Z0-9_-]+_(s[0-9]+)_r[0-9]+_e[0-9]+\.zip', file)
+        if file_re:
+            file_by_session[file_re.group(2)].append(file)
+    sorted_archives = []
+    for sess in sorted(file_by_session.keys()):
+        sorted_archives.extend(sorted(file_by_session[sess]))
+    return sorted_archives
+
+
+def new_submission(dataset, current_submission, workers, include_changed=False):
+    """(manifest, {archive: (eeg folder, files)}, earlier records of the archives, archives to send) for the current submission,
+    exits when there is nothing new"""
+    ndar_path = join(dataset, 'data-monitoring', 'ndar')
+    submission_path = join(ndar_path, current_submission)
     print("starting")
-    if not isdir(join(dataset,'data-monitoring','ndar',current_submission)):
+    if not isdir(submission_path):
         sys.exit("Error, current submission folder doesn't exist")
-    if not isdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg')):
-        os.mkdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg'))
-    prior_submissions = []
-    for dir in os.listdir(join(dataset,'data-monitoring','ndar')):
-        if dir != current_submission and isdir(join(dataset,'data-monitoring','ndar',dir)):
-            prior_submissions.append(join(dataset,'data-monitoring','ndar',dir))
-    if len(prior_submissions) == 0:
-        #sys.exit("Error, no prior_submission directories seen in ndar folder")
+    if not isdir(join(submission_path, 'eeg')):
+        os.mkdir(join(submission_path, 'eeg'))
+
+    manifest = load_manifest(ndar_path)
+    import_submissions(ndar_path, manifest, current_submission)
+    if len([s for s in manifest["submissions"].keys() if s != current_submission]) == 0:
         print("first submission")
-    prior_sub_files = []
-    for prior_submission in prior_submissions:
-        for file in os.listdir(join(prior_submission,'eeg')):
-            if re.match('(sub-[0-9]+)_[a-zA-Z0-9_-]+_(s[0-9]+_r[0-9]+)_e[0-9]+\.zip', file):
-                prior_sub_files.append(file)
-    current_sub_files = []
-    for sub_folder in os.listdir(join(dataset,'sourcedata','checked')):
-        if sub_folder.startswith('sub-'):
-            for sess_folder in os.listdir(join(dataset,'sourcedata','checked',sub_folder)):
-                if isdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                    if len(os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg'))) > 0:
-                        if not 'no-data.txt' in os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                            current_sub_files.append(sub_folder+'_all_eeg_'+sess_folder+'_e1.zip')
-    new_sub_files = set(current_sub_files).difference(set(prior_sub_files))
+    current_archives = scan_checked(dataset, workers)
+
+    # archives sent in an earlier submission whose files no longer have the size and mtime they had then,
+    # those with a recorded hash are hashed again to tell touched files from changed ones
+    submitted = {file: record for file, record in manifest["archives"].items() if record["submission"] != current_submission}
+    to_check = dict()
+    for file, record in submitted.items():
+        if file not in current_archives:
+            continue
+        files = current_archives[file][1]
+        if record["files"] is None:
+            record["files"] = files # first run since it was imported, these stats are taken as what was submitted
+        elif not same_stats(files, record["files"]):
+            to_check[file] = record
+    changed = []
+    if to_check:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = dict(zip(to_check.keys(), executor.map(lambda file: hash_folder(*current_archives[file]) if to_check[file]["hash"] else None, to_check.keys())))
+        for file, record in to_check.items():
+            if hashes[file] is not None and hashes[file] == record["hash"]:
+                record["files"] = current_archives[file][1]
+            else:
+                print("Warning: " + file + " changed since it was sent in " + record["submission"] +
+                      ("" if record["hash"] else " (no hash recorded for it, file sizes or mtimes differ)"))
+                changed.append(file)
+
+    new_sub_files = [file for file in current_archives.keys() if file not in submitted]
+    if include_changed:
+        new_sub_files.extend(changed)
+    new_sub_files = sort_by_session(new_sub_files)
     if len(new_sub_files) == 0:
+        save_manifest(ndar_path, manifest)
         sys.exit("Exiting, no new subjects seen")
-    else:
-        file_by_session = defaultdict(list)
-        for file in new_sub_files:
-            file_re = re.match('(sub-[0-9]+)_[a-zA-Z0-9_-]+_(s[0-9]+)_r[0-9]+_e[0-9]+\.zip', file)
-            if file_re:
-                sess = file_re.group(2)
-                file_by_session[sess].append(file)
-        new_sub_files = []
-        sessions = list(file_by_session.keys())
-        sessions.sort()
-        for sess in sessions:
-            file_by_session[sess].sort()
-            new_sub_files.extend(file_by_session[sess])
-    for new_sub_file in new_sub_files:
-        file_re = re.match('(sub-[0-9]+)_[a-zA-Z0-9_-]+_(s[0-9]+_r[0-9]+)_e[0-9]+\.zip', new_sub_file)
-        if file_re:
-            sub_folder = file_re.group(1)
-            sess_folder = file_re.group(2)
-            if not 'no-data.txt' in os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                if not isdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg',sub_folder+'_all_eeg_'+sess_folder+'_e1')):
-                    _ = os.system('cp -R ' + join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg') + ' ' + \
-                                join(dataset,'data-monitoring','ndar',current_submission,'eeg',sub_folder+'_all_eeg_'+sess_folder+'_e1'))
+    return manifest, current_archives, submitted, new_sub_files
+
+def record_submission(dataset, current_submission, manifest, submitted, new_sub_files, records):
+    # records: {archive: manifest record} of everything staged, a re-run of the current submission replaces what was recorded for it before
+    ndar_path = join(dataset, 'data-monitoring', 'ndar')
+    for file in [file for file, record in manifest["archives"].items() if record["submission"] == current_submission]:
+        del manifest["archives"][file]
+    for new_sub_file, record in records.items():
+        if new_sub_file in submitted:
+            record["previous"] = submitted[new_sub_file]
+        manifest["archives"][new_sub_file] = record
+    manifest["submissions"][current_submission] = {"staged": now(), "archives": new_sub_files}
+    save_manifest(ndar_path, manifest)
+
+def write_sub_files_csv(dataset, current_submission, new_sub_files):
     #experiment_id = "2232" # thrive = 2232
     experiment_id = "" # read leave blank
-    with open(join(dataset,'data-monitoring','ndar',current_submission,'eeg_sub_files01.csv'), 'w') as o:
+    with open(join(dataset, 'data-monitoring', 'ndar', current_submission, 'eeg_sub_files01.csv'), 'w') as o:
         _ = o.write('eeg_sub_files,01,,,,,,,\n')
         _ = o.write('subjectkey,src_subject_id,interview_date,interview_age,sex,experiment_id,data_file1,data_file1_type,timepoint_label\n')
         for new_sub_file in new_sub_files:
@@ -71,4 +233,44 @@ if __name__ == "__main__":
                 _ = o.write(','+src_subject_id+',,,,'+experiment_id+','+new_sub_file+',file folder,'+timepoint_label+'\n')
             else:
                 print("doesn't match expected format?")
-    o.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python3 new_ndar_submission.py <dataset> <current submission> [--workers N] [--include-changed]")
+    parser.add_argument("dataset")
+    parser.add_argument("current_submission")
+    parser.add_argument("--workers", type=int, default=4, help="folders listed, hashed and copied at the same time")
+    parser.add_argument("--include-changed", action="store_true", help="also stage sessions whose files changed after they were submitted")
+    args = parser.parse_args()
+
+    current_submission = args.current_submission
+    dataset = '/home/data/NDClab/datasets/' + args.dataset
+    workers = max(1, args.workers)
+    manifest, current_archives, submitted, new_sub_files = new_submission(dataset, current_submission, workers, args.include_changed)
+
+    submission_path = join(dataset, 'data-monitoring', 'ndar', current_submission)
+    staging_path = join(submission_path, '.staging')
+    # left by a job that was killed while staging, like the .zip.part files zip_eeg.py removes
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path, exist_ok=True)
+    start = time.time()
+    total_size = 0
+    records = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for new_sub_file in new_sub_files:
+            src, files = current_archives[new_sub_file]
+            folder = new_sub_file[:-len('.zip')]
+            futures[new_sub_file] = executor.submit(stage, src, join(submission_path, 'eeg', folder),
+                                                    join(staging_path, folder + "." + str(os.getpid())), files)
+        for new_sub_file, future in futures.items():
+            archive_hash, size, seconds = future.result()
+            total_size += size
+            records[new_sub_file] = {"submission": current_submission, "staged": now(), "hash": archive_hash, "files": current_archives[new_sub_file][1]}
+            print("staged " + new_sub_file[:-len('.zip')] + (" ({:.1f} MB in {:.2f}s)".format(size / (1024 * 1024), seconds) if size else " (already staged)"))
+    seconds = time.time() - start
+    print("Staged {} sessions, {:.1f} MB in {:.2f}s, {:.1f} MB/s".format(len(new_sub_files), total_size / (1024 * 1024), seconds,
+          total_size / (1024 * 1024) / seconds if seconds else 0))
+    record_submission(dataset, current_submission, manifest, submitted, new_sub_files, records)
+    write_sub_files_csv(dataset, current_submission, new_sub_files)
+    shutil.rmtree(staging_path, ignore_errors=True)
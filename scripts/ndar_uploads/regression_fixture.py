@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import filecmp
+import argparse
+import subprocess
+from os.path import join, abspath, dirname, basename
+
+import numpy as np
+import pandas as pd
+
+RACE_CODES = ["10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "24", "25", "999"]
+ADIS_CODES = [0, 1, 2, 3, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13]
+# roles that need numbers in the column, a column used for several things gets the first of these it has
+NUMERIC_ROLES = ["complete", "race", "adis", "conditional", "component", "formula", "mapping"]
+
+def es_column(col):
+    # parent survey in spanish, same naming as map_vals
+    col_re = re.match('^([a-zA-Z0-9]+)_(.*)$', col)
+    return col_re.group(1) + "es_" + col_re.group(2)
+
+def coles_column(col):
+    # same as Column(col).coles in gen_NDAR_csvs.py
+    col_re = re.match('^([a-zA-Z0-9]+)(_.*)?$', col)
+    return col_re.group(1) + "es" + (col_re.group(2) if col_re.group(2) else "")
+
+def spec_columns(ndar_json, sre):
+    """({redcap: {column: role}}, redcaps from other sessions, redcaps keyed by parent IDs) read by gen_NDAR_csvs.py for this spec"""
+    columns = dict()
+    other_sessions = set()
+    parents = set()
+    def need(rc, col, role):
+        rc_columns = columns.setdefault(rc, dict())
+        if rc_columns.get(col) not in NUMERIC_ROLES:
+            rc_columns[col] = role
+    for ndar_csv in ndar_json.keys():
+        for ndar_col, spec in ndar_json[ndar_csv]["req_columns"].items():
+            if "redcap" not in spec.keys():
+                continue
+            rc = spec["redcap"]
+            if "different_session" in spec.keys():
+                other_sessions.add(rc)
+            if "parent" in spec.keys():
+                parents.add(rc)
+            rc_variable = spec.get("rc_variable")
+            if ndar_col == "src_subject_id":
+                parents.add(rc)
+                if "sessionless" in spec.keys():
+                    need(rc, rc_variable, "complete")
+                    need(rc, rc_variable.split("_")[0] + "es_" + "_".join(rc_variable.split("_")[1:]), "complete")
+                else:
+                    need(rc, rc_variable + "_" + sre + "_complete", "complete")
+                    need(rc, rc_variable + "_" + sre + "_complete" + "es_" + sre + "_complete", "complete")
+            elif ndar_col == "interview_date":
+                need(rc, rc_variable, "date")
+                need(rc, coles_column(rc_variable), "date")
+            elif ndar_col == "interview_age":
+                continue
+            elif ndar_col == "race":
+                base = rc_variable if "sessionless" in spec.keys() else rc_variable + "_" + sre
+                for code in RACE_CODES:
+                    need(rc, base + "___" + code, "race")
+                    need(rc, coles_column(base) + "___" + code, "race")
+            elif ndar_csv == "adis_v01":
+                for i in range(1, 9):
+                    need(rc, "adis_fn_dx" + str(i) + "_lb_" + sre, "adis")
+                    need(rc, "adis_fn_dx" + str(i) + "_sp_" + sre, "phobia")
+            else:
+                for comp in spec.get("components", []):
+                    need(rc, comp + "_" + sre, "component")
+                if rc_variable is None:
+                    continue
+                col = rc_variable if "sessionless" in spec.keys() else rc_variable + "_" + sre
+                if "mapping_formula" in spec.keys():
+                    role = "formula"
+                elif isinstance(spec.get("mapping"), dict):
+                    role = "mapping"
+                else:
+                    role = "exact"
+                need(rc, col, role)
+                if "parent" in spec.keys():
+                    need(rc, es_column(col), role)
+                if "conditional_column" in spec.keys():
+                    conditional = spec["conditional_column"]
+                    col = conditional["rc_variable"] if "sessionless" in conditional.keys() else conditional["rc_variable"] + "_" + sre
+                    need(conditional["redcap"], col, "conditional")
+                    if conditional.get("parent", "").lower() == "true":
+                        need(conditional["redcap"], coles_column(col), "conditional")
+    return columns, other_sessions, parents
+
+def column_values(rng, role, n):
+    # values of the kinds REDCap exports have, with the blanks and odd values the mapping has to handle
+    nan = np.nan
+    if role == "complete":
+        return rng.choice([2, 2, 2, 0, 1, nan], n)
+    if role == "date":
+        return np.array(["2024-%02d-%02d 10:%02d:00" % (rng.integers(1, 13), rng.integers(1, 29), rng.integers(0, 60))
+                         if rng.random() < .8 else None for _ in range(n)], dtype=object)
+    if role == "mapping":
+        return rng.choice([0, 1, 2, 3, 4, 5, 88, nan, nan], n)
+    if role == "formula":
+        return rng.choice([0, 1, 2, 3, 2.5, -1, nan], n)
+    if role == "conditional":
+        return rng.choice([1, 2, 3, 4, nan], n)
+    if role == "component":
+        return rng.choice([0, 1, 2, 3, 4, 4, 4, 4, nan], n)
+    if role == "race":
+        return rng.choice([0] * 30 + [1] * 3 + [nan], n)
+    if role == "adis":
+        return rng.choice(ADIS_CODES + [nan] * 3, n)
+    if role == "phobia":
+        return rng.choice(["dogs", "heights", "spiders, bugs", "", None], n)
+    kind = rng.integers(0, 4)
+    if kind == 0:
+        return rng.choice(["yes", "no", "maybe so", None], n)
+    if kind == 1:
+        return rng.integers(0, 5, n)
+    if kind == 2:
+        return rng.choice([1.7, 2.0, 3.2, nan, -0.5], n)
+    return rng.choice([0, 1, 2, nan], n)
+
+def make_fixture(ndar_json, sre, out_dir, prefix, subjects=300, seed=0, second_parent=False):
+    """write synthetic REDCap exports and a datadict for the spec, returns (main redcaps, other session redcaps, datadict)
+
+    Child redcaps miss about 10% of the subjects, clinician redcaps have all of them,
+    redcaps with parent columns are keyed by parent IDs (308...). second_parent adds
+    two 309... parents, whose children then show up twice in the output.
+    """
+    rng = np.random.default_rng(seed)
+    columns, other_sessions, parents = spec_columns(ndar_json, sre)
+    child_ids = np.arange(3000001, 3000001 + subjects)
+    main_redcaps, other_redcaps, datadict = [], [], []
+    for rc, rc_columns in columns.items():
+        if rc in parents:
+            ids = child_ids + 80000
+            if second_parent:
+                ids = np.append(ids, [3090001, 3090002])
+        elif "clinician" in rc:
+            ids = child_ids
+        else:
+            ids = child_ids[rng.random(subjects) < .9]
+        rc_df = pd.DataFrame({"record_id": ids})
+        for col, role in rc_columns.items():
+            rc_df[col] = column_values(rng, role, len(ids))
+        path = join(out_dir, prefix + rc + "_DATA_2024-07-12_1200.csv")
+        rc_df.to_csv(path, index=False)
+        if rc in other_sessions:
+            other_redcaps.append(path)
+        else:
+            main_redcaps.append(path)
+            datadict.append({"variable": rc + "_s1_r1_e1", "dataType": "redcap_data", "provenance": "file: \"" + rc + "\"; variable: \"record_id\";"})
+    datadict_path = join(out_dir, "central-tracker_datadict.csv")
+    pd.DataFrame(datadict).to_csv(datadict_path, index=False)
+    return main_redcaps, other_redcaps, datadict_path
+
+def run(script, args, out_path):
+    # each run in its own working directory, older versions leave files there
+    os.makedirs(join(out_path, "cwd"), exist_ok=True)
+    start = time.time()
+    subprocess.run([sys.executable, abspath(script)] + args[:4] + [out_path] + args[4:], cwd=join(out_path, "cwd"), check=True)
+    return time.time() - start
+
+if __name__ == "__main__":
+    # synthetic REDCaps for an NDAR spec, and optionally a byte for byte comparison of two versions of gen_NDAR_csvs.py on them
+    # USAGE: python3 regression_fixture.py <JSON file> <sre string> <output path> [--compare <old gen_NDAR_csvs.py>]
+    # e.g. git show HEAD~1:scripts/ndar_uploads/gen_NDAR_csvs.py > /tmp/old_gen_NDAR_csvs.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ndar_json")
+    parser.add_argument("sre")
+    parser.add_argument("out_path")
+    parser.add_argument("--subjects", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--second-parent", action="store_true", help="add 309... parents, i.e. children listed twice")
+    parser.add_argument("--compare", metavar="GEN_NDAR_CSVS", help="other version of gen_NDAR_csvs.py to compare outputs with")
+    args = parser.parse_args()
+
+    with open(args.ndar_json, 'r') as json_file:
+        ndar_json = json.load(json_file)
+    redcap_path = join(args.out_path, "redcap")
+    os.makedirs(redcap_path, exist_ok=True)
+    prefix = basename(args.ndar_json).split("_")[0].capitalize()
+    main_redcaps, other_redcaps, datadict_path = make_fixture(ndar_json, args.sre, redcap_path, prefix,
+                                                              args.subjects, args.seed, args.second_parent)
+    gen_args = [",".join(main_redcaps), datadict_path, abspath(args.ndar_json), args.sre, ",".join(other_redcaps) if other_redcaps else "None"]
+    current = join(dirname(abspath(__file__)), "gen_NDAR_csvs.py")
+    print("Wrote " + str(len(main_redcaps) + len(other_redcaps)) + " redcaps for " + str(args.subjects) + " subjects to " + redcap_path)
+    print("python3 " + current + " " + " ".join(gen_args[:4]) + " <output path> " + gen_args[4])
+    if not args.compare:
+        sys.exit(0)
+
+    times = dict()
+    for name, script in [("old", args.compare), ("new", current)]:
+        times[name] = run(script, gen_args, join(args.out_path, name))
+    old_csvs = sorted(f for f in os.listdir(join(args.out_path, "old")) if f.endswith(".csv"))
+    new_csvs = sorted(f for f in os.listdir(join(args.out_path, "new")) if f.endswith(".csv"))
+    match, mismatch, errors = filecmp.cmpfiles(join(args.out_path, "old"), join(args.out_path, "new"), old_csvs, shallow=False)
+    print("old: {:.2f}s, new: {:.2f}s".format(times["old"], times["new"]))
+    for csv in mismatch + errors + [csv for csv in new_csvs if csv not in old_csvs]:
+        print("Error: " + csv + " differs")
+    if len(match) != len(old_csvs) or len(new_csvs) != len(old_csvs):
+        sys.exit(1)
+    print(str(len(match)) + " CSVs identical")
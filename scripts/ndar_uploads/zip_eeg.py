@@ -0,0 +1,117 @@
+import os
+from os.path import basename, dirname, join, exists
+import sys
+import time
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from new_ndar_submission import new_submission, record_submission, write_sub_files_csv, hash_file, hash_folder, folder_hash, now
+
+### zips the EEG folders of sessions not sent to NDAR yet straight from sourcedata/checked into
+### data-monitoring/ndar/<current submission>/eeg/<archive>.zip, without copying them first,
+### and records them in data-monitoring/ndar/eeg_manifest.json like new_ndar_submission.py does
+###
+### each session is zipped by one process of a pool sized to SLURM_CPUS_PER_TASK, a zip is written as .<archive>.zip.part
+### and renamed when complete, so a job that was interrupted can be run again and only zips what isn't done
+###
+### USAGE: python3 zip_eeg.py <dataset> <current submission> [--workers N] [--level 0-9] [--store .eeg,...] [--include-changed]
+
+# files with these extensions are stored as they are, deflating them takes long and barely makes them smaller
+STORE_EXTENSIONS = [".eeg"]
+
+def zip_session(src, folder, zip_path, files, level, store_extensions):
+    """zips the files of src (relative paths) into zip_path as folder/<file>, returns ({file: sha256}, zip size, bytes read or None if it was zipped before, seconds)"""
+    start = time.time()
+    hashes = dict()
+    if exists(zip_path):
+        # zipped by an earlier run, only hashed for the manifest
+        hash_folder(src, files)
+        return {rel: files[rel][2] for rel in files.keys()}, os.stat(zip_path).st_size, None, time.time() - start
+    tmp_path = join(dirname(zip_path), "." + basename(zip_path) + ".part")
+    read = 0
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level) as zf:
+            for rel in sorted(files.keys()):
+                path = join(src, rel)
+                if level == 0 or os.path.splitext(rel)[1].lower() in store_extensions:
+                    zf.write(path, folder + "/" + rel, compress_type=zipfile.ZIP_STORED)
+                else:
+                    zf.write(path, folder + "/" + rel, compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+                # hashed right after it's zipped, while the file is still in the page cache
+                hashes[rel] = hash_file(path)
+                read += os.stat(path).st_size
+        os.replace(tmp_path, zip_path)
+    finally:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+    return hashes, os.stat(zip_path).st_size, read, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python3 zip_eeg.py <dataset> <current submission> [--workers N] [--level 0-9] [--store .eeg,...] [--include-changed]")
+    parser.add_argument("dataset")
+    parser.add_argument("current_submission")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)),
+                        help="sessions zipped at the same time, SLURM_CPUS_PER_TASK by default")
+    parser.add_argument("--level", type=int, default=6, choices=range(0, 10), help="deflate level, 0 stores every file")
+    parser.add_argument("--store", default=",".join(STORE_EXTENSIONS), help="extensions that are never deflated")
+    parser.add_argument("--include-changed", action="store_true", help="also zip sessions whose files changed after they were submitted")
+    args = parser.parse_args()
+
+    current_submission = args.current_submission
+    dataset = '/home/data/NDClab/datasets/' + args.dataset
+    workers = max(1, args.workers)
+    store_extensions = [ext.strip().lower() for ext in args.store.split(",") if ext.strip()]
+    manifest, current_archives, submitted, new_sub_files = new_submission(dataset, current_submission, workers, args.include_changed)
+
+    eeg_path = join(dataset, 'data-monitoring', 'ndar', current_submission, 'eeg')
+    for file in os.listdir(eeg_path):
+        if file.endswith(".zip.part"):
+            os.remove(join(eeg_path, file)) # left by an interrupted job
+
+    # biggest sessions first so no process is left with a long one at the end, the pool hands out the next session to whichever process is free
+    by_size = sorted(new_sub_files, key=lambda file: -sum(size for size, mtime, sha in current_archives[file][1].values()))
+    start = time.time()
+    total_read = 0
+    total_zipped = 0
+    records = dict()
+    failed = []
+    resumed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for new_sub_file in by_size:
+            src, files = current_archives[new_sub_file]
+            futures[executor.submit(zip_session, src, new_sub_file[:-len('.zip')], join(eeg_path, new_sub_file),
+                                    files, args.level, store_extensions)] = new_sub_file
+        for i, future in enumerate(as_completed(futures)):
+            new_sub_file = futures[future]
+            try:
+                hashes, zip_size, read, seconds = future.result()
+            except Exception as e:
+                print("Error: couldn't zip " + new_sub_file + ": " + str(e))
+                failed.append(new_sub_file)
+                continue
+            files = current_archives[new_sub_file][1]
+            for rel in files.keys():
+                files[rel][2] = hashes[rel]
+            records[new_sub_file] = {"submission": current_submission, "staged": now(), "hash": folder_hash(files),
+                                     "files": files, "zip_size": zip_size}
+            progress = "[" + str(i + 1) + "/" + str(len(futures)) + "] "
+            if read is not None:
+                total_read += read
+                total_zipped += zip_size
+                print(progress + "zipped " + new_sub_file + " ({:.1f} MB to {:.1f} MB in {:.2f}s)".format(read / (1024 * 1024), zip_size / (1024 * 1024), seconds))
+            else:
+                resumed += 1
+                print(progress + new_sub_file + " already zipped")
+    seconds = time.time() - start
+    print("Zipped {} sessions ({} already zipped), {:.1f} MB to {:.1f} MB in {:.2f}s, {:.1f} MB/s, {:.1f} sessions/hr".format(
+          len(records) - resumed, resumed, total_read / (1024 * 1024), total_zipped / (1024 * 1024), seconds,
+          total_read / (1024 * 1024) / seconds if seconds else 0, (len(records) - resumed) / seconds * 3600 if seconds else 0))
+
+    new_sub_files = [file for file in new_sub_files if file not in failed]
+    record_submission(dataset, current_submission, manifest, submitted, new_sub_files, records)
+    write_sub_files_csv(dataset, current_submission, new_sub_files)
+    if failed:
+        sys.exit("Error: " + str(len(failed)) + " sessions couldn't be zipped, run again to retry them")